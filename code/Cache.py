@@ -0,0 +1,253 @@
+import os
+import ast
+import json
+import time
+import shutil
+import hashlib
+import inspect
+from Simulation import Simulation
+from Recorder import TrajectoryRecorder
+from Trajectory import Trajectory
+
+# Modules that define a run and the data that is stored of it, together with every module of this folder they
+# import (see `code_files`)
+CODE_ROOTS = ('Simulation.py', 'Recorder.py', 'Trajectory.py', 'OnlineMetrics.py', 'Detectors.py')
+
+def code_files(roots=CODE_ROOTS):
+    """Find the source files of the roots and of all the modules of this folder they import, directly or not (also
+    the imports inside functions, e.g. of optional modules), so a new module is covered as soon as it is used
+
+    Returns: Sorted tuple of file names
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    files, todo = set(), list(roots)
+    while todo:
+        name = todo.pop()
+        if name in files or not os.path.isfile(os.path.join(folder, name)): continue
+        files.add(name)
+
+        with open(os.path.join(folder, name), 'r') as f:
+            tree = ast.parse(f.read(), filename=name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                todo += [alias.name.split('.')[0] + '.py' for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                todo.append(node.module.split('.')[0] + '.py')
+    return tuple(sorted(files))
+
+# Source files that define the result of a simulation, a change in any of them invalidates the cache
+CODE_FILES = code_files()
+
+def code_version():
+    """Hash of the source of the simulation (see `CODE_FILES`)
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for name in CODE_FILES:
+        with open(os.path.join(folder, name), 'rb') as f:
+            h.update(name.encode() + b'\0' + f.read())
+    return h.hexdigest()
+
+def file_hash(filename):
+    """Hash of the content of a file
+    """
+
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def save_json(value, filename):
+    with open(filename, 'w') as f:
+        json.dump(value, f)
+
+def load_json(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+class ResultCache:
+    """Cache of simulation runs and of everything derived from them, on disk
+
+    Every run is stored under a key that is the hash of everything its result depends on: the params of all the
+    car types, the arguments of the `Simulation` (road geometry, delta_t, car_frequency, engine, ...), the seed,
+    the simulated time and the version of the simulation code. Changing any of them gives a new key, so stale data
+    is never reused.
+
+    Each key has its own folder holding the run as a binary trajectory (see `Trajectory`) and any derived
+    artifacts (averages, images, ...). When the cache is bigger than max_size, the least recently used entries
+    are deleted. Files that are still being written are kept in the '.tmp' folder of the cache, which is not an
+    entry, so evicting never deletes them.
+
+    Args:
+        folder: Folder to keep the cache in
+        max_size: Maximum size of the cache in bytes
+    """
+
+    # Folder of the cache the files that are being written are kept in
+    TEMP = '.tmp'
+
+    def __init__(self, folder='cache', max_size=10 * 2**30):
+        self.folder = folder
+        self.max_size = max_size
+        self.version = code_version()
+
+    def key(self, params_list, seed, time=None, warm_start=None, monitor=None, **simulation_kwargs):
+        """Get the key of a run
+
+        Args:
+            params_list: List of car params of the run
+            seed: Seed of the run (see `Simulation`)
+            time: Amount of time the run is simulated for (None if it runs until a car reaches the end)
+            warm_start: Checkpoint the run starts from (see `Simulation.restore`), its content is part of the key
+            monitor: `ConvergenceMonitor` that ends the run early, its settings are part of the key
+            simulation_kwargs: Arguments of the `Simulation`, the defaults are filled in for the missing ones
+
+        Returns: Hex string
+        """
+
+        arguments = inspect.signature(Simulation).bind(params_list, seed=seed, **simulation_kwargs)
+        arguments.apply_defaults()
+        description = {name: value for name, value in arguments.arguments.items() if name != 'params_list'}
+        description.update(params_list=[params.as_dict() for params in params_list], time=time, version=self.version)
+        if warm_start is not None: description.update(warm_start=file_hash(warm_start))
+        if monitor is not None: description.update(monitor=repr(monitor))
+
+        text = json.dumps(description, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key, name):
+        """Get the filename of an item stored for a key (the run itself is 'run.traj')
+        """
+
+        return os.path.join(self.folder, key, name)
+
+    def run(self, params_list, seed, time=None, warm_start=None, monitor=None, **simulation_kwargs):
+        """Run a simulation, or get its data from the cache if it was already run
+
+        Args:
+            optional monitor: New `ConvergenceMonitor` that ends the run once it converged, its summary is stored
+                              with the run (see `convergence`)
+
+        Returns: Tuple with the key of the run and its data as a `Trajectory`
+        """
+
+        key = self.key(params_list, seed, time, warm_start, monitor, **simulation_kwargs)
+        filename = self.path(key, 'run.traj')
+
+        if not self.has_run(key):
+            # The run is written outside the entry and moved into it once complete, so an interrupted run or
+            # another process never sees half of it
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            temp = self.__temp_name(key, 'run.traj')
+            if warm_start is not None:
+                sim = Simulation.restore(warm_start, params_list=params_list, seed=seed)
+            else:
+                sim = Simulation(params_list, seed=seed, **simulation_kwargs)
+            sim.run(time=time, recorder=TrajectoryRecorder(temp) if monitor is None else [TrajectoryRecorder(temp), monitor])
+            try:
+                os.replace(temp, filename)
+            except OSError:
+                if not os.path.exists(filename): raise
+                # Another process stored the same run in the meantime
+                shutil.rmtree(temp, ignore_errors=True)
+            save_json({'time': time, 'seed': repr(seed), 'warm_start': warm_start, 'simulation_kwargs': {k: repr(v) for k, v in simulation_kwargs.items()},
+                       'params_list': [{k: repr(v) for k, v in params.as_dict().items()} for params in params_list]}, self.path(key, 'meta.json'))
+            if monitor is not None: save_json(monitor.summary(), self.path(key, 'convergence.json'))
+            self.evict(keep=key)
+
+        self.__touch(key)
+        return key, Trajectory(filename)
+
+    def convergence(self, key):
+        """Returns: The summary of the `ConvergenceMonitor` of a run (see `ConvergenceMonitor.summary`), None if it
+                    was run without one
+        """
+
+        filename = self.path(key, 'convergence.json')
+        return load_json(filename) if os.path.exists(filename) else None
+
+    def has_run(self, key):
+        """Returns: True if the run of a key is in the cache
+        """
+
+        return os.path.exists(self.path(key, 'run.traj'))
+
+    def artifact(self, key, name, compute, save=save_json, load=load_json):
+        """Get something derived from a run, computing and storing it the first time
+
+        Args:
+            key: Key of the run it is derived from
+            name: Filename of the artifact in the entry of the run (e.g. 'average.json')
+            compute: Function without arguments that computes the artifact
+            save: Function called as save(value, filename) to store the artifact
+            load: Function that reads the artifact from a filename
+
+        Returns: The artifact
+        """
+
+        filename = self.path(key, name)
+        if os.path.exists(filename):
+            self.__touch(key)
+            return load(filename)
+
+        value = compute()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp = self.__temp_name(key, name)
+        save(value, temp)
+        os.replace(temp, filename)
+        self.__touch(key)
+        return value
+
+    def size(self):
+        """Returns: Total size of the cache in bytes
+        """
+
+        return sum(size for _, _, size in self.__entries())
+
+    def evict(self, keep=None):
+        """Delete the least recently used entries until the cache fits in max_size
+
+        Args:
+            keep: Key of an entry that is never deleted (e.g. the one that was just added)
+        """
+
+        entries = sorted(self.__entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= self.max_size: break
+            if key == keep: continue
+            shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+            total -= size
+
+    def __entries(self):
+        """Returns: List with (key, time of last use, size in bytes) for each entry of the cache
+        """
+
+        if not os.path.isdir(self.folder): return []
+
+        entries = []
+        for key in os.listdir(self.folder):
+            entry = os.path.join(self.folder, key)
+            if key == self.TEMP or not os.path.isdir(entry): continue
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry) for f in files)
+            entries.append((key, os.path.getmtime(entry), size))
+        return entries
+
+    def __touch(self, key):
+        """Mark an entry as used now (the modification time of its folder is the time of last use)
+        """
+
+        now = time.time()
+        os.utime(os.path.join(self.folder, key), (now, now))
+
+    def __temp_name(self, key, name):
+        """Get a filename to write an item of an entry to before it is moved into the entry (keeps the extension,
+        some writers use it to pick the format)
+        """
+
+        folder = os.path.join(self.folder, self.TEMP)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, f'{os.getpid()}-{key}-{name}')
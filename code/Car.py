@@ -8,6 +8,22 @@ from DriverModel import Driver
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 
+# Independent random streams used by a road
+RANDOM_STREAMS = ('spawn', 'params', 'failures')
+
+def random_streams(seed=None):
+    """Make the random number generators used by a road, each with its own independent stream
+
+    Args:
+        seed: Int or `np.random.SeedSequence` the streams are derived from (fresh entropy if None)
+
+    Returns: Dict with one `np.random.Generator` for spawning (lane and type of new cars), for sampling the
+             params of new cars and for car failures
+    """
+
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return dict(zip(RANDOM_STREAMS, (np.random.default_rng(s) for s in seed_seq.spawn(len(RANDOM_STREAMS)))))
+
 class Params:
     """Class to store the Car parameters, including IDM parameters
 
@@ -31,6 +47,9 @@ class Params:
         spawn_weight: Defines the weighted probability that this car will spawn
     """
 
+    FIELDS = ('v_0', 's_0', 's_1', 'T', 'a', 'b', 'delta', 'length', 'thr', 'pol', 'fail_p', 'right_bias', 'start_v', 'fail_steps', 'spawn_weight')
+    __slots__ = FIELDS # Every car has its own Params, so they have no __dict__
+
     def __init__(self, **kwargs):
         self.v_0 = kwargs.pop('v_0', (30, 1))
         self.s_0 = kwargs.pop('s_0', (2, 1))
@@ -53,13 +72,24 @@ class Params:
         if len(kwargs) > 0:
             for arg in kwargs.keys(): warnings.warn("Unexpected kwarg " + arg)
 
-    def apply_dist(self):
+    def as_dict(self):
+        """Returns: Dict with the value of every param (the kwargs to make a copy of this object)
+        """
+
+        return {field: getattr(self, field) for field in Params.FIELDS}
+
+    def apply_dist(self, rng=None):
         """Applies the distribution and returns a Params object with fixed values
+
+        Args:
+            rng: `np.random.Generator` to sample the values with (the global NumPy random state if None)
         """
-        
+
+        rng = rng if rng is not None else np.random
+
         # Make sure we get no negative values and that we cut off at 2 sigma (then the average will be chosen)
         def positive_normal(avg, dev):
-            a = abs(np.random.normal(avg, dev))
+            a = abs(rng.normal(avg, dev))
             return a if avg-2*dev <= a <= avg+2*dev else avg
 
         v_0 = positive_normal(self.v_0[0], self.v_0[1]) if hasattr(self.v_0, '__getitem__') else self.v_0
@@ -82,171 +112,338 @@ class Params:
         return Params(v_0=v_0, s_0=s_0, s_1=s_1, T=T, a=a, b=b, delta=delta, length=length,
                       thr=thr, pol=pol, start_v=start_v, fail_p=fail_p, right_bias=right_bias, fail_steps=fail_steps, spawn_weight=spawn_weight)
 
+def changed_params(old_list, new_list):
+    """Find the params of each car type that differ between two lists of car types, for the cars that are already
+    on a road (see `Road.set_params`). start_v and spawn_weight only matter for new cars, so they are left out
+
+    Args:
+        old_list, new_list: Lists of car params with the same car types in the same order
+
+    Returns: List with the names of the changed params of each car type
+    """
+
+    if len(old_list) != len(new_list):
+        raise ValueError(f"The road has {len(old_list)} car types, they can't be replaced by {len(new_list)}")
+
+    changed = []
+    for model, (old, new) in enumerate(zip(old_list, new_list)):
+        fields = [field for field in ParamsPool.DIST_FIELDS + ('fail_steps',) if getattr(old, field) != getattr(new, field)]
+        if 'length' in fields:
+            raise ValueError(f"The length of car type {model} can't change, its cars on the road would overlap")
+        changed.append(fields)
+    return changed
+
+class ParamsPool:
+    """Pre-sampled parameters for the cars that are spawned on a road
+
+    Instead of sampling the parameters of every new car one by one with `Params.apply_dist`, a whole block of them
+    is drawn at once for each car type (from the same distributions) and refilled when it runs out. The lane and
+    car type of each new car are drawn in blocks too, with the spawn weights turned into probabilities only once.
+
+    Args:
+        params_list: List of car params defining the different car types
+        lanes: Amount of lanes new cars can be spawned in
+        rngs: Random streams of the road (see `random_streams`), the lanes and car types are drawn from 'spawn' and
+              the params from 'params'
+        batch: Amount of samples drawn at once
+    """
+
+    # Params that can be given as a distribution (see `Params`)
+    DIST_FIELDS = ('v_0', 's_0', 's_1', 'T', 'a', 'b', 'delta', 'length', 'thr', 'pol', 'fail_p', 'right_bias')
+
+    def __init__(self, params_list, lanes, rngs=None, batch=1024):
+        self.params_list = params_list
+        self.lanes = lanes
+        self.rngs = rngs if rngs is not None else random_streams()
+        self.batch = batch
+
+        weights = np.array([m.spawn_weight for m in params_list], dtype=float)
+        self.p = weights / weights.sum() # Probability of each car type
+
+        self.__choices = []                          # Upcoming (lane, car type) pairs
+        self.__samples = [[] for _ in params_list]   # Upcoming fixed params of each car type
+
+    def sample(self, params, count, fields=DIST_FIELDS):
+        """Draw the fixed values of some params for cars of one car type
+
+        Args:
+            params: Params of the car type
+            count: Amount of cars
+            fields: Names of the params to draw (of `DIST_FIELDS`)
+
+        Returns: Dict with a list of count values per param
+        """
+
+        # Make sure we get no negative values and that we cut off at 2 sigma (then the average will be chosen)
+        def positive_normal(avg, dev):
+            a = np.abs(self.rngs['params'].normal(avg, dev, count))
+            return np.where((avg-2*dev <= a) & (a <= avg+2*dev), a, avg)
+
+        columns = {}
+        for field in fields:
+            value = getattr(params, field)
+            columns[field] = positive_normal(value[0], value[1]).tolist() if hasattr(value, '__getitem__') else [value] * count
+        return columns
+
+    def __sample(self, model):
+        """Draw a block of fixed params for one car type
+
+        Returns: List with one dict of fixed values per car (the kwargs of a `Params` object, and the index of the car
+                 type as type)
+        """
+
+        params = self.params_list[model]
+        columns = self.sample(params, self.batch)
+        columns['start_v'] = [params.start_v] * self.batch if params.start_v is not None else columns['v_0']
+        columns['fail_steps'] = [params.fail_steps] * self.batch
+        columns['spawn_weight'] = [params.spawn_weight] * self.batch
+        columns['type'] = [model] * self.batch
+
+        return [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+
+    def redraw(self, cars, changed):
+        """Draw the changed params of cars given as dicts of fixed values again from their new car type (e.g. the
+        cars waiting to enter a road, see `Road.set_params`)
+
+        Args:
+            cars: List of dicts of fixed values (see `draw`), changed in place
+            changed: Names of the changed params of each car type (see `changed_params`)
+        """
+
+        for model, fields in enumerate(changed):
+            of_type = [values for values in cars if values.get('type') == model]
+            if not fields or not of_type: continue
+
+            columns = self.sample(self.params_list[model], len(of_type), [field for field in fields if field != 'fail_steps'])
+            for i, values in enumerate(of_type):
+                values.update({field: column[i] for field, column in columns.items()})
+                if 'fail_steps' in fields: values['fail_steps'] = self.params_list[model].fail_steps
+
+    def draw(self):
+        """Get the lane and the params of the next car to spawn
+
+        Returns: Tuple with the lane number and a dict with the fixed values of the params (kwargs of `Params`) and
+                 the index of the car type as type
+        """
+
+        if not self.__choices:
+            lanes = self.rngs['spawn'].integers(0, self.lanes, self.batch)
+            types = self.rngs['spawn'].choice(len(self.params_list), size=self.batch, p=self.p)
+            self.__choices = list(zip(lanes.tolist(), types.tolist()))
+            self.__choices.reverse()
+
+        lane, model = self.__choices.pop()
+        if not self.__samples[model]:
+            self.__samples[model] = self.__sample(model)
+            self.__samples[model].reverse()
+
+        return lane, self.__samples[model].pop()
+
+class AdaptiveStepping:
+    """Settings of the adaptive (multi-rate) stepping of the cars on a road (see `Car.update_local`)
+
+    The road still advances with the fixed delta_t of the simulation, which is the common clock every car is
+    synchronised to for the output. A car whose acceleration barely changed since its last evaluation keeps it for
+    several steps instead of evaluating the driver model again, only moving along the road. The amount of steps
+    between two evaluations is doubled every time the acceleration is still steady, up to max_substeps. Cars in dense
+    or changing traffic are evaluated every step, and a car is evaluated right away if the car in front of it changes
+    or slows down by more than speed_margin. The lane changes of all the cars are still decided at every step (a car
+    that changes lanes is evaluated), a lane change that comes a few steps late changes the traffic behind it for
+    the rest of the run.
+
+    This saves little where lane changes are on: the lane change stage evaluates the driver model of every car for
+    every possible lane change at every step (MOBIL and the disadvantage of the car behind), which adaptive stepping
+    does not skip. Counting all of them, `benchmarks/adaptive.py` does ~0.9× the evaluations of the fixed step run
+    in ~0.8-0.9× the time (on one core). Nor does it keep the cars where they would be: a lane change that is close
+    to its threshold flips and the traffic behind it takes another course (any other small difference, e.g. of
+    delta_t, does the same), so the same car ends up 15-30 m (up to ~50 m with tolerance=0.05) from where it is in
+    the fixed step run on average, and the average speed differs by up to ~0.2 km/h. Only statistics of the traffic,
+    not single cars, can be compared with the fixed step run. Finer steps than delta_t in dense traffic are not done.
+
+    Args:
+        tolerance: Change of the acceleration (in m/s^2) between two evaluations below which it is considered steady
+        max_substeps: Maximum amount of steps between two evaluations of the driver model of a car
+        speed_margin: Drop of the speed of the car in front (in m/s) that makes a car evaluate its driver model
+    """
+
+    def __init__(self, tolerance=0.001, max_substeps=8, speed_margin=5):
+        self.tolerance = tolerance
+        self.max_substeps = max_substeps
+        self.speed_margin = speed_margin
+
+    def __repr__(self):
+        return f'AdaptiveStepping(tolerance={self.tolerance!r}, max_substeps={self.max_substeps!r}, speed_margin={self.speed_margin!r})'
+
 class Car:
     """Car game object
 
     Args:
-        screen: pygame screen
+        params: Car params with fixed values (see `Params.apply_dist` and `ParamsPool`)
         road: Road object to later get the car in front
         startpos: Starting position in screen coords
     """
 
+    # There can be many cars, so they have no __dict__ (the private names are mangled like the attributes)
+    __slots__ = ('params', 'type', 'pos', 'pos_back', 'pos_front', 'road', 'id', 'entry_time', 'v', 'failing', 'lane_change', 'steady', 'driver',
+                 '__x', '__lane', '__v', '__accel', '__interval', '__skips_left', '__last_accel', '__guard_car', '__guard_v')
+
     def __init__(self, params: Params, road: 'Road', startpos):
-        self.params = params.apply_dist()
+        self.params = params
+        self.type = -1 # Index of the car type in the params_list of the road, -1 if not known (see `Road.set_params`)
 
         self.pos = startpos
         self.pos_back = self.pos[0] - self.params.length / 2
         self.pos_front = self.pos[0] + self.params.length / 2
 
         self.road = road
+        self.id = road.next_id
+        road.next_id += 1
+        self.entry_time = road.time # Time the car was put on the road, for its travel time
         self.v = self.params.start_v
 
-        self.failing = False
-        self.steps_left = self.params.fail_steps
+        self.failing = False # Set by the road when the car fails and recovers (see `Road.update`)
+        self.lane_change = 0 # Set by the road to 1 if the car changes to the right lane in this step, -1 to the left
+        self.steady = False  # True if the car keeps its acceleration in this step (see `start_step`)
 
         # Hidden values to not share state
-        self.__pos = list(startpos)
+        self.__x, self.__lane = startpos
         self.__v = self.params.start_v
         self.__accel = 0.
 
-        self.driver = Driver(params=self.params)
+        # Adaptive stepping (see `AdaptiveStepping`)
+        self.__interval = 1    # Steps between the last two evaluations of the driver model
+        self.__skips_left = 0  # Steps left until the next evaluation
+        self.__last_accel = 0. # Acceleration (in m/s^2) of the last evaluation
+        self.__guard_car = None # Car in front at the last evaluation
+        self.__guard_v = None   # Speed of the car in front below which the car has to be evaluated again
 
-    def __calc_lane_change(self, left, car_front_now, car_front_change, car_back_change):
-        """Calculates if a car should change lanes
+        self.driver = Driver(params=self.params)
 
-        Args:
-            left: True if the lane change is to the left lane
-            car_front_now: Car that is currently in front
-            car_back_change: Car that will be in front after the change
-            car_back_change: Car that will be in the back after the change
+    def get_cars_around(self):
+        """Get other Cars around this Car
 
-        Returns: True if the lane change should happen
+        Returns: Tuple with:
+            current Car in front of this Car
+            front left Car
+            front right Car
+            back left Car
+            back right Car
         """
 
-        s_before = (car_front_now.pos_back - self.pos_front) if car_front_now is not None else 2 * self.road.length # Distance to the car in front
-        other_v_before = car_front_now.v if car_front_now is not None else self.v                                   # Speed of the car in front
+        x, lane = self.pos
+        index = self.road.index
 
-        s_after = (car_front_change.pos_back - self.pos_front) if car_front_change is not None else 2 * self.road.length # Same as above but after the change
-        other_v_after = car_front_change.v if car_front_change is not None else self.v
+        car_front_now = index.front(lane, x)
+        car_front_left = index.front(lane - self.road.lanewidth, x) if lane != self.road.toplane else None
+        car_front_right = index.front(lane + self.road.lanewidth, x) if lane != self.road.bottomlane else None
+        car_back_left = index.back(lane - self.road.lanewidth, x) if lane != self.road.toplane else None
+        car_back_right = index.back(lane + self.road.lanewidth, x) if lane != self.road.bottomlane else None
 
-        if car_back_change is None: # If there is no car in front, set both to 0
-            disadvantage = 0
-            accel_behind_after = 0
-        else:
-            s_behind_before = (car_front_change.pos_back - car_back_change.pos_front) if car_front_change is not None else 2 * self.road.length
-            other_v_behind_before = car_front_change.v if car_front_change is not None else car_back_change.v
+        return car_front_now, car_front_left, car_front_right, car_back_left, car_back_right
 
-            s_behind_after = (self.pos_back - car_back_change.pos_front)
-            other_v_behind_after = self.v
+    def __front_unchanged(self):
+        """Checks if the car in front is the same as in the last evaluation and did not slow down by more than the
+        speed margin (see `AdaptiveStepping`)
+        """
 
-            disadvantage, accel_behind_after = car_back_change.driver.disadvantage_and_safety(car_back_change.v, s_behind_before, other_v_behind_before, s_behind_after, other_v_behind_after)
+        car_front = self.__guard_car
+        return self.road.index.front(self.pos[1], self.pos[0]) is car_front and (car_front is None or car_front.v >= self.__guard_v)
 
-        # Using the MOBIL model
-        change = self.driver.change_lane(left=left, v=self.v, dist_front_before=s_before, vel_front_before=other_v_before, dist_front_after=s_after, vel_front_after=other_v_after, disadvantage_behind_after=disadvantage, accel_behind_after=accel_behind_after)
+    def __plan_substeps(self, accel, car_front_now, changed_lane):
+        """Decide after an evaluation of the driver model for how many steps the car keeps its acceleration
 
-        # These extra conditions just make sure that cars would not collide if a lane change would to happen
-        safeBack = car_back_change.pos_front < self.pos_back if car_back_change is not None else True
-        safeFront = car_front_change.pos_back > self.pos_front if car_front_change is not None else True
+        Args:
+            accel: Acceleration of the car (in m/s^2)
+            car_front_now: Car that is currently in front
+            changed_lane: True if the car is changing lanes in this step
+        """
 
-        return change and safeBack and safeFront
+        stepping = self.road.adaptive
+        change = abs(accel - self.__last_accel)
+        self.__last_accel = accel
 
-    def get_cars_around(self):
-        """Get other Cars around this Car
+        if not self.failing and not changed_lane and change <= stepping.tolerance:
+            self.__interval = min(2 * self.__interval, stepping.max_substeps)
+            self.__skips_left = self.__interval - 1
+            self.__guard_car = car_front_now
+            self.__guard_v = car_front_now.v - stepping.speed_margin if car_front_now is not None else None
+        else:
+            self.__interval = 1
+            self.__skips_left = 0
 
-        Returns: Dict with:
-            frontNow: current Car in front of this Car
-            frontLeft: front left Car
-            frontRight: front right Car
-            backLeft: back left Car
-            backRight: back right Car
+    def start_step(self):
+        """Decide if the car evaluates its driver model in this step or keeps its acceleration (see `AdaptiveStepping`)
+
+        Returns: True if the car is evaluated
         """
 
-        car_front_now = None
-        car_front_left = None
-        car_front_right = None
-        car_back_left = None
-        car_back_right = None
-
-        for car in self.road.carlist:
-            if car.pos[0] > self.pos[0] and car.pos[1] == self.pos[1]:
-                car_front_now = car if (car_front_now is None or car.pos[0] < car_front_now.pos[0]) else car_front_now
-            if (self.pos[1] is not self.road.bottomlane and car.pos[0] > self.pos[0] and car.pos[1] == self.pos[1] + self.road.lanewidth):
-                # Front right
-                car_front_right = car if (car_front_right is None or car.pos[0] < car_front_right.pos[0]) else car_front_right
-                pass
-            if (self.pos[1] is not self.road.bottomlane and car.pos[0] < self.pos[0] and car.pos[1] == self.pos[1] + self.road.lanewidth):
-                # Back right
-                car_back_right = car if (car_back_right is None or car.pos[0] > car_back_right.pos[0]) else car_back_right
-            if (self.pos[1] is not self.road.toplane and car.pos[0] > self.pos[0] and car.pos[1] == self.pos[1] - self.road.lanewidth):
-                # Front left
-                car_front_left = car if (car_front_left is None or car.pos[0] < car_front_left.pos[0]) else car_front_left
-            if (self.pos[1] is not self.road.toplane and car.pos[0] < self.pos[0] and car.pos[1] == self.pos[1] - self.road.lanewidth):
-                # Back left
-                car_back_left = car if (car_back_left is None or car.pos[0] > car_back_left.pos[0]) else car_back_left
-            else: continue
-
-        return {"frontNow": car_front_now, "frontLeft": car_front_left, "frontRight": car_front_right, "backLeft": car_back_left, "backRight": car_back_right}
+        self.steady = self.__skips_left > 0 and not self.failing and self.__front_unchanged()
+        self.lane_change = 0
+        return not self.steady
 
     def update_local(self, delta_t: float):
         """
-        Update local state
+        Update local state (`start_step` and the lane changes of the road come first, see `Road.update`)
         """
 
-        # If a car is currently failing or fails now by chance
-        if self.failing or (np.random.random() < self.params.fail_p):
-
-            self.failing = True
-            if self.steps_left > 0:
-                self.steps_left -= 1
-            else:
-                self.steps_left = self.params.fail_steps
-                self.failing = False
+        # A car with a steady acceleration keeps it and only moves along the road, unless it changes lanes (see
+        # `AdaptiveStepping`)
+        if self.steady and self.lane_change != 0: self.steady = False
+        if self.steady:
+            self.__skips_left -= 1
+            self.__x += (self.v) * delta_t
+            self.__v = max(self.v + self.__accel, 0)
+            return
 
-        # Get cars around this one to perform calculations based on them
-        cars_around = self.get_cars_around()
-        car_front_now = cars_around["frontNow"]
-        car_front_left = cars_around["frontLeft"]
-        car_front_right = cars_around["frontRight"]
-        car_back_left = cars_around["backLeft"]
-        car_back_right = cars_around["backRight"]
+        car_front_now = self.road.index.front(self.pos[1], self.pos[0])
 
         # Before this section of the code is run, the global and local state is the same, so e.g.
         # v and __v can be used interchangeably on the right hand side of the assignment
 
-        # Change lanes
-        change_left = self.__calc_lane_change(left=True, car_front_now=car_front_now, car_front_change=car_front_left, car_back_change=car_back_left)
-        change_right = self.__calc_lane_change(left=False, car_front_now=car_front_now, car_front_change=car_front_right, car_back_change=car_back_right)
-
-
-        # Update local position
-        self.__pos[0] += (self.v) * delta_t
-
-        # Don't jump outside of the road :)
-        if change_right and self.pos[1] != self.road.bottomlane:
-            self.__pos[1] += self.road.lanewidth
-        elif change_left and self.pos[1] != self.road.toplane:
-            self.__pos[1] -= self.road.lanewidth
+        # Update local position and change lanes
+        self.__x += (self.v) * delta_t
+        self.__lane += self.lane_change * self.road.lanewidth
+        changed_lane = self.lane_change != 0
 
         # Update local speed
-        s = (car_front_now.pos_back - self.pos_front) if car_front_now is not None else 2 * self.road.length
+        s = (car_front_now.pos_back - self.pos_front + self.road.seam(self, car_front_now, True)) if car_front_now is not None else 2 * self.road.length
         s = max(0.000000001, s) # s can't be 0 or it will break things so we make s smol
         other_v = car_front_now.v if car_front_now is not None else self.v
         self.__v = self.v
-        self.__accel = self.driver.get_accel(v=self.v, other_v=other_v, s=s) * delta_t if not self.failing else 0
+        accel = self.driver.get_accel(v=self.v, other_v=other_v, s=s) if not self.failing else 0
+        self.__accel = accel * delta_t if not self.failing else 0
         self.__v += self.__accel
         self.__v = max(self.__v, 0) if not self.failing else 0
 
+        if self.road.adaptive is not None: self.__plan_substeps(accel, car_front_now, changed_lane)
+
     def update_global(self):
         """
         Update global state
         """
 
-        self.pos = self.__pos.copy()
-        self.pos_back = self.pos[0] - self.driver.params.length / 2
-        self.pos_front = self.pos[0] + self.driver.params.length / 2
+        # pos is updated in place instead of replaced by a new list, `serialize` hands out copies of it
+        self.pos[0] = self.__x
+        self.pos[1] = self.__lane
+        self.pos_back = self.__x - self.params.length / 2
+        self.pos_front = self.__x + self.params.length / 2
 
         self.v = self.__v
 
+    def wrap_around(self):
+        """Move the car from the end of a ring road back to its start (after `update_global`)
+        """
+
+        self.__x -= self.road.length
+        self.update_global()
+
+    @property
+    def accel(self):
+        """Change of the speed in the last step (the acceleration times delta_t)
+        """
+
+        return self.__accel
+
     def serialize(self):
         """Serialize the car
 
@@ -256,5 +453,6 @@ class Car:
                 v: Speed of the car
                 accel: Acceleration of the car
                 length: Length of the car
+                id: Id of the car
         """
-        return {'pos': self.pos, 'v': self.v, 'accel': self.__accel, 'length': self.params.length}
+        return {'pos': [self.pos[0], self.pos[1]], 'v': self.v, 'accel': self.__accel, 'length': self.params.length, 'id': self.id}
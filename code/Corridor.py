@@ -0,0 +1,288 @@
+import numpy as np
+from VectorRoad import VectorRoad
+from Car import changed_params
+import Kernels
+
+class OnRamp:
+    """On-ramp at the start of a `Segment`
+
+    Cars arrive at the ramp at a fixed rate and wait on it in order until they can merge into the right lane within
+    the merge zone (the first `merge_length` metres of the segment), at most one car per step. A car is put in the
+    middle of the largest gap of the zone where neither the merging car nor the car that ends up behind it has to
+    brake harder than its comfortable deceleration b.
+
+    Args:
+        rate: Amount of cars per second that arrive at the ramp
+        merge_length: Length of the merge zone (in m)
+    """
+
+    def __init__(self, rate, merge_length=200):
+        self.rate = rate
+        self.merge_length = merge_length
+
+    def __repr__(self):
+        return f'OnRamp(rate={self.rate!r}, merge_length={self.merge_length!r})'
+
+class OffRamp:
+    """Off-ramp at the end of a `Segment`
+
+    Args:
+        fraction: Share of the cars in the right lane passing the end of the segment that leave the road
+    """
+
+    def __init__(self, fraction):
+        self.fraction = fraction
+
+    def __repr__(self):
+        return f'OffRamp(fraction={self.fraction!r})'
+
+class Segment:
+    """One segment of a `Corridor`
+
+    Args:
+        length: Length of the segment (in m)
+        speed_limit: Speed limit (in km/h), cars entering the segment drive at most at it, no limit if None
+        on_ramp: Optional `OnRamp` at the start of the segment
+        off_ramp: Optional `OffRamp` at the end of the segment
+    """
+
+    def __init__(self, length, speed_limit=None, on_ramp=None, off_ramp=None):
+        if on_ramp is not None and on_ramp.merge_length > length:
+            raise ValueError("The merge zone of an on-ramp has to fit into its segment")
+
+        self.length = length
+        self.speed_limit = speed_limit
+        self.on_ramp = on_ramp
+        self.off_ramp = off_ramp
+
+    def __repr__(self):
+        return f'Segment(length={self.length!r}, speed_limit={self.speed_limit!r}, on_ramp={self.on_ramp!r}, off_ramp={self.off_ramp!r})'
+
+class Corridor(VectorRoad):
+    """Road made of a chain of segments, with a speed limit per segment and on- and off-ramps between them
+
+    All the cars of the corridor are kept in the arrays of one `VectorRoad` and stepped at once, so a car costs as
+    much as on a single road however many segments there are. The segments only exist as their bounds along the
+    road: the neighbours of a car are found with a binary search among the cars of its lane sorted by position,
+    so they are always in its own segment or the ones next to it. After every step the cars that crossed into
+    another segment adapt to its speed limit (their desired speed `v_desired` is capped at it), and the ones in
+    the right lane that pass an off-ramp may leave.
+
+    New cars are spawned at the start of the corridor like on a `VectorRoad`, so a corridor without ramps and
+    limits gives exactly the same result as a `VectorRoad` of the same length. Like `exits` for the cars that left
+    the road, `merges` has the ids of the cars that merged from an on-ramp in the last step, and `ramp_summary`
+    gives how many cars arrived at each on-ramp, merged and are still waiting.
+
+    Args:
+        params_list: List of car params defining the different car types
+        position: Position of the top most lane
+        lanes: Amount of lanes
+        lanewidth: Width of the lanes
+        segments: List of `Segment`s, in the order along the road
+        car_frequency: Car creation frequency at the start of the corridor
+        rngs: Random streams for spawning, params and failures (see `Car.random_streams`), unseeded if None. The
+              off-ramps draw from the 'spawn' stream
+        inflow: `Inflow` the new cars at the start of the corridor come from instead of car_frequency (see `Road`)
+    """
+
+    def __init__(self, params_list, position, lanes, lanewidth, segments, car_frequency, rngs=None, inflow=None):
+        lengths = [segment.length for segment in segments]
+        super().__init__(params_list, position, lanes, lanewidth, sum(lengths), car_frequency, rngs, inflow=inflow)
+
+        self.segments = segments
+        self.starts = position[0] + np.cumsum([0] + lengths[:-1]) # Start of each segment
+        self.limits = np.array([segment.speed_limit / 3.6 if segment.speed_limit is not None else np.inf for segment in segments])
+        self.off_fractions = np.array([segment.off_ramp.fraction if segment.off_ramp is not None else 0. for segment in segments])
+        self.ramp_t = [0. for _ in segments]        # Time since the last car arrived at the on-ramp of each segment
+        self.ramp_cars = [None for _ in segments]   # Params of the first car waiting on each on-ramp
+        self.ramp_waiting = np.zeros(len(segments), dtype=np.int64) # Cars waiting on each on-ramp
+        self.ramp_arrived = np.zeros(len(segments), dtype=np.int64) # Cars that arrived at each on-ramp so far
+        self.ramp_merged = np.zeros(len(segments), dtype=np.int64)  # Cars of each on-ramp that merged so far
+        self.merges = [] # Ids of the cars that merged from an on-ramp in the last step
+
+    def segment_of(self, x):
+        """Get the index of the segment of every position (positions before the road are in the first one)
+        """
+
+        return np.maximum(np.searchsorted(self.starts, x, side='right') - 1, 0)
+
+    def add_car(self, x, lane, values=None):
+        """Put a car on the road, without checking if there is space for it (see `VectorRoad.add_car`)
+
+        Returns: Id of the new car
+        """
+
+        car_id = super().add_car(x, lane, values)
+        self.__limit(np.array([self.n - 1]))
+        return car_id
+
+    def set_params(self, params_list):
+        """Replace the car types of the road (see `VectorRoad.set_params`), the desired speeds of the cars on the
+        road are capped at the speed limits again and the cars waiting on the on-ramps are drawn again
+        """
+
+        changed = changed_params(self.params_list, params_list)
+        super().set_params(params_list)
+        self.__limit(np.arange(self.n))
+        self.pool.redraw([values for values in self.ramp_cars if values is not None], changed)
+
+    def __limit(self, cars):
+        """Cap the desired speed of some cars at the speed limit of the segment they are in
+        """
+
+        self.v_0[cars] = np.minimum(self.v_desired[cars], self.limits[self.segment_of(self.x[cars])])
+
+    def __exit(self, mask):
+        """Remove the cars where mask is True and record them in `exits`
+        """
+
+        exited = self.take_cars(mask)
+        self.exits += list(zip(exited['id'].tolist(), (self.time - exited['entry_t']).tolist()))
+
+    def __cross(self, cars, left):
+        """Handle the cars that crossed into another segment in this step
+
+        Args:
+            cars: Indices of the cars
+            left: Index of the segment each car left
+        """
+
+        self.__limit(cars)
+
+        # Each car in the right lane takes the off-ramp at the end of the segment it left with its probability
+        fractions = self.off_fractions[left]
+        candidates = (fractions > 0) & (self.y[cars] == self.bottomlane)
+        if candidates.any():
+            exiting = np.zeros(self.n, dtype=bool)
+            exiting[cars[candidates]] = self.rngs['spawn'].random(int(np.count_nonzero(candidates))) < fractions[candidates]
+            if exiting.any(): self.__exit(exiting)
+
+    def ramp_summary(self):
+        """Get the amount of cars that arrived at each on-ramp, merged and are still waiting
+
+        Returns: List with a dict for each segment with an on-ramp (with its index as 'segment')
+        """
+
+        return [{'segment': k, 'arrived': int(self.ramp_arrived[k]), 'merged': int(self.ramp_merged[k]), 'waiting': int(self.ramp_waiting[k])}
+                for k, segment in enumerate(self.segments) if segment.on_ramp is not None]
+
+    def __merge(self, k, ramp, values, right, lane_x):
+        """Let a car from the on-ramp of segment k merge into the right lane if there is a safe gap (see `OnRamp`)
+
+        Args:
+            k: Index of the segment
+            ramp: Its `OnRamp`
+            values: Params of the car
+            right: Indices of the cars in the right lane, sorted by position
+            lane_x: Their positions
+
+        Returns: Position of the car that merged, None if it could not merge
+        """
+
+        start = self.starts[k]
+        end = start + ramp.merge_length
+        half = values['length'] / 2
+
+        # The cars in the zone and the closest ones before and after it
+        window = right[max(np.searchsorted(lane_x, start, side='left') - 1, 0):np.searchsorted(lane_x, end, side='right') + 1]
+        if len(window) == 0:
+            self.add_car((start + end) / 2, self.lanes - 1, values)
+            return (start + end) / 2
+
+        # Every gap between two consecutive cars (or before the first and after the last one), with the car that
+        # would be in front of the merging car and the one behind it (-1 if there is none)
+        fronts, backs = np.append(window, -1), np.insert(window, 0, -1)
+        has_front, has_back = fronts >= 0, backs >= 0
+        gap_start = np.where(has_back, self.x[backs] + self.car_length[backs] / 2, -np.inf)
+        gap_end = np.where(has_front, self.x[fronts] - self.car_length[fronts] / 2, np.inf)
+
+        # The merging car goes to the middle of the part of each gap within the zone
+        x = (np.maximum(gap_start, start + half) + np.minimum(gap_end, end - half)) / 2
+        s_front = np.where(has_front, gap_end - (x + half), np.inf)
+        s_back = np.where(has_back, (x - half) - gap_start, np.inf)
+        possible = (s_front > 0) & (s_back > 0) & (x - half >= start) & (x + half <= end)
+        if not possible.any(): return None
+
+        # Neither the merging car nor the one behind it may have to brake harder than b
+        v = np.where(has_front, np.minimum(values['start_v'], self.v[fronts]), values['start_v'])
+        accel = Kernels.idm_accel(v, np.where(has_front, self.v[fronts], v), np.maximum(s_front, 1e-9),
+                                  *(values[name] for name in ('v_0', 's_0', 's_1', 'T', 'a', 'b', 'delta')))
+        safe = possible & (accel > -values['b'])
+        behind = np.flatnonzero(safe & has_back)
+        back = backs[behind]
+        accel_back = Kernels.idm_accel(self.v[back], v[behind], s_back[behind],
+                                       *(getattr(self, name)[back] for name in ('v_0', 's_0', 's_1', 'T', 'a', 'b', 'delta')))
+        safe[behind] &= accel_back > -self.b[back]
+        if not safe.any(): return None
+
+        best = np.flatnonzero(safe)[np.argmax(np.minimum(s_front, s_back)[safe])]
+        self.add_car(float(x[best]), self.lanes - 1, {**values, 'start_v': float(v[best])})
+        return float(x[best])
+
+    def update(self, delta_t: float):
+        """Create cars and update all the cars on the road
+        Args:
+            delta_t: Time step to simulate
+
+        Returns: True if a car reached the end of the road during this step
+        """
+
+        car_reached_end = False
+
+        # Start and end the failures of this step
+        self.step_count += 1
+        self.time += delta_t
+        self.exits = []
+        self.merges = []
+        redraw = self.start_failures()
+        self.schedule_failures(redraw, self.rngs['failures'].geometric(self.fail_p[redraw]))
+
+        if self.n > 0:
+            before = self.segment_of(self.x)
+            self.step_cars(delta_t)
+
+            after = self.segment_of(self.x)
+            crossed = np.flatnonzero(after != before)
+            if len(crossed) > 0: self.__cross(crossed, before[crossed])
+
+            # If a car is outside the road, then delete it and set the return flag
+            outside = self.x - self.car_length / 2 > self.length
+            if outside.any():
+                self.__exit(outside)
+                car_reached_end = True
+
+        # Cars arrive at the on-ramps, and the first car waiting on each of them merges if there is a gap
+        right = None
+        for k, segment in enumerate(self.segments):
+            if segment.on_ramp is None: continue
+            self.ramp_t[k] += delta_t
+            while self.ramp_t[k] >= 1.0/segment.on_ramp.rate:
+                self.ramp_t[k] -= 1.0/segment.on_ramp.rate
+                self.ramp_waiting[k] += 1
+                self.ramp_arrived[k] += 1
+            if self.ramp_waiting[k] == 0: continue
+
+            # The params of the first waiting car are drawn once and kept until it merged
+            if self.ramp_cars[k] is None: _, self.ramp_cars[k] = self.pool.draw()
+            if right is None:
+                right = np.flatnonzero(self.y == self.bottomlane)
+                right = right[np.argsort(self.x[right], kind='stable')]
+                lane_x = self.x[right]
+            x = self.__merge(k, segment.on_ramp, self.ramp_cars[k], right, lane_x)
+            if x is not None:
+                self.ramp_cars[k] = None
+                self.ramp_waiting[k] -= 1
+                self.ramp_merged[k] += 1
+                self.merges.append(int(self.id[self.n - 1]))
+                # The new car is the last one in the arrays, it is put into the sorted lane for the next ramps
+                i = np.searchsorted(lane_x, x)
+                right, lane_x = np.insert(right, i, self.n - 1), np.insert(lane_x, i, x)
+
+        # Let the waiting cars enter, or try to spawn a car if the time has come
+        self.last_new_car_t += delta_t
+        if self.queues is not None:
+            self.queues.update(self)
+        elif self.last_new_car_t >= 1.0/self.car_frequency and self.spawn_car():
+            self.last_new_car_t = 0
+
+        return car_reached_end
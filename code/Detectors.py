@@ -0,0 +1,244 @@
+import csv
+import numpy as np
+from Recorder import Recorder
+
+class LoopDetector:
+    """Virtual loop detector at a cross-section of the road
+
+    Per interval it counts the cars whose front passed it, with the time mean (arithmetic) and space mean
+    (harmonic) of their speeds, and measures the occupancy: the share of the time a car was over it.
+
+    Args:
+        x: Position along the road (in m)
+        lanes: Numbers of the lanes it covers, all lanes if None
+    """
+
+    def __init__(self, x, lanes=None):
+        self.x = x
+        self.lanes = lanes
+
+    def __repr__(self):
+        return f'LoopDetector(x={self.x!r}, lanes={self.lanes!r})'
+
+class SectionDetector:
+    """Virtual detector of a measurement section of the road (e.g. a camera)
+
+    Per interval it counts the cars entering the section, with the time mean and space mean of their speeds at the
+    entry like a `LoopDetector` at its start. The flow, density and space mean speed over the whole section follow
+    Edie's definitions (from the total distance travelled and time spent by all the cars in it), and the occupancy
+    is the share of the section covered by cars.
+
+    Args:
+        start, end: Positions along the road where the section starts and ends (in m)
+        lanes: Numbers of the lanes it covers, all lanes if None
+    """
+
+    def __init__(self, start, end, lanes=None):
+        if end <= start:
+            raise ValueError("A measurement section has to end after its start")
+        self.start = start
+        self.end = end
+        self.lanes = lanes
+
+    def __repr__(self):
+        return f'SectionDetector(start={self.start!r}, end={self.end!r}, lanes={self.lanes!r})'
+
+class DetectorRecorder(Recorder):
+    """Measure what a set of virtual detectors along the road would, in bins of fixed time intervals
+
+    Only the sums of each detector, lane and interval are kept, so the result grows with detectors × intervals
+    instead of cars × steps like the full data. The cars are matched to the previous step by id to find the ones
+    that passed a detector, the speed of a car that passed it is its average speed over that step. The intervals
+    start at time 0 of the simulation, the first one is the one the first recorded step is in (e.g. when a run is
+    continued from a checkpoint), and the measures of an interval that was only recorded in part are averaged over
+    the recorded part. The positions before the first recorded step are not known, so no car passes a detector in it.
+
+    Args:
+        detectors: List of `LoopDetector`s and `SectionDetector`s
+        interval: Length of the time bins (in s)
+
+    Attributes:
+        counts: Cars that passed each detector in each interval (for a section, the ones that entered it)
+        flow: Cars per hour (all its lanes together)
+        density: Cars per km (all its lanes together), for a loop detector estimated as flow / space mean speed
+        time_mean_speed, space_mean_speed: Speeds (in km/h), nan for an interval without cars
+        occupancy: Share of the time (loop detector) or the length and time (section) covered by cars, averaged
+                   over its lanes
+        All of them are arrays with one row per detector and one column per interval
+        start: Time the first interval starts at (None before the first step)
+    """
+
+    # Sums kept per detector, lane and interval
+    SUMS = ('count', 'speed', 'inverse_speed', 'occupied', 'time_spent', 'distance', 'covered')
+
+    def __init__(self, detectors, interval=60):
+        self.detectors = detectors
+        self.interval = interval
+        self.sections = np.array([isinstance(detector, SectionDetector) for detector in detectors], dtype=bool)
+        self.starts = np.array([detector.start if section else detector.x for detector, section in zip(detectors, self.sections)], dtype=float)
+        self.ends = np.array([detector.end if section else detector.x for detector, section in zip(detectors, self.sections)], dtype=float)
+        self.bins = []      # Dict with an array of shape (detectors, lanes) per sum for every interval so far
+        self.durations = [] # Recorded time of each interval
+        self.start = None
+
+        # The detectors sorted by their (start) position, to find the ones a car passed with a binary search
+        self.__order = np.argsort(self.starts, kind='stable')
+        self.__sorted_starts = self.starts[self.__order]
+        self.__lane_mask = None
+        self.__last_t = None
+        self.__ids = np.zeros(0, dtype=np.int64) # Ids and positions of the cars of the previous step, sorted by id
+        self.__x = np.zeros(0)
+
+    def __repr__(self):
+        return f'DetectorRecorder(detectors={self.detectors!r}, interval={self.interval!r})'
+
+    def __setup(self, road):
+        """Find the lanes of the road each detector covers
+        """
+
+        self.lanes = road.lanes
+        self.__lane_y = np.array([road.position[1] + int(lane * road.lanewidth) for lane in range(road.lanes)])
+        self.__lane_mask = np.zeros((len(self.detectors), road.lanes), dtype=bool)
+        for i, detector in enumerate(self.detectors):
+            self.__lane_mask[i, list(range(road.lanes)) if detector.lanes is None else detector.lanes] = True
+
+    def __bin(self, t, delta_t):
+        """Get the sums of the interval the step ending at t is in
+        """
+
+        k = int((t - delta_t / 2) // self.interval)
+        if self.start is None: self.start = k * self.interval
+        k -= int(round(self.start / self.interval))
+        while len(self.bins) <= k:
+            self.bins.append({name: np.zeros((len(self.detectors), self.lanes)) for name in DetectorRecorder.SUMS})
+            self.durations.append(0.)
+        self.durations[k] += delta_t
+        return self.bins[k]
+
+    def record(self, t, road):
+        if self.__lane_mask is None: self.__setup(road)
+
+        # The length of the first recorded step is the one of every step of the road so far
+        delta_t = t - self.__last_t if self.__last_t is not None else road.time / max(road.step_count, 1)
+        self.__last_t = t
+        sums = self.__bin(t, delta_t)
+
+        columns = road.columns()
+        ids, x, v, length = columns['id'], np.asarray(columns['pos_x'], dtype=float), np.asarray(columns['v'], dtype=float), np.asarray(columns['length'], dtype=float)
+        lane = np.searchsorted(self.__lane_y, columns['lane'])
+
+        # Position of every car in the previous step (a new car starts where it is now, so it passed no detector),
+        # on a ring road a car that passed the end is continued before the start
+        found = np.minimum(np.searchsorted(self.__ids, ids), max(len(self.__ids) - 1, 0))
+        known = (self.__ids[found] == ids) if len(self.__ids) > 0 else np.zeros(len(ids), dtype=bool)
+        x_before = np.where(known, self.__x[found] if len(self.__x) > 0 else x, x)
+        if getattr(road, 'ring', False): x_before = np.where(x_before > x, x_before - road.length, x_before)
+        order = np.argsort(ids, kind='stable')
+        self.__ids, self.__x = ids[order], x[order]
+
+        # The (start) positions each car passed in this step: before < position <= now
+        first = np.searchsorted(self.__sorted_starts, x_before, side='right')
+        passed = np.maximum(np.searchsorted(self.__sorted_starts, x, side='right') - first, 0)
+        cars = np.repeat(np.arange(len(ids)), passed)
+        detector = self.__order[np.repeat(first - np.cumsum(passed) + passed, passed) + np.arange(len(cars))]
+        speed = (x[cars] - x_before[cars]) / delta_t
+        np.add.at(sums['count'], (detector, lane[cars]), 1)
+        np.add.at(sums['speed'], (detector, lane[cars]), speed)
+        np.add.at(sums['inverse_speed'], (detector, lane[cars]), 1 / speed)
+
+        # Loop detectors are occupied while a car is over them (back <= x < front)
+        loops = np.flatnonzero(~self.sections)
+        if len(loops) > 0:
+            points = self.starts[loops]
+            point_order = np.argsort(points, kind='stable')
+            first = np.searchsorted(points[point_order], x - length / 2, side='left')
+            over = np.searchsorted(points[point_order], x + length / 2, side='left') - first
+            cars = np.repeat(np.arange(len(ids)), over)
+            detector = loops[point_order[np.repeat(first - np.cumsum(over) + over, over) + np.arange(len(cars))]]
+            np.add.at(sums['occupied'], (detector, lane[cars]), delta_t)
+
+        # Sections sum up the time spent, the distance travelled and the length covered by the cars whose center is
+        # in them, from the cars of each lane sorted by position
+        sections = np.flatnonzero(self.sections)
+        if len(sections) > 0:
+            by_position = np.lexsort((x, lane))
+            sorted_lane, sorted_x = lane[by_position], x[by_position]
+            distance = np.r_[0, np.cumsum(v[by_position] * delta_t)]
+            covered = np.r_[0, np.cumsum(length[by_position] * delta_t)]
+            for l in range(self.lanes):
+                lane_start, lane_end = np.searchsorted(sorted_lane, (l, l + 1), side='left')
+                lane_x = sorted_x[lane_start:lane_end]
+                start = lane_start + np.searchsorted(lane_x, self.starts[sections], side='left')
+                end = lane_start + np.searchsorted(lane_x, self.ends[sections], side='left')
+                sums['time_spent'][sections, l] += (end - start) * delta_t
+                sums['distance'][sections, l] += distance[end] - distance[start]
+                sums['covered'][sections, l] += covered[end] - covered[start]
+
+    def __total(self, name):
+        """Sum over the lanes of each detector of one of the sums, as an array of shape (detectors, intervals)
+        """
+
+        if not self.bins: return np.zeros((len(self.detectors), 0))
+        return np.stack([np.where(self.__lane_mask, sums[name], 0).sum(axis=1) for sums in self.bins], axis=1)
+
+    @property
+    def __durations(self):
+        return np.array(self.durations)[None, :]
+
+    @property
+    def counts(self):
+        return self.__total('count').astype(np.int64)
+
+    @property
+    def flow(self):
+        lengths = (self.ends - self.starts)[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            section_flow = self.__total('distance') / np.where(self.sections[:, None], lengths, 1) / self.__durations * 3600
+        return np.where(self.sections[:, None], section_flow, self.__total('count') / self.__durations * 3600)
+
+    @property
+    def density(self):
+        lengths = (self.ends - self.starts)[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            section_density = self.__total('time_spent') / np.where(self.sections[:, None], lengths, 1) / self.__durations * 1000
+            loop_density = np.where(self.__total('count') > 0, self.flow / self.__crossing_space_mean_speed(), 0.)
+        return np.where(self.sections[:, None], section_density, loop_density)
+
+    @property
+    def time_mean_speed(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.__total('speed') / self.__total('count') * 3.6
+
+    def __crossing_space_mean_speed(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.__total('count') / self.__total('inverse_speed') * 3.6
+
+    @property
+    def space_mean_speed(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            section_speed = self.__total('distance') / self.__total('time_spent') * 3.6
+        return np.where(self.sections[:, None], section_speed, self.__crossing_space_mean_speed())
+
+    @property
+    def occupancy(self):
+        lanes = self.__lane_mask.sum(axis=1)[:, None] if self.__lane_mask is not None else 1
+        lengths = np.where(self.sections, self.ends - self.starts, 1)[:, None]
+        return np.where(self.sections[:, None], self.__total('covered') / lengths, self.__total('occupied')) / self.__durations / lanes
+
+    def save_csv(self, filename):
+        """Save the measurements as a CSV file with one row per detector and interval (with the time of the interval
+        that was recorded)
+        """
+
+        measures = {'count': self.counts, 'flow': self.flow, 'density': self.density, 'time_mean_speed': self.time_mean_speed,
+                    'space_mean_speed': self.space_mean_speed, 'occupancy': self.occupancy}
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['detector', 'start', 'end', 'recorded'] + list(measures))
+            for i, detector in enumerate(self.detectors):
+                for k in range(len(self.bins)):
+                    start = self.start + k * self.interval
+                    writer.writerow([repr(detector), start, start + self.interval, self.durations[k]] + [measure[i, k].item() for measure in measures.values()])
+
+    def result(self):
+        return self
@@ -9,6 +9,8 @@ class Driver:
         params: Car parameters
     """
 
+    __slots__ = ('params',)
+
     def __init__(self, params):
         self.params = params
 
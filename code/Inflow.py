@@ -0,0 +1,212 @@
+import csv
+import hashlib
+from collections import deque
+import numpy as np
+
+class DemandProfile:
+    """Piecewise-constant demand at the start of the road
+
+    The demand is constant from one time to the next (the last one holds until the end of the run). Arrivals are a
+    Poisson process with this rate, there is no demand before the first time.
+
+    Args:
+        times: Start time (in s) of each interval, in increasing order
+        rates: Demand of each interval in cars per second, either one value per interval (the lane of each car is
+               then drawn like for spawned cars) or one row per interval with one value per lane
+    """
+
+    def __init__(self, times, rates):
+        self.times = np.asarray(times, dtype=float)
+        self.rates = np.asarray(rates, dtype=float)
+        if self.times.ndim != 1 or np.any(np.diff(self.times) <= 0):
+            raise ValueError("The times of a demand profile have to be increasing")
+        if self.rates.ndim not in (1, 2) or len(self.rates) != len(self.times):
+            raise ValueError(f"A demand profile needs one rate (or row of rates per lane) for each of its {len(self.times)} times")
+        if np.any(self.rates < 0):
+            raise ValueError("The rates of a demand profile can't be negative")
+
+    def __repr__(self):
+        return f'DemandProfile(times={self.times.tolist()!r}, rates={self.rates.tolist()!r})'
+
+    def arrivals(self, start, end, rng):
+        """Draw the arrivals between two times
+
+        Args:
+            start, end: Time span, arrivals at start are included and the ones at end are not
+            rng: Random generator to draw from
+
+        Returns: Tuple with the arrays of the times and the lanes (-1 for any lane) of the arrivals, sorted by time
+        """
+
+        rates = self.rates.reshape(len(self.times), -1)
+        edges = np.clip(np.r_[self.times, np.inf], start, end)
+        durations = np.diff(edges)
+
+        # The amount of arrivals of every interval and lane, then their times spread uniformly in the interval
+        counts = rng.poisson(rates * durations[:, None]).ravel()
+        interval = np.repeat(np.repeat(np.arange(len(durations)), rates.shape[1]), counts)
+        lanes = np.repeat(np.tile(np.arange(rates.shape[1]), len(durations)), counts)
+        times = edges[interval] + rng.random(len(interval)) * durations[interval]
+        if self.rates.ndim == 1: lanes[:] = -1
+
+        order = np.argsort(times, kind='stable')
+        return times[order], lanes[order]
+
+class ArrivalTrace:
+    """Recorded arrivals at the start of the road (e.g. from a detector), replayed as they are
+
+    Args:
+        times: Time (in s) of each arrival
+        lanes: Lane of each arrival (-1 to draw it like for spawned cars), any lane if None
+    """
+
+    def __init__(self, times, lanes=None):
+        times = np.asarray(times, dtype=float)
+        lanes = np.full(len(times), -1, dtype=np.int64) if lanes is None else np.asarray(lanes, dtype=np.int64)
+        if len(lanes) != len(times):
+            raise ValueError(f"An arrival trace needs a lane for each of its {len(times)} times")
+        if np.any(lanes < -1):
+            raise ValueError("The lanes of an arrival trace can't be negative (except -1 for any lane)")
+
+        order = np.argsort(times, kind='stable')
+        self.times, self.lanes = times[order], lanes[order]
+
+    def __repr__(self):
+        # The arrivals themselves would be far too long, they are summarized by a digest (e.g. for the key of a `Cache`)
+        digest = hashlib.sha256(self.times.tobytes() + self.lanes.tobytes()).hexdigest()[:16]
+        return f'ArrivalTrace(arrivals={len(self.times)}, digest={digest!r})'
+
+    @staticmethod
+    def read_csv(filename, time_column='time', lane_column='lane'):
+        """Read the arrivals from a CSV file with a header
+
+        Args:
+            filename: CSV file with one arrival per row
+            time_column: Column with the time of the arrival (in s)
+            lane_column: Column with its lane (any lane if the file has no such column or the value is empty)
+
+        Returns: The `ArrivalTrace`
+        """
+
+        times, lanes = [], []
+        with open(filename, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                times.append(float(row[time_column]))
+                lane = row.get(lane_column)
+                lanes.append(int(lane) if lane not in (None, '') else -1)
+        return ArrivalTrace(times, lanes)
+
+    def arrivals(self, start, end, rng):
+        """Get the arrivals between two times (see `DemandProfile.arrivals`)
+        """
+
+        first, last = np.searchsorted(self.times, (start, end), side='left')
+        return self.times[first:last], self.lanes[first:last]
+
+class Inflow:
+    """Settings of the cars that enter the road at its start, instead of one car every 1/car_frequency seconds
+
+    Every arriving car joins the queue of its lane at the start of the road and enters as soon as there is enough
+    space in front of it (the same check as for spawned cars), at most one car per lane and step. So a demand that
+    is higher than what the road can take builds up queues instead of being lost. A car that arrives at a queue
+    that already has max_queue cars is rejected and counted (see `EntryQueues`).
+
+    Args:
+        demand: `DemandProfile` or `ArrivalTrace`
+        max_queue: Amount of cars that can wait in the queue of each lane, unlimited if None
+        horizon: The arrivals are drawn ahead in batches of this much simulated time (in s)
+    """
+
+    def __init__(self, demand, max_queue=None, horizon=60):
+        self.demand = demand
+        self.max_queue = max_queue
+        self.horizon = horizon
+
+    def __repr__(self):
+        return f'Inflow(demand={self.demand!r}, max_queue={self.max_queue!r}, horizon={self.horizon!r})'
+
+class EntryQueues:
+    """Queues of the cars waiting to enter a road, fed by an `Inflow`
+
+    Args:
+        inflow: The `Inflow`
+        lanes: Amount of lanes of the road
+
+    Attributes:
+        arrived, entered, rejected: Arrays with the amount of cars that arrived, entered the road and were rejected
+                                    in each lane so far
+        delay: Total time (in s) the cars that entered the road waited in the queues
+    """
+
+    def __init__(self, inflow, lanes):
+        rates = getattr(inflow.demand, 'rates', None)
+        if rates is not None and rates.ndim == 2 and rates.shape[1] != lanes:
+            raise ValueError(f"The demand profile has rates for {rates.shape[1]} lanes, but the road has {lanes}")
+        trace_lanes = getattr(inflow.demand, 'lanes', None)
+        if trace_lanes is not None and np.any(trace_lanes >= lanes):
+            raise ValueError(f"The arrival trace has arrivals in lane {trace_lanes.max()}, but the road has {lanes} lanes")
+
+        self.inflow = inflow
+        self.queues = [deque() for _ in range(lanes)] # (arrival time, params) of the waiting cars of each lane
+        self.arrived = np.zeros(lanes, dtype=np.int64)
+        self.entered = np.zeros(lanes, dtype=np.int64)
+        self.rejected = np.zeros(lanes, dtype=np.int64)
+        self.delay = 0.
+
+        self.__times, self.__lanes = np.zeros(0), np.zeros(0, dtype=np.int64) # Arrivals drawn ahead
+        self.__next = 0     # Index of the next of these arrivals
+        self.__until = 0.   # The arrivals are drawn up to this time
+
+    @property
+    def lengths(self):
+        """Amount of cars waiting in the queue of each lane
+        """
+
+        return np.array([len(queue) for queue in self.queues], dtype=np.int64)
+
+    def update(self, road):
+        """Put the cars that arrived until the current time of the road in the queues, then let the first car of
+        each queue enter the road if there is enough space
+
+        Args:
+            road: The road (`Road`, `VectorRoad`, ...) the queues belong to
+        """
+
+        # Draw the next batch of arrivals once the ones drawn so far are used up
+        while self.__until <= road.time:
+            times, lanes = self.inflow.demand.arrivals(self.__until, self.__until + self.inflow.horizon, road.rngs['spawn'])
+            self.__times = np.r_[self.__times[self.__next:], times]
+            self.__lanes = np.r_[self.__lanes[self.__next:], lanes]
+            self.__next = 0
+            self.__until += self.inflow.horizon
+
+        # The params of every car are taken from the pool of the road when it arrives, like for spawned cars
+        end = self.__next + int(np.searchsorted(self.__times[self.__next:], road.time, side='right'))
+        for t, lane in zip(self.__times[self.__next:end].tolist(), self.__lanes[self.__next:end].tolist()):
+            drawn_lane, values = road.pool.draw()
+            if lane < 0: lane = drawn_lane
+
+            self.arrived[lane] += 1
+            if self.inflow.max_queue is not None and len(self.queues[lane]) >= self.inflow.max_queue:
+                self.rejected[lane] += 1
+            else:
+                self.queues[lane].append((t, values))
+        self.__next = end
+
+        for lane, queue in enumerate(self.queues):
+            if queue and road.can_enter(lane, queue[0][1]):
+                t, values = queue.popleft()
+                road.add_car(road.position[0], lane, values)
+                self.entered[lane] += 1
+                self.delay += road.time - t
+
+    def summary(self):
+        """Get the totals of the queues so far
+
+        Returns: Dict with the amount of cars that arrived, entered, were rejected and are still waiting (queued),
+                 and the mean time the cars that entered waited
+        """
+
+        entered = int(self.entered.sum())
+        return {'arrived': int(self.arrived.sum()), 'entered': entered, 'rejected': int(self.rejected.sum()),
+                'queued': int(self.lengths.sum()), 'mean_delay': self.delay / entered if entered > 0 else 0.}
@@ -0,0 +1,100 @@
+import math
+import numpy as np
+
+# Numba is optional, without it the kernels fall back to NumPy array operations
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKEND = 'numba' if numba is not None else 'numpy'
+
+def _idm_accel_loop(v, other_v, s, v_0, s_0, s_1, T, a, b, delta, out):
+    """Loop version of `idm_accel`, compiled with Numba when it is installed
+    """
+
+    for i in range(len(v)):
+        s_star = (s_0[i]
+                  + s_1[i] * math.sqrt(v[i]/v_0[i])
+                  + T[i] * v[i]
+                  + (v[i] * (v[i] - other_v[i])) / (2 * math.sqrt(a[i] * b[i])))
+        out[i] = a[i] * (1 - (v[i]/v_0[i]) ** delta[i] - (s_star/s[i]) ** 2)
+    return out
+
+def _mobil_loop(left, v, s_before, other_v_before, s_after, other_v_after, disadvantage_behind, accel_behind_after,
+                v_0, s_0, s_1, T, a, b, delta, thr, pol, right_bias, out):
+    """Loop version of `mobil_change`, compiled with Numba when it is installed
+    """
+
+    for i in range(len(v)):
+        root_ab = 2 * math.sqrt(a[i] * b[i])
+        free = 1 - (v[i]/v_0[i]) ** delta[i]
+        s_star_base = s_0[i] + s_1[i] * math.sqrt(v[i]/v_0[i]) + T[i] * v[i]
+
+        s_star = s_star_base + (v[i] * (v[i] - other_v_after[i])) / root_ab
+        accel_after = a[i] * (free - (s_star/s_after[i]) ** 2)
+        s_star = s_star_base + (v[i] * (v[i] - other_v_before[i])) / root_ab
+        accel_before = a[i] * (free - (s_star/s_before[i]) ** 2)
+
+        bias = right_bias[i] if left else -right_bias[i]
+        incentive = accel_after - accel_before > pol[i] * disadvantage_behind[i] + thr[i] + bias
+        out[i] = incentive and accel_behind_after[i] > -b[i]
+    return out
+
+if numba is not None:
+    _idm_accel_loop = numba.njit(cache=True)(_idm_accel_loop)
+    _mobil_loop = numba.njit(cache=True)(_mobil_loop)
+
+def idm_accel(v, other_v, s, v_0, s_0, s_1, T, a, b, delta):
+    """Intelligent Driver Model acceleration for arrays of cars in one call (see `Driver.get_accel`)
+
+    All the arguments can be arrays (one value per car) or scalars, which are used for every car.
+
+    Returns: Array with the acceleration of each car
+    """
+
+    args = np.broadcast_arrays(*(np.asarray(arg, dtype=np.float64) for arg in (v, other_v, s, v_0, s_0, s_1, T, a, b, delta)))
+    if numba is not None:
+        args = [np.ascontiguousarray(arg) for arg in args]
+        return _idm_accel_loop(*args, np.empty(args[0].shape))
+
+    v, other_v, s, v_0, s_0, s_1, T, a, b, delta = args
+    s_star = s_0 + s_1 * np.sqrt(v/v_0) + T * v + (v * (v - other_v)) / (2 * np.sqrt(a * b))
+    return a * (1 - np.power(v/v_0, delta) - np.power(s_star/s, 2))
+
+def disadvantage_and_safety(v, dist_other_before, vel_other_before, dist_other_after, vel_other_after, v_0, s_0, s_1, T, a, b, delta):
+    """Disadvantage and acceleration after the change of the cars that would be behind after a lane change, for
+    arrays of cars (see `Driver.disadvantage_and_safety`)
+
+    Returns: Tuple with the array of disadvantages and the array of accelerations after the change
+    """
+
+    params = (v_0, s_0, s_1, T, a, b, delta)
+    accel_after = idm_accel(v, vel_other_after, dist_other_after, *params)
+    accel_before = idm_accel(v, vel_other_before, dist_other_before, *params)
+    return accel_before - accel_after, accel_after
+
+def mobil_change(left, v, dist_front_before, vel_front_before, dist_front_after, vel_front_after, disadvantage_behind_after,
+                 accel_behind_after, v_0, s_0, s_1, T, a, b, delta, thr, pol, right_bias):
+    """Decide with the MOBIL model if each car of an array should change lanes (see `Driver.change_lane`)
+
+    All the arguments except `left` can be arrays (one value per car) or scalars, which are used for every car.
+
+    Returns: Boolean array, True where the lane change should happen
+    """
+
+    args = np.broadcast_arrays(*(np.asarray(arg, dtype=np.float64) for arg in
+                                 (v, dist_front_before, vel_front_before, dist_front_after, vel_front_after, disadvantage_behind_after,
+                                  accel_behind_after, v_0, s_0, s_1, T, a, b, delta, thr, pol, right_bias)))
+    if numba is not None:
+        args = [np.ascontiguousarray(arg) for arg in args]
+        return _mobil_loop(bool(left), *args, np.empty(args[0].shape, dtype=np.bool_))
+
+    (v, dist_front_before, vel_front_before, dist_front_after, vel_front_after, disadvantage_behind_after,
+     accel_behind_after, v_0, s_0, s_1, T, a, b, delta, thr, pol, right_bias) = args
+    params = (v_0, s_0, s_1, T, a, b, delta)
+    delta_bias = right_bias if left else -right_bias
+    advantage = idm_accel(v, vel_front_after, dist_front_after, *params) - idm_accel(v, vel_front_before, dist_front_before, *params)
+    incentive = advantage > pol * disadvantage_behind_after + thr + delta_bias
+    safe = accel_behind_after > -b
+    return incentive & safe
@@ -1,27 +1,50 @@
 import numpy as np
 from tqdm import tqdm
+from Trajectory import Trajectory
 
 class Metrics:
     """Class with functions to get all the different metrics we need
+
+    The data can either be the list returned by `Simulation.run` or a binary `Trajectory`. Both are processed in
+    chunks of `CHUNK_STEPS` steps, so a trajectory never has to fit into memory.
     """
 
+    CHUNK_STEPS = 200 # Amount of steps that are processed at once
+
     def __roundClosest(a, b):
         """Round a to the closest multiple of b
         """
 
         return b * round(a/b)
 
-    def avg_speed(car_data: list):
+    def __step_labels(offsets):
+        """Get the index of the step each car of a trajectory chunk belongs to
+        """
+
+        return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    def avg_speed(car_data: list, warmup=0):
         """Calculate average speed for each time step
 
         Args:
-            carData: List with cars for each time step (generated by the simulation)
+            carData: List with cars for each time step (generated by the simulation) or a `Trajectory`
+            optional warmup: Amount of steps at the start to leave out, e.g. the transient found by a
+                             `ConvergenceMonitor` (its `warmup_steps`)
 
-        Returns: List with average speed for each time step
+        Returns: List with average speed for each time step after the warm-up
         """
 
         avg_list = []
-        for data_t in car_data:
+        if isinstance(car_data, Trajectory):
+            for indices, offsets, columns in car_data.chunks(Metrics.CHUNK_STEPS):
+                if indices[-1] < warmup: continue
+                speeds = columns['v'].astype(np.float64) * 3.6
+                sums = np.bincount(Metrics.__step_labels(offsets), weights=speeds, minlength=len(indices))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    avg_list.extend((sums / np.diff(offsets))[indices >= warmup].tolist())
+            return avg_list
+
+        for data_t in car_data[warmup:]:
             speed_array = np.array([car['v'] * 3.6 for car in data_t])
             avg_list.append(np.average(speed_array))
         return avg_list
@@ -42,12 +65,108 @@ class Metrics:
         return median_list
 
 
+    def __chunks(car_data, time_div):
+        """Go through the data a chunk of steps at a time
+
+        Args:
+            car_data: List with cars for each time step, or a `Trajectory`
+            time_div: Only use every time_div-th step
+
+        Returns: Generator that yields (rows, offsets, pos_x, lane) for each chunk, where rows are the indices of the
+                 steps of the chunk among the used steps, offsets the start of each step in the other arrays (plus
+                 the end of the last one) and pos_x and lane the positions of the cars of the chunk
+        """
+
+        if isinstance(car_data, Trajectory):
+            for indices, offsets, columns in car_data.chunks(Metrics.CHUNK_STEPS, time_div):
+                yield indices // time_div, offsets, columns['pos_x'].astype(np.float64), columns['lane']
+            return
+
+        steps = car_data[::time_div]
+        for start in range(0, len(steps), Metrics.CHUNK_STEPS):
+            chunk = steps[start:start + Metrics.CHUNK_STEPS]
+            offsets = np.concatenate(([0], np.cumsum([len(data_t) for data_t in chunk])))
+            pos_x = np.array([car['pos'][0] for data_t in chunk for car in data_t], dtype=np.float64)
+            lane = np.array([car['pos'][1] for data_t in chunk for car in data_t], dtype=np.int64)
+            yield np.arange(start, start + len(chunk)), offsets, pos_x, lane
+
+    def __pixel_counts(offsets, pos_x, width, delta_x, channels=None, lanes=1):
+        """Count the cars in each pixel of some rows of a dot plot
+
+        Args:
+            offsets: Start of each row (step) in pos_x, plus the end of the last one
+            pos_x: Positions of the cars
+            width: Width of the plot in pixels
+            delta_x: How much distance a pixel represents
+            channels: Optional index of the count (e.g. the lane) of each car
+            lanes: Amount of different channels
+
+        Returns: Array with shape (rows, width, lanes) with the amount of cars in each pixel (and channel)
+        """
+
+        rows = len(offsets) - 1
+        x = np.floor(pos_x/delta_x).astype(np.int64)
+        row = Metrics.__step_labels(offsets)
+        channels = np.zeros(len(x), dtype=np.int64) if channels is None else channels
+        inside = (x >= 0) & (x < width) & (channels >= 0) & (channels < lanes)
+
+        bins = (row[inside] * width + x[inside]) * lanes + channels[inside]
+        return np.bincount(bins, minlength=rows * width * lanes).reshape(rows, width, lanes)
+
+    def bw_pixels(offsets, pos_x, width, delta_x):
+        """Make the rows of a black and white dot plot (see `make_dots_bw`) for some steps
+
+        Args:
+            offsets: Start of each step in pos_x, plus the end of the last one
+            pos_x: Positions of the cars of all the steps
+            width: Width of the plot in pixels
+            delta_x: How much distance a pixel represents
+
+        Returns: Array with one row of pixels per step
+        """
+
+        # Every car in a pixel takes away half of the brightness, down to black
+        cars = Metrics.__pixel_counts(offsets, pos_x, width, delta_x)[:, :, 0]
+        return np.maximum(255. - cars * (255./2), 0)
+
+    def color_pixels(offsets, pos_x, lane, width, delta_x, colors, lane_width=5):
+        """Make the rows of a colored dot plot (see `make_dots`) for some steps
+
+        Args:
+            offsets: Start of each step in pos_x and lane, plus the end of the last one
+            pos_x: Positions of the cars of all the steps
+            lane: Vertical positions of the lanes of the cars
+            width: Width of the plot in pixels
+            delta_x: How much distance a pixel represents
+            colors: Colors to use for each lane
+            lane_width: Width of the lanes (to get the lane from its position)
+
+        Returns: Array with one row of pixels per step
+        """
+
+        colors = np.asarray(colors, dtype=np.float64)
+        lane_index = (np.asarray(lane) / lane_width).astype(np.int64)
+        cars = Metrics.__pixel_counts(offsets, pos_x, width, delta_x, lane_index, len(colors))
+
+        # Each car multiplies the color of the pixel by the color of its lane and the pixel is scaled back so that its
+        # brightest channel is 255. This is the same as scaling the product of all the colors, which is done in log
+        # space so it can't underflow. A channel that gets multiplied by 0 stays black.
+        with np.errstate(divide='ignore'):
+            log_colors = np.log(np.where(colors > 0, colors, 1))
+        zero = (cars @ (colors <= 0).astype(np.int64)) > 0
+        log_product = np.where(zero, -np.inf, cars @ log_colors)
+        brightest = log_product.max(axis=2, keepdims=True)
+
+        with np.errstate(invalid='ignore'):
+            pixels = np.where(np.isfinite(brightest), 255. * np.exp(log_product - brightest), 0.)
+        return np.where(cars.sum(axis=2, keepdims=True) > 0, pixels, 255.)
+
     def make_dots(car_data: list, road_length: int, time_div: float, delta_x: float, colors: list):
 
         """Make car dot plot
 
         Args:
-            carData: List with cars for each time step (generated by the simulation)
+            carData: List with cars for each time step (generated by the simulation) or a `Trajectory`
             roadLength: Length of the road in the simulation
             time_div: Time resampling factor of the data points (use 1 every i-th datapoint)
             delta_x: Minimum change in distance (how much distance a pixel represents)
@@ -55,13 +174,10 @@ class Metrics:
         """
 
         print("Generating graph...")
-        pixel_plot = np.full((len(car_data[::time_div]), round(road_length/delta_x), 3), (255., 255., 255.))
-        for i, data_t in enumerate(tqdm(car_data[::time_div])):
-            for car in data_t:
-                x = int(np.floor(car['pos'][0]/delta_x))
-                if x >= pixel_plot.shape[1]:  continue
-                pixel_plot[i][x] *= colors[int(car['pos'][1]/5)]
-                pixel_plot[i][x] = pixel_plot[i][x] * (255 / max(0.00001, pixel_plot[i][x].max()))
+        width = round(road_length/delta_x)
+        pixel_plot = np.full((len(range(0, len(car_data), time_div)), width, 3), (255., 255., 255.))
+        for rows, offsets, pos_x, lane in tqdm(Metrics.__chunks(car_data, time_div)):
+            pixel_plot[rows] = Metrics.color_pixels(offsets, pos_x, lane, width, delta_x, colors)
 
         return pixel_plot
 
@@ -70,20 +186,17 @@ class Metrics:
         """Make car dot plot in black and white only
 
         Args:
-            carData: List with cars for each time step (generated by the simulation)
+            carData: List with cars for each time step (generated by the simulation) or a `Trajectory`
             roadLength: Length of the road in the simulation
             time_div: Time resampling factor of the data points (use 1 every i-th datapoint)
             delta_x: Minimum change in distance (how much distance a pixel represents)
         """
 
         print("Generating graph...")
-        pixel_plot = np.full((len(car_data[::time_div]), round(road_length/delta_x)), (255.))
-        for i, data_t in enumerate(tqdm(car_data[::time_div])):
-            for car in data_t:
-                x = int(np.floor(car['pos'][0]/delta_x))
-                if x >= pixel_plot.shape[1]:  continue
-                pixel_plot[i][x] -= 255./2
-                pixel_plot[i][x] = max(pixel_plot[i][x], 0)
+        width = round(road_length/delta_x)
+        pixel_plot = np.full((len(range(0, len(car_data), time_div)), width), (255.))
+        for rows, offsets, pos_x, lane in tqdm(Metrics.__chunks(car_data, time_div)):
+            pixel_plot[rows] = Metrics.bw_pixels(offsets, pos_x, width, delta_x)
 
         return pixel_plot
 
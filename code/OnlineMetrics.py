@@ -0,0 +1,355 @@
+import numpy as np
+from statistics import NormalDist
+from Recorder import Recorder
+from Metrics import Metrics
+
+class QuantileSketch:
+    """Streaming quantile estimate of a stream of non-negative values
+
+    The values are counted in a histogram with fixed bin width, so the memory does not grow with the amount of
+    values and any quantile is accurate to half a bin width.
+
+    Args:
+        bin_width: Width of the histogram bins (resolution of the quantiles)
+    """
+
+    def __init__(self, bin_width=0.1):
+        self.bin_width = bin_width
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.total = 0
+
+    def add(self, values):
+        """Add an array of values to the sketch
+        """
+
+        if len(values) == 0: return
+        bins = np.maximum(np.floor(np.asarray(values) / self.bin_width), 0).astype(np.int64)
+        counts = np.bincount(bins)
+        if len(counts) > len(self.counts):
+            self.counts = np.concatenate((self.counts, np.zeros(len(counts) - len(self.counts), dtype=np.int64)))
+        self.counts[:len(counts)] += counts
+        self.total += len(values)
+
+    def quantile(self, q):
+        """Get the estimate of the q-quantile (e.g. q=0.5 for the median), nan if no values were added
+        """
+
+        if self.total == 0: return np.nan
+        i = np.searchsorted(np.cumsum(self.counts), q * self.total)
+        return (min(i, len(self.counts) - 1) + 0.5) * self.bin_width
+
+class SpeedAggregator(Recorder):
+    """Average and median speed (in km/h, like `Metrics.avg_speed`) computed while the simulation runs
+
+    Attributes:
+        avg: List with the average speed at each step
+        median: List with the median speed at each step
+        mean: Average speed over all the cars of all the steps
+        sketch: `QuantileSketch` of the speeds of all the cars of all the steps (see `overall_median`)
+    """
+
+    def __init__(self, bin_width=0.1):
+        self.avg = []
+        self.median = []
+        self.sketch = QuantileSketch(bin_width)
+        self.__sum = 0.
+
+    def record(self, t, road):
+        speeds = road.columns()['v'] * 3.6
+        self.avg.append(float(np.mean(speeds)) if len(speeds) > 0 else np.nan)
+        self.median.append(float(np.median(speeds)) if len(speeds) > 0 else np.nan)
+        self.sketch.add(speeds)
+        self.__sum += float(speeds.sum())
+
+    @property
+    def mean(self):
+        return self.__sum / self.sketch.total if self.sketch.total > 0 else np.nan
+
+    @property
+    def overall_median(self):
+        return self.sketch.quantile(0.5)
+
+    def result(self):
+        return self
+
+class SegmentAggregator(Recorder):
+    """Density, flow and space mean speed in each segment of the road, averaged over time
+
+    Args:
+        road_length: Length of the road
+        segment_length: Length of each segment (in m)
+
+    Attributes:
+        density: Average amount of cars per km in each segment (all lanes together)
+        flow: Average flow in each segment (cars per hour, all lanes together)
+        speed: Space mean speed in each segment (km/h)
+    """
+
+    def __init__(self, road_length, segment_length=1000):
+        self.segment_length = segment_length
+        self.segments = int(np.ceil(road_length / segment_length))
+        self.steps = 0
+        self.cars = np.zeros(self.segments)   # Sum over all steps of the amount of cars in each segment
+        self.speeds = np.zeros(self.segments) # Sum over all steps of the speeds of the cars in each segment
+
+    def record(self, t, road):
+        columns = road.columns()
+        segment = np.floor(columns['pos_x'] / self.segment_length).astype(np.int64)
+        inside = (segment >= 0) & (segment < self.segments)
+
+        self.cars += np.bincount(segment[inside], minlength=self.segments)
+        self.speeds += np.bincount(segment[inside], weights=columns['v'][inside], minlength=self.segments)
+        self.steps += 1
+
+    @property
+    def density(self):
+        return self.cars / max(self.steps, 1) / (self.segment_length / 1000)
+
+    @property
+    def flow(self):
+        return self.speeds / max(self.steps, 1) / self.segment_length * 3600
+
+    @property
+    def speed(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.speeds / self.cars * 3.6
+
+    def result(self):
+        return self
+
+class TravelTimeAggregator(Recorder):
+    """Travel time of every car that left the road during the simulation (as reported by the road, see `Road.exits`)
+
+    A car is counted from the step it was put on the road until the step it left it.
+
+    Attributes:
+        travel_times: Dict with the travel time (in s) of each car id that left the road
+        exits: List with the amount of cars that left the road in each step
+    """
+
+    def __init__(self):
+        self.travel_times = {}
+        self.exits = []
+
+    def record(self, t, road):
+        self.travel_times.update(road.exits)
+        self.exits.append(len(road.exits))
+
+    @property
+    def mean(self):
+        return float(np.mean(list(self.travel_times.values()))) if len(self.travel_times) > 0 else np.nan
+
+    def result(self):
+        return self
+
+class LaneChangeCounter(Recorder):
+    """Count the lane changes at each step (as counted by the road, see `Road.lane_changes`)
+
+    Attributes:
+        changes: List with the amount of cars that changed lane in each step
+        total: Total amount of lane changes
+    """
+
+    def __init__(self):
+        self.changes = []
+
+    def record(self, t, road):
+        self.changes.append(road.lane_changes)
+
+    @property
+    def total(self):
+        return sum(self.changes)
+
+    def result(self):
+        return self
+
+class QueueRecorder(Recorder):
+    """Queues at the start of a road with an inflow (see `Inflow.EntryQueues`) at each step
+
+    Attributes:
+        lengths: List with the amount of cars waiting in each lane at each step
+        rejected: List with the amount of cars rejected so far (all lanes together) at each step
+        max_length: Longest queue of any lane during the simulation
+    """
+
+    def __init__(self):
+        self.lengths = []
+        self.rejected = []
+
+    def record(self, t, road):
+        if road.queues is None:
+            raise ValueError("The road has no inflow, so there are no queues to record")
+        self.lengths.append(road.queues.lengths.tolist())
+        self.rejected.append(int(road.queues.rejected.sum()))
+
+    @property
+    def max_length(self):
+        return max((max(lengths) for lengths in self.lengths), default=0)
+
+    def result(self):
+        return self
+
+class DotsRecorder(Recorder):
+    """Draw the car dot plot (see `Metrics.make_dots` and `Metrics.make_dots_bw`) while the simulation runs
+
+    Only the image is kept in memory, one row per used step. Wrap it in a `DecimatingRecorder` to only use
+    every time_div-th step.
+
+    Args:
+        road_length: Length of the road in the simulation
+        delta_x: How much distance a pixel represents
+        colors: Colors to use for each lane, black and white if None
+    """
+
+    def __init__(self, road_length, delta_x, colors=None):
+        self.width = round(road_length/delta_x)
+        self.delta_x = delta_x
+        self.colors = colors
+        self.rows = []
+
+    def record(self, t, road):
+        columns = road.columns()
+        offsets = np.array([0, len(columns['pos_x'])])
+        pos_x = np.asarray(columns['pos_x'], dtype=np.float64)
+        if self.colors is None:
+            self.rows.append(Metrics.bw_pixels(offsets, pos_x, self.width, self.delta_x)[0])
+        else:
+            self.rows.append(Metrics.color_pixels(offsets, pos_x, columns['lane'], self.width, self.delta_x, self.colors)[0])
+
+    def result(self):
+        """Returns: The pixel plot, like `Metrics.make_dots` or `Metrics.make_dots_bw`
+        """
+
+        shape = (0, self.width) if self.colors is None else (0, self.width, 3)
+        return np.array(self.rows) if len(self.rows) > 0 else np.zeros(shape)
+
+def mser_cutoff(values):
+    """Find the end of the warm-up of a series with the MSER rule
+
+    The cutoff is the one among the first half of the values that minimizes the squared standard error of the
+    mean of the values after it. Values up to the last nan are always cut off.
+
+    Returns: Amount of values at the start that belong to the warm-up
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    nans = np.flatnonzero(np.isnan(values))
+    start = nans[-1] + 1 if len(nans) > 0 else 0
+    rest = values[start:]
+    if len(rest) == 0: return start
+
+    # Sums of the values and of their squares after each possible cutoff
+    sums = np.cumsum(rest[::-1])[::-1]
+    squares = np.cumsum((rest ** 2)[::-1])[::-1]
+    remaining = np.arange(len(rest), 0, -1)
+    scores = (squares - sums ** 2 / remaining) / remaining ** 2
+    return start + int(np.argmin(scores[:len(rest) // 2 + 1]))
+
+def t_quantile(p, df):
+    """Quantile of Student's t distribution (Cornish-Fisher expansion around the normal quantile, accurate to
+    better than 0.3% from 4 degrees of freedom on)
+    """
+
+    z = NormalDist().inv_cdf(p)
+    return (z + (z**3 + z) / (4 * df) + (5*z**5 + 16*z**3 + 3*z) / (96 * df**2)
+            + (3*z**7 + 19*z**5 + 17*z**3 - 15*z) / (384 * df**3))
+
+class ConvergenceMonitor(Recorder):
+    """Watch statistics of the road while the simulation runs and end it once they reached a steady state
+
+    The steps are grouped into batches of `batch_steps` steps and each statistic is averaged per batch. After every
+    batch, the warm-up at the start of the run is cut off with the MSER rule (see `mser_cutoff`) and a confidence
+    interval of the mean is computed from the means of the remaining batches (batch means). The monitor is done,
+    which ends `Simulation.run`, as soon as the interval of every statistic is narrower than `tolerance` times its
+    mean. Pass `warmup_steps` to `Metrics.avg_speed` to leave the transient out of the recorded data.
+
+    Args:
+        statistics: Names of the statistics to watch: 'speed' (average speed of the cars in km/h, like
+                    `Metrics.avg_speed`), 'flow' (cars per hour, all lanes together) and 'density' (cars per km)
+        tolerance: Half width of the confidence intervals relative to the mean at which a statistic is converged
+        batch_steps: Amount of steps per batch, long enough that the means of consecutive batches are nearly
+                     independent (the run can only stop at the end of a batch)
+        min_batches: Least amount of batches after the warm-up before the run can stop
+        confidence: Confidence level of the intervals
+
+    Attributes:
+        converged: True once all the statistics converged
+        steps: Amount of steps recorded so far
+        warmup_steps: Amount of steps at the start of the run that belong to the warm-up
+        means: Dict with the mean of each statistic after the warm-up
+        half_widths: Dict with the half width of the confidence interval of each mean
+    """
+
+    STATISTICS = ('speed', 'flow', 'density')
+
+    def __init__(self, statistics=('speed', 'flow'), tolerance=0.02, batch_steps=100, min_batches=10, confidence=0.95):
+        unknown = set(statistics) - set(ConvergenceMonitor.STATISTICS)
+        if unknown: raise ValueError(f"Unknown statistics {sorted(unknown)}, expected some of {list(ConvergenceMonitor.STATISTICS)}")
+
+        self.statistics = tuple(statistics)
+        self.tolerance = tolerance
+        self.batch_steps = batch_steps
+        self.min_batches = min_batches
+        self.confidence = confidence
+
+        self.converged = False
+        self.steps = 0
+        self.warmup_steps = 0
+        self.means = {name: np.nan for name in self.statistics}
+        self.half_widths = {name: np.inf for name in self.statistics}
+        self.__batches = {name: [] for name in self.statistics} # Mean of each statistic in each finished batch
+        self.__sums = dict.fromkeys(self.statistics, 0.)         # Sums of the statistics in the current batch
+        self.__speed_steps = 0                                  # Steps of the current batch with cars on the road
+
+    def __repr__(self):
+        return (f'ConvergenceMonitor(statistics={self.statistics!r}, tolerance={self.tolerance!r}, batch_steps={self.batch_steps!r}, '
+                f'min_batches={self.min_batches!r}, confidence={self.confidence!r})')
+
+    def record(self, t, road):
+        v = road.columns()['v']
+        cars = len(v)
+        total = float(np.sum(v))
+
+        if 'speed' in self.__sums and cars > 0:
+            self.__sums['speed'] += total / cars * 3.6
+            self.__speed_steps += 1
+        if 'flow' in self.__sums: self.__sums['flow'] += total / road.length * 3600
+        if 'density' in self.__sums: self.__sums['density'] += cars / road.length * 1000
+        self.steps += 1
+
+        if self.steps % self.batch_steps == 0:
+            for name in self.statistics:
+                steps = self.__speed_steps if name == 'speed' else self.batch_steps
+                self.__batches[name].append(self.__sums[name] / steps if steps > 0 else np.nan)
+                self.__sums[name] = 0.
+            self.__speed_steps = 0
+            self.__check()
+
+    def __check(self):
+        """Update the warm-up cutoff and the confidence intervals with the finished batches
+        """
+
+        cutoff = max(mser_cutoff(batches) for batches in self.__batches.values())
+        count = len(self.__batches[self.statistics[0]]) - cutoff
+        self.warmup_steps = cutoff * self.batch_steps
+        if count < max(self.min_batches, 2): return
+
+        quantile = t_quantile(0.5 + self.confidence / 2, count - 1)
+        for name, batches in self.__batches.items():
+            batches = np.array(batches[cutoff:])
+            self.means[name] = float(np.mean(batches))
+            self.half_widths[name] = float(quantile * np.std(batches, ddof=1) / np.sqrt(count))
+        self.converged = all(self.half_widths[name] <= self.tolerance * abs(self.means[name]) for name in self.statistics)
+
+    def done(self):
+        return self.converged
+
+    def summary(self):
+        """Returns: Dict with the state of the monitor that can be stored as JSON
+        """
+
+        return {'converged': self.converged, 'steps': self.steps, 'warmup_steps': self.warmup_steps,
+                'means': self.means, 'half_widths': self.half_widths, 'monitor': repr(self)}
+
+    def result(self):
+        return self
@@ -0,0 +1,120 @@
+from Trajectory import Trajectory, TrajectoryWriter
+
+class Recorder:
+    """Base class for everything that gets the state of the road after each step of `Simulation.run`
+
+    A recorder gets every step as it is produced and decides what to keep of it, so a run only needs as much
+    memory as its recorders keep. Subclasses implement `record` and `result`, and `close` if they hold files.
+    """
+
+    def record(self, t, road):
+        """Get the state of the road after a step
+
+        Args:
+            t: Simulation time at the end of the step
+            road: The road, use `road.serialize()` or `road.columns()` to get the cars (the arrays returned by
+                  `columns` may change in the next step, so they have to be copied to be kept)
+        """
+
+        raise NotImplementedError
+
+    def done(self):
+        """Checked after every step, the simulation ends early once a recorder is done (e.g. `ConvergenceMonitor`)
+
+        Returns: True if the recorder doesn't need any more steps
+        """
+
+        return False
+
+    def result(self):
+        """Called once the simulation has ended
+
+        Returns: What `Simulation.run` should return for this recorder
+        """
+
+        return None
+
+    def close(self):
+        """Called once the simulation has ended, also if it failed, to release what the recorder holds (e.g. files)
+        """
+
+        pass
+
+class ListRecorder(Recorder):
+    """Keep every step in memory as a list of serialized cars (what `Simulation.run` always did)
+    """
+
+    def __init__(self):
+        self.data = []
+
+    def record(self, t, road):
+        self.data.append(road.serialize())
+
+    def result(self):
+        return self.data
+
+class DecimatingRecorder(Recorder):
+    """Only pass every k-th step on to another recorder
+
+    Args:
+        recorder: Recorder that gets the steps that are kept
+        every: Keep one step out of `every` (the first step is always kept)
+    """
+
+    def __init__(self, recorder, every):
+        self.recorder = recorder
+        self.every = every
+        self.steps = 0
+
+    def record(self, t, road):
+        if self.steps % self.every == 0:
+            self.recorder.record(t, road)
+        self.steps += 1
+
+    def done(self):
+        return self.recorder.done()
+
+    def result(self):
+        return self.recorder.result()
+
+    def close(self):
+        self.recorder.close()
+
+class TrajectoryRecorder(Recorder):
+    """Write every step straight to a binary trajectory on disk (see `Trajectory`)
+
+    Args:
+        filename: Folder of the trajectory
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
+
+    def record(self, t, road):
+        if self.writer is None: self.writer = TrajectoryWriter(self.filename)
+        self.writer.write_columns(**road.columns())
+
+    def result(self):
+        """Returns: The `Trajectory` that was written (opened for reading)
+        """
+
+        if self.writer is None: self.writer = TrajectoryWriter(self.filename)
+        self.writer.close()
+        return Trajectory(self.filename)
+
+    def close(self):
+        if self.writer is not None: self.writer.close()
+
+class CallbackRecorder(Recorder):
+    """Call a function with every step, e.g. to show the simulation while it runs
+
+    Args:
+        callback: Function called as callback(t, road)
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, t, road):
+        self.callback(t, road)
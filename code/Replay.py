@@ -0,0 +1,180 @@
+import os
+import subprocess
+import numpy as np
+from Trajectory import Trajectory
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+class Replay:
+    """Render the steps of a simulation into frames without a display
+
+    Every frame is drawn into a NumPy framebuffer of shape (height, width, 3): all the cars of a step are filled in
+    at once as rectangles of length × car_height pixels centered at their position (the position is in pixels
+    times `scale`, like the screen coordinates of the simulation). Only one step of the data is read at a time,
+    so a `Trajectory` is read lazily from disk and can be much bigger than the memory.
+
+    Args:
+        data: `Trajectory` or list of serialized cars for each step (what `Simulation.run` returns)
+        size: (width, height) of the frames in pixels
+        scale: Pixels per unit of the position along the road (1 draws the first `width` metres of the road)
+        car_height: Height of the cars in pixels
+        background, color: Colors of the background and of the cars
+    """
+
+    def __init__(self, data, size=(1000, 100), scale=1, car_height=2, background=BLACK, color=WHITE):
+        self.data = data
+        self.width, self.height = size
+        self.scale = scale
+        self.car_height = car_height
+        self.background = np.array(background, dtype=np.uint8)
+        self.color = np.array(color, dtype=np.uint8)
+        self.__background_row = np.tile(self.background, self.width) # One row of the frame, to clear it quickly
+
+    def __len__(self):
+        return len(self.data)
+
+    def __columns(self, i):
+        """Get the position and the length of the cars of step i as arrays
+        """
+
+        if isinstance(self.data, Trajectory):
+            step = self.data.step(i)
+            return step['pos_x'], step['lane'], step['length']
+
+        cars = self.data[i]
+        return (np.array([car['pos'][0] for car in cars], dtype=float), np.array([car['pos'][1] for car in cars], dtype=float),
+                np.array([car['length'] for car in cars], dtype=float))
+
+    def frame(self, i, out=None):
+        """Render step i
+
+        Args:
+            i: Index of the step
+            optional out: Framebuffer to draw into (a new one if None)
+
+        Returns: Array of shape (height, width, 3) with the RGB pixels of the frame
+        """
+
+        if out is None: out = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        x, lane, length = self.__columns(i)
+
+        # Horizontal extent of the cars in pixels, centered at their position and cut to the frame
+        width = np.maximum(np.asarray(length, dtype=float) * self.scale, 1).astype(np.int64)
+        left = np.round(np.asarray(x, dtype=float) * self.scale).astype(np.int64) - width // 2
+        right = np.clip(left + width, 0, self.width)
+        left = np.clip(left, 0, self.width)
+        top = np.asarray(lane).astype(np.int64) - self.car_height // 2
+
+        # Every row of a car counts +1 where it starts and -1 where it ends, the running sum along each row is then
+        # positive exactly on the pixels covered by a car
+        row = (top[:, None] + np.arange(self.car_height)).ravel()
+        left, right = np.repeat(left, self.car_height), np.repeat(right, self.car_height)
+        visible = (row >= 0) & (row < self.height) & (left < right)
+        base = row[visible] * (self.width + 1)
+        size = self.height * (self.width + 1)
+        coverage = np.bincount(base + left[visible], minlength=size) - np.bincount(base + right[visible], minlength=size)
+        covered = np.cumsum(coverage.reshape(self.height, self.width + 1)[:, :self.width], axis=1) > 0
+
+        out.reshape(self.height, self.width * 3)[:] = self.__background_row
+        out[covered] = self.color
+        return out
+
+    def frames(self, start=0, stop=None, every=1):
+        """Render the steps one after the other, reusing the same framebuffer
+
+        Args:
+            start, stop: Range of steps to render (until the end if stop is None)
+            every: Only render every n-th step
+
+        Returns: Generator of frames (the same array is overwritten with every frame, copy it to keep it)
+        """
+
+        out = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        for i in range(start, len(self) if stop is None else min(stop, len(self)), every):
+            yield self.frame(i, out)
+
+    def save_frames(self, folder, start=0, stop=None, every=1):
+        """Save every frame as a PNG image named frame_<step>.png
+
+        Returns: Amount of frames that were saved
+        """
+
+        from PIL import Image
+
+        os.makedirs(folder, exist_ok=True)
+        count = 0
+        for count, frame in enumerate(self.frames(start, stop, every), 1):
+            Image.fromarray(frame).save(os.path.join(folder, f'frame_{start + (count - 1) * every:06d}.png'))
+        return count
+
+    def save_gif(self, filename, fps=30, start=0, stop=None, every=1):
+        """Save the frames as an animated GIF (encoded with Pillow, so this needs every frame in memory)
+        """
+
+        from PIL import Image
+
+        images = [Image.fromarray(frame).convert('P', palette=Image.ADAPTIVE)
+                  for frame in self.frames(start, stop, every)]
+        if not images: raise ValueError("There are no frames to save")
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        images[0].save(filename, save_all=True, append_images=images[1:], duration=int(1000 / fps), loop=0)
+
+    def save_mp4(self, filename, fps=30, start=0, stop=None, every=1, ffmpeg='ffmpeg'):
+        """Save the frames as an MP4 video, streamed frame by frame to a local ffmpeg process
+
+        Args:
+            ffmpeg: Path of the ffmpeg executable
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{self.width}x{self.height}',
+                   '-r', str(fps), '-i', '-', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', filename]
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError(f"{ffmpeg} was not found, it is needed to encode MP4 videos (save_gif or save_frames work without it)")
+
+        with process.stdin:
+            for frame in self.frames(start, stop, every):
+                process.stdin.write(frame.tobytes())
+        if process.wait() != 0:
+            raise RuntimeError(f"{ffmpeg} failed with exit code {process.returncode}")
+
+    def show(self, delta_t, speed=5, driver=None):
+        """Play the frames in a pygame window
+
+        The up and down arrow keys change the playback speed. Without a display (e.g. on a server), SDL's dummy
+        video driver is used, so the frames are still rendered but not shown.
+
+        Args:
+            delta_t: Time step of the simulation
+            speed: Playback speed (1 for real time)
+            driver: SDL video driver to use (e.g. 'dummy'), picked by SDL if None
+        """
+
+        if driver is None and os.name == 'posix' and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+            driver = 'dummy'
+        if driver is not None: os.environ['SDL_VIDEODRIVER'] = driver
+
+        import pygame
+
+        pygame.init()
+        screen = pygame.display.set_mode((self.width, self.height))
+        clock = pygame.time.Clock()
+
+        for frame in self.frames():
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    return
+                if event.type == pygame.KEYDOWN:
+                    # These two change the playback speed with the arrow keys
+                    if event.key == pygame.K_UP: speed += 1
+                    if event.key == pygame.K_DOWN: speed = max(1, speed - 1)
+
+            pygame.surfarray.blit_array(screen, frame.swapaxes(0, 1)) # pygame arrays are indexed by (x, y)
+            pygame.display.update()
+            clock.tick(1./delta_t * speed)
+
+        pygame.quit()
@@ -1,13 +1,152 @@
 
 import numpy as np
 
+import math
 import random
+import heapq
+import bisect
 
 import Car
+import Kernels
+from Inflow import EntryQueues
+
+# Params of the driver model in the order `Kernels` takes them
+IDM_PARAMS = ('v_0', 's_0', 's_1', 'T', 'a', 'b', 'delta')
+
+def fill(road, density):
+    """Put cars on an empty road at a given density, e.g. the fixed population of a ring road
+
+    The cars are spread evenly over the lanes, and all the cars of a lane have the same gap between them. Each lane
+    is shifted by a share of that gap, so no two cars of neighbouring lanes are side by side at the same position
+    (a car at exactly the same position is neither in front of nor behind the other one for the lane changes).
+    Their params and starting speed are taken from the pool of the road, like for spawned cars.
+
+    Args:
+        road: `Road` or `VectorRoad`
+        density: Cars per km (all lanes together)
+
+    Returns: Amount of cars that were put on the road
+    """
+
+    count = int(round(density * road.length / 1000))
+    for lane in range(road.lanes):
+        cars = [road.pool.draw()[1] for _ in range(count // road.lanes + (lane < count % road.lanes))]
+        if not cars: continue
+
+        gap = (road.length - sum(values['length'] for values in cars)) / len(cars)
+        if gap <= 0:
+            raise ValueError(f"{len(cars)} cars don't fit in a lane of {road.length} m, the density {density} is too high")
+
+        back = gap * lane / road.lanes # Back of the next car
+        for values in cars:
+            road.add_car(back + values['length'] / 2, lane, values)
+            back += values['length'] + gap
+    return count
+
+class LaneIndex:
+    """Per-lane index of the cars on a road, sorted by their position along the road
+
+    Cars are kept in one list per lane (keyed by the vertical position of the lane) ordered by
+    (position, id), so that the neighbours of a position can be found with a binary search instead
+    of scanning the whole road. The binary search runs on a list with only the positions, so the index
+    doesn't need a new object per car when it is updated.
+
+    Args:
+        ring: True if the lanes are closed into rings, then the search continues across the end of the road (the
+              first car of a lane is in front of the last one)
+    """
+
+    def __init__(self, ring=False):
+        self.ring = ring
+        self.__cars = {}
+        self.__keys = {}
+
+    def add(self, car):
+        """Insert a car into the lane it is currently in
+        """
+
+        keys = self.__keys.setdefault(car.pos[1], [])
+        cars = self.__cars.setdefault(car.pos[1], [])
+        i = bisect.bisect_left(keys, car.pos[0])
+        while i < len(keys) and keys[i] == car.pos[0] and cars[i].id < car.id: i += 1
+        keys.insert(i, car.pos[0])
+        cars.insert(i, car)
+
+    def update(self, removed=()):
+        """Bring the index up to date after the global state of the cars changed
+
+        Cars that changed lanes are moved to their new lane and every lane is sorted again. Since the
+        order of the cars barely changes from one step to the next, the sort is close to linear.
+
+        Args:
+            removed: Cars that left the road and have to be dropped from the index
+        """
+
+        removed_ids = {car.id for car in removed}
+        moved = []
+        for lane, cars in self.__cars.items():
+            kept = []
+            for car in cars:
+                if car.id in removed_ids: continue
+                if car.pos[1] == lane: kept.append(car)
+                else: moved.append(car)
+            self.__cars[lane] = kept
+
+        for car in moved:
+            self.__cars.setdefault(car.pos[1], []).append(car)
+
+        for lane, cars in self.__cars.items():
+            cars.sort(key=LaneIndex.__position)
+            keys = [car.pos[0] for car in cars]
+
+            # Cars at the same position are ordered by id, which the sort by position alone doesn't guarantee
+            if any(x == next_x for x, next_x in zip(keys, keys[1:])):
+                cars.sort(key=lambda car: (car.pos[0], car.id))
+            self.__keys[lane] = keys
+
+    @staticmethod
+    def __position(car):
+        return car.pos[0]
+
+    def front(self, lane, x):
+        """Get the closest car in `lane` with a position strictly greater than `x` (None if there is none)
+        """
+
+        keys = self.__keys.get(lane)
+        if not keys: return None
+
+        i = bisect.bisect_right(keys, x)
+        if i == len(keys) and self.ring: i = 0
+        return self.__cars[lane][i] if i < len(keys) else None
+
+    def back(self, lane, x):
+        """Get the closest car in `lane` with a position strictly smaller than `x` (None if there is none)
+        """
+
+        keys = self.__keys.get(lane)
+        if not keys: return None
+
+        i = bisect.bisect_left(keys, x) - 1
+        if i < 0 and self.ring: i = len(keys) - 1
+        if i < 0: return None
+
+        # If several cars share the closest position, take the oldest one
+        i = bisect.bisect_left(keys, keys[i])
+        return self.__cars[lane][i]
 
 class Road:
     """Road class to keep track of all the cars, create and destroy them when they are outside the simulation bounds
 
+    Car failures are scheduled ahead of time instead of testing fail_p for every car at every step. From the first
+    step a car can fail in, the step it fails in follows a geometric distribution with p = fail_p, so it is drawn
+    once and kept in a queue of events together with the step it recovers in. A failure lasts fail_steps steps
+    (starting with the step it happens in), the car can't fail in the step it recovers in, and a failure with
+    fail_steps = 0 has no effect.
+
+    A ring road is closed at its end: no cars are spawned and none leave, a car that passes the end continues at
+    the start and the cars at the start of a lane see the ones at the end behind them. It is filled with a fixed
+    population with `fill`.
+
     Args:
         params_list: List of car params defining the different car types
         position: Position of the top most lane
@@ -15,12 +154,22 @@ class Road:
         lanewidth: Width of the lanes
         car_frequency: Car creation frequency
         length: Road length
+        rngs: Random streams for spawning, params and failures (see `Car.random_streams`), unseeded if None
+        adaptive: `Car.AdaptiveStepping` settings to let free cars evaluate their driver model less often, every car
+                  is evaluated at every step if None
+        ring: True for a ring road (periodic boundary)
+        inflow: `Inflow` the new cars come from instead of car_frequency, None to spawn them with car_frequency
     """
 
-    def __init__(self, params_list, position, lanes, lanewidth, length, car_frequency):
+    def __init__(self, params_list, position, lanes, lanewidth, length, car_frequency, rngs=None, adaptive=None, ring=False, inflow=None):
         self.params_list = params_list
+        self.adaptive = adaptive
+        self.ring = ring
+        self.rngs = rngs if rngs is not None else Car.random_streams()
+        self.pool = Car.ParamsPool(params_list, lanes, self.rngs) # Sampled params of the cars to spawn
         self.car_frequency = car_frequency
         self.last_new_car_t = 1.0/car_frequency # Time since last car creation
+        self.queues = EntryQueues(inflow, lanes) if inflow is not None else None # Cars waiting to enter the road
 
         self.position = position
         self.length = length
@@ -30,6 +179,55 @@ class Road:
         self.bottomlane = self.toplane + lanewidth * (lanes - 1)
 
         self.carlist: list[Car.Car] = [] # List of cars on the load
+        self.index = LaneIndex(ring) # Cars sorted by position in each lane
+        self.next_id = 0 # Id of the next car that is created (ids are given in order of creation)
+
+        self.step_count = 0 # Amount of steps simulated so far
+        self.time = 0.      # Simulated time so far
+        self.failure_events = [] # Heap with (step, car id) of the next failure or recovery of the cars
+        self.scheduled = {} # Cars on the road that have an event in failure_events, by id
+        self.lane_changes = 0 # Amount of cars that changed lanes in the last step
+        self.exits = [] # (id, travel time) of the cars that left the road in the last step
+        self.__columns = {name: np.empty(64, dtype=dtype) for name, dtype in (('pos_x', float), ('lane', int), ('v', float), ('accel', float), ('length', float), ('id', int))}
+
+    def serialize(self):
+        """Serialize all the cars on the road
+
+        Returns: List with one dict per car (see `Car.serialize`)
+        """
+
+        return [car.serialize() for car in self.carlist]
+
+    def columns(self):
+        """Get the state of all the cars on the road as arrays
+
+        Returns: Dict with the arrays pos_x, lane, v, accel, length and id (see `Trajectory`), which are overwritten
+                 in the next call
+        """
+
+        # The arrays are kept from one step to the next and only grow when there are more cars than ever before
+        cars = self.carlist
+        if len(cars) > len(self.__columns['id']):
+            capacity = max(2 * len(self.__columns['id']), len(cars))
+            self.__columns = {name: np.empty(capacity, dtype=column.dtype) for name, column in self.__columns.items()}
+
+        columns = {name: column[:len(cars)] for name, column in self.__columns.items()}
+        columns['pos_x'][:] = [car.pos[0] for car in cars]
+        columns['lane'][:] = [car.pos[1] for car in cars]
+        columns['v'][:] = [car.v for car in cars]
+        columns['accel'][:] = [car.accel for car in cars]
+        columns['length'][:] = [car.params.length for car in cars]
+        columns['id'][:] = [car.id for car in cars]
+        return columns
+
+    def __len__(self):
+        return len(self.carlist)
+
+    def first_pos(self):
+        """Get the position of the car that is the furthest along the road (None if the road is empty)
+        """
+
+        return max((car.pos[0] for car in self.carlist), default=None)
 
     def spawn_car(self):
         """Create new car with the given frequency only if there is enough distance to the next car
@@ -37,33 +235,250 @@ class Road:
         Returns: True if a car could be spawned, False otherwise
         """
 
-        # Select random lane
-        lane = int(np.random.choice(range(self.lanes)) * self.lanewidth)
+        # Take the lane and the parameters of the new car from the pool
+        lane, values = self.pool.draw()
 
-        # Choose car type randomly based on the weight
-        distribution = np.array([m.spawn_weight for m in self.params_list])
-        models = [m for m in self.params_list]
-        params = np.random.choice(models, p=(distribution/distribution.sum()))
+        # If it is safe to spawn the car, then do so
+        if self.can_enter(lane, values):
+            self.add_car(self.position[0], lane, values)
+            return True
+        else:
+            return False
 
-        # Create new car
-        new_car = Car.Car(params=params.apply_dist(), road=self, startpos=[self.position[0], self.position[1] + lane])
+    def can_enter(self, lane, values):
+        """Check if there is enough distance in front of the start of a lane for a new car
+
+        Args:
+            lane: Number of the lane
+            values: Dict with the fixed params of the new car
+        """
+
+        x, y = self.position[0], self.position[1] + int(lane * self.lanewidth)
+        pos_front = x + values['length'] / 2
 
         # Look for the car that would be in front when this car spawned
-        car_front = new_car.get_cars_around()["frontNow"]
+        car_front = self.index.front(y, x)
 
         if car_front is not None:
-            t = (car_front.pos_back - new_car.pos_front) / new_car.v if new_car.v != 0 else new_car.params.T
-            clipping = (car_front.pos_back - new_car.pos_front) <= 0
+            t = (car_front.pos_back - pos_front) / values['start_v'] if values['start_v'] != 0 else values['T']
+            clipping = (car_front.pos_back - pos_front) <= 0
         else:
-            t = new_car.params.T+2
+            t = values['T']+2
             clipping = False
 
-        # If it is safe to spawn the car, then do so
-        if t >= new_car.params.T +2 and not clipping:
-            self.carlist.append(new_car)
-            return True
-        else:
-            return False
+        return t >= values['T'] +2 and not clipping
+
+    def add_car(self, x, lane, values=None):
+        """Put a car on the road, without checking if there is space for it
+
+        Args:
+            x: Position of the center of the car along the road
+            lane: Number of the lane (0 is the top lane)
+            values: Dict with the fixed params of the car (kwargs of `Params`), taken from the pool if None
+
+        Returns: Id of the new car
+        """
+
+        if values is None: _, values = self.pool.draw()
+        y = self.position[1] + int(lane * self.lanewidth)
+
+        values = dict(values)
+        model = values.pop('type', -1)
+        new_car = Car.Car(params=Car.Params(**values), road=self, startpos=[x, y])
+        new_car.type = model
+        self.carlist.append(new_car)
+        self.index.add(new_car)
+        self.__schedule_failure(new_car, self.step_count + 1)
+        return new_car.id
+
+    def set_params(self, params_list):
+        """Replace the car types of the road, e.g. to branch a warm started run with other params (see
+        `Simulation.restore`)
+
+        The new cars are spawned with the new params. The cars that are already on the road or waiting to enter it
+        take the params that changed for their car type (see `Car.changed_params`), drawn again from the new
+        distribution, and a car that is not failing draws its next failure again if fail_p changed. The length of
+        a car type can't change.
+
+        Args:
+            params_list: List of car params with the same car types in the same order
+        """
+
+        changed = Car.changed_params(self.params_list, params_list)
+        self.params_list = params_list
+        self.pool = Car.ParamsPool(params_list, self.lanes, self.rngs)
+
+        rescheduled = []
+        for model, fields in enumerate(changed):
+            cars = [car for car in self.carlist if car.type == model]
+            if not fields or not cars: continue
+
+            columns = self.pool.sample(params_list[model], len(cars), [field for field in fields if field != 'fail_steps'])
+            for i, car in enumerate(cars):
+                for field, column in columns.items(): setattr(car.params, field, column[i])
+                if 'fail_steps' in fields: car.params.fail_steps = params_list[model].fail_steps
+            if 'fail_p' in fields: rescheduled += [car for car in cars if not car.failing]
+
+        # The old failure events of these cars are dropped before their new failure is drawn
+        if rescheduled:
+            ids = {car.id for car in rescheduled}
+            self.failure_events = [event for event in self.failure_events if event[1] not in ids]
+            heapq.heapify(self.failure_events)
+            for car in rescheduled:
+                self.scheduled.pop(car.id, None)
+                self.__schedule_failure(car, self.step_count + 1)
+
+        if self.queues is not None: self.pool.redraw([values for queue in self.queues.queues for _, values in queue], changed)
+
+    def __schedule_failure(self, car, step):
+        """Draw the step of the next failure of a car
+
+        Args:
+            car: The car
+            step: First step the car can fail in
+        """
+
+        if car.params.fail_p > 0:
+            heapq.heappush(self.failure_events, (step - 1 + int(self.rngs['failures'].geometric(car.params.fail_p)), car.id))
+            self.scheduled[car.id] = car
+
+    def __process_failures(self):
+        """Make the cars that fail in this step fail and the ones that recover in it recover
+        """
+
+        while self.failure_events and self.failure_events[0][0] <= self.step_count:
+            step, car_id = heapq.heappop(self.failure_events)
+            car = self.scheduled.pop(car_id, None)
+            if car is None: continue # The car is not on the road anymore
+
+            if car.failing:
+                car.failing = False
+                self.__schedule_failure(car, step + 1)
+            elif car.params.fail_steps > 0:
+                car.failing = True
+                heapq.heappush(self.failure_events, (step + int(car.params.fail_steps), car.id))
+                self.scheduled[car.id] = car
+            else:
+                self.__schedule_failure(car, step + 1)
+
+    def __change_lanes(self, cars):
+        """Decide which cars change lanes in this step with the MOBIL model and set their `Car.lane_change`
+
+        All the possible lane changes go through cheap checks first: there is no lane beyond the edge lanes, and a
+        change is dropped if the car would overlap with the cars in the other lane. A car can't gain more by changing
+        lanes than what the car in front of it costs it now (the interaction term of its acceleration), so without a
+        car that would be behind it after the change, changes that can't beat thr + right_bias are dropped too (this
+        includes cars with no car ahead within interaction range). Only the rest are evaluated with MOBIL, all at
+        once. A change to the right is preferred over one to the left.
+
+        Args:
+            cars: Cars of the road
+        """
+
+        no_car = 2 * self.length
+
+        # Possible changes in parallel lists (no object per change): row of the car in cars, 1 for right or -1 for
+        # left, car in front and car behind after the change
+        rows, directions, fronts, backs = [], [], [], []
+        front_now = []
+        gap_free = self.__ring_gap_free if self.ring else Road.__gap_free
+        for i, car in enumerate(cars):
+            car.lane_change = 0
+            car_front_now, car_front_left, car_front_right, car_back_left, car_back_right = car.get_cars_around()
+            front_now.append(car_front_now)
+            if car.pos[1] != self.bottomlane and gap_free(car, car_front_right, car_back_right):
+                rows.append(i); directions.append(1); fronts.append(car_front_right); backs.append(car_back_right)
+            if car.pos[1] != self.toplane and gap_free(car, car_front_left, car_back_left):
+                rows.append(i); directions.append(-1); fronts.append(car_front_left); backs.append(car_back_left)
+
+        self.lane_changes = 0
+        if not rows: return
+
+        # Acceleration of every car with the car that is currently in front, and what it would be without it
+        v = np.array([car.v for car in cars])
+        params = [np.array([getattr(car.params, name) for car in cars]) for name in IDM_PARAMS]
+        s_before = np.array([front.pos_back - car.pos_front + seam if front is not None else no_car
+                             for car, front, seam in zip(cars, front_now, self.__seams(cars, front_now, True))])
+        other_v_before = np.array([front.v if front is not None else car.v for car, front in zip(cars, front_now)])
+        accel_before = Kernels.idm_accel(v, other_v_before, s_before, *params)
+        interaction = Kernels.idm_accel(v, v, np.inf, *params) - accel_before
+
+        seam_front = self.__seams([cars[i] for i in rows], fronts, True)
+        seam_back = self.__seams([cars[i] for i in rows], backs, False)
+        rows = np.array(rows)
+        left = np.array(directions) == -1
+        has_back = np.array([back is not None for back in backs])
+        thr = np.array([cars[i].params.thr for i in rows.tolist()])
+        right_bias = np.array([cars[i].params.right_bias for i in rows.tolist()])
+        candidate = has_back | (interaction[rows] + 1e-9 > thr + np.where(left, right_bias, -right_bias)) # Margin for the rounding of the advantage
+
+        # Acceleration before and after the change of the cars that would be behind
+        disadvantage = np.zeros(len(rows))
+        accel_behind_after = np.zeros(len(rows))
+        behind = np.flatnonzero(candidate & has_back).tolist()
+        if behind:
+            disadvantage[behind], accel_behind_after[behind] = Kernels.disadvantage_and_safety(
+                np.array([backs[k].v for k in behind]),
+                np.array([fronts[k].pos_back - backs[k].pos_front + seam_front[k] + seam_back[k] if fronts[k] is not None else no_car for k in behind]),
+                np.array([fronts[k].v if fronts[k] is not None else backs[k].v for k in behind]),
+                np.array([cars[rows[k]].pos_back - backs[k].pos_front + seam_back[k] for k in behind]),
+                v[rows[behind]],
+                *(np.array([getattr(backs[k].params, name) for k in behind]) for name in IDM_PARAMS))
+
+        # Using the MOBIL model, once for each direction
+        change = np.zeros(len(rows), dtype=bool)
+        for is_left in (False, True):
+            selected = np.flatnonzero(candidate & (left == is_left))
+            if len(selected) == 0: continue
+            selected_rows = rows[selected]
+            change[selected] = Kernels.mobil_change(
+                is_left, v[selected_rows], s_before[selected_rows], other_v_before[selected_rows],
+                np.array([fronts[k].pos_back - cars[i].pos_front + seam_front[k] if fronts[k] is not None else no_car for k, i in zip(selected.tolist(), selected_rows.tolist())]),
+                np.array([fronts[k].v if fronts[k] is not None else cars[i].v for k, i in zip(selected.tolist(), selected_rows.tolist())]),
+                disadvantage[selected], accel_behind_after[selected],
+                *(param[selected_rows] for param in params),
+                thr[selected], *(np.array([getattr(cars[i].params, name) for i in selected_rows.tolist()]) for name in ('pol', 'right_bias')))
+
+        # Right is checked first, so a car that can go both ways goes right
+        for i, direction in zip(rows[change].tolist(), np.array(directions)[change].tolist()):
+            if cars[i].lane_change == 0:
+                cars[i].lane_change = direction
+                self.lane_changes += 1
+
+    @staticmethod
+    def __gap_free(car, front_change, back_change, seam_front=0., seam_back=0.):
+        """Checks that a car would not overlap with the cars around it in the other lane if it changed lanes
+        """
+
+        return ((back_change is None or back_change.pos_front - seam_back < car.pos_back)
+                and (front_change is None or front_change.pos_back + seam_front > car.pos_front))
+
+    def __ring_gap_free(self, car, front_change, back_change):
+        return Road.__gap_free(car, front_change, back_change, self.seam(car, front_change, True), self.seam(car, back_change, False))
+
+    def seam(self, car, other, ahead):
+        """Get the distance to add to the position of a car in front of another one (ahead) or to subtract from the
+        position of a car behind it, which is the length of the road if they are only neighbours across the end
+        of a ring road and 0 otherwise
+
+        Args:
+            car: The car
+            other: Car in front of it (ahead) or behind it, or None
+            ahead: True if other is in front of car
+        """
+
+        if not self.ring or other is None: return 0.
+        wrapped = other.pos[0] <= car.pos[0] if ahead else other.pos[0] >= car.pos[0]
+        return self.length if wrapped else 0.
+
+    def __seams(self, cars, others, ahead):
+        """Get `seam` for pairs of cars
+
+        Returns: List with the seam of every car of cars and the car of others at the same index
+        """
+
+        if not self.ring: return [0.] * len(cars)
+        return [self.seam(car, other, ahead) for car, other in zip(cars, others)]
 
     def update(self, delta_t: float):
         """Create cars and update all the cars in the list
@@ -74,23 +489,51 @@ class Road:
         """
 
         car_reached_end = False
+        exited = []
+
+        # Start and end the failures of this step
+        self.step_count += 1
+        self.time += delta_t
+        self.__process_failures()
 
-        # Update the local state of all the cars
+        # Decide the lane changes of all the cars at once (also of the cars that keep their acceleration, see
+        # `Car.AdaptiveStepping`), then update their local state
+        for car in self.carlist:
+            car.start_step()
+        self.__change_lanes(self.carlist)
         for car in self.carlist:
             car.update_local(delta_t)
 
-        # Update the global state of all the cars
-        for car in self.carlist:
-            car.update_global()
+        # Update the global state of all the cars and collect the ones that are outside the road (on a ring road,
+        # the cars that pass the end continue at the start instead)
+        if self.ring:
+            for car in self.carlist:
+                car.update_global()
+                if car.pos[0] >= self.length: car.wrap_around()
+        else:
+            for car in self.carlist:
+                car.update_global()
+                if car.pos_back > self.length: exited.append(car)
+
+        # The cars that left are dropped in one pass over the list, so a step costs the same however many cars leave
+        self.exits = [(car.id, self.time - car.entry_time) for car in exited]
+        if exited:
+            self.carlist = [car for car in self.carlist if car.pos_back <= self.length]
+            for car in exited: self.scheduled.pop(car.id, None)
+            car_reached_end = True
+
+        self.index.update(exited)
 
-            # If a car is outside the road, then delete it from the list and set the return flag
-            if car.pos_back > self.length:
-                self.carlist.remove(car)
-                car_reached_end = True
+        # Drop the events of the cars that left the road once they are the majority of the queue
+        if len(self.failure_events) > 2 * len(self.scheduled) + 64:
+            self.failure_events = [event for event in self.failure_events if event[1] in self.scheduled]
+            heapq.heapify(self.failure_events)
 
-        # Try to spawn a car if the time has come
+        # Let the waiting cars enter, or try to spawn a car if the time has come
         self.last_new_car_t += delta_t
-        if self.last_new_car_t >= 1.0/self.car_frequency and self.spawn_car():
+        if self.queues is not None:
+            self.queues.update(self)
+        elif not self.ring and self.last_new_car_t >= 1.0/self.car_frequency and self.spawn_car():
             self.last_new_car_t = 0
 
         return car_reached_end
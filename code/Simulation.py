@@ -1,8 +1,16 @@
+import os
 import sys
+import gzip
+import pickle
 import numpy as np
 from tqdm import tqdm
-from Road import Road
-from collections import deque
+from Road import Road, fill
+from Car import random_streams, ParamsPool
+from VectorRoad import VectorRoad
+from Corridor import Corridor
+from Recorder import Recorder, ListRecorder
+
+CHECKPOINT_VERSION = 6
 
 class Simulation:
     """Class to manage the simulation
@@ -14,13 +22,56 @@ class Simulation:
         road_lanes: Amount of lanes
         road_lane_width: Width of the car lanes
         delta_t: Time step to use when running the simulation
+        engine: 'objects' to simulate every car as a `Car` object, 'vectorized' to keep all cars in NumPy arrays
+                (`VectorRoad`), which is much faster when there are many cars on the road
+        adaptive: `AdaptiveStepping` settings to evaluate the driver model of cars in free flow less often than
+                  every step (only with the objects engine), None to evaluate every car at every step
+        corridor: List of `Corridor.Segment`s to simulate a corridor made of these segments, with their speed
+                  limits and ramps, instead of one uniform road (only with the vectorized engine, road_length is
+                  then the sum of the segment lengths)
+        inflow: `Inflow` with the demand the cars enter the road from, with queues at the start of the road for
+                the cars that can't enter yet, instead of trying to spawn one car every 1/car_frequency seconds
+        ring_density: Close the road into a ring (see `Road`) and fill it with a fixed population of cars at this
+                      density (cars per km, all lanes together) instead of spawning them. The car count and so
+                      the memory and the time per step stay the same for the whole run
+        seed: Int or `np.random.SeedSequence` all the randomness of the run is derived from, so the same seed always
+              gives the same run (fresh entropy if None, which is stored in `seed` afterwards)
     """
 
-    def __init__(self, params_list: list, road_position=(0, 0), road_length=1000, road_lanes=2, road_lane_width=5, car_frequency=1, delta_t=0.1):
+    ENGINES = {'objects': Road, 'vectorized': VectorRoad}
+
+    def __init__(self, params_list: list, road_position=(0, 0), road_length=1000, road_lanes=2, road_lane_width=5, car_frequency=1, delta_t=0.1, engine='objects', adaptive=None, corridor=None, inflow=None, ring_density=None, seed=None):
+        if engine not in Simulation.ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {list(Simulation.ENGINES)}")
+        if adaptive is not None and engine != 'objects':
+            raise ValueError("Adaptive stepping is only available with the objects engine")
+        if corridor is not None and (engine != 'vectorized' or ring_density is not None):
+            raise ValueError("A corridor is only available with the vectorized engine, without a ring")
+        if ring_density is not None and inflow is not None:
+            raise ValueError("No cars enter a ring road, it can't have an inflow")
+
         self.params_list = params_list
         self.delta_t = delta_t
-        self.road = Road(params_list=params_list, position=road_position, lanewidth=road_lane_width, car_frequency=car_frequency, lanes=road_lanes, length=road_length)
+        self.engine = engine
+
+        # The simulation owns the random state, the road gets independent child streams of it
+        self.seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.seed = self.seed_seq.entropy
+        self.rng = np.random.default_rng(self.seed_seq)
+        road_kwargs = dict(params_list=params_list, position=road_position, lanewidth=road_lane_width, car_frequency=car_frequency, lanes=road_lanes, length=road_length,
+                           rngs=random_streams(self.seed_seq))
+        if ring_density is not None: road_kwargs.update(ring=True)
+        if inflow is not None: road_kwargs.update(inflow=inflow)
+        if corridor is not None:
+            road_kwargs.pop('length')
+            self.road = Corridor(**road_kwargs, segments=corridor)
+        elif adaptive is not None:
+            self.road = Road(**road_kwargs, adaptive=adaptive)
+        else:
+            self.road = Simulation.ENGINES[engine](**road_kwargs)
+        if ring_density is not None: fill(self.road, ring_density)
         self.end = False # Flag to end the simulation
+        self.t = 0.      # Simulated time so far
 
     def step(self):
         """Run just one step of the simulation
@@ -28,34 +79,136 @@ class Simulation:
         Returns: True if a car has reached the end of the simulation
         """
 
-        self.end |= self.road.update(delta_t=self.delta_t)
+        self.__update()
         return self.road.carlist
 
-    def run(self, time=None):
+    def __update(self):
+        """Advance the road by one time step and remember if a car reached the end
+        """
+
+        self.end |= self.road.update(delta_t=self.delta_t)
+        self.t += self.delta_t
+
+    def run(self, time=None, recorder=None, checkpoint=None, checkpoint_every=600):
         """Run the simulation either for `time` seconds or until a car reaches the end of the road
-        
+
+        After every step the road is handed to the recorder, which decides what to keep of it (see `Recorder`).
+        By default every step is kept in memory as a list of serialized cars. The run ends early as soon as a
+        recorder is done, e.g. a `ConvergenceMonitor` once the traffic reached a steady state.
+
         Args:
             optional time: Amount of time (in seconds) to run the simulation
+            optional recorder: Recorder or list of recorders that get every step (defaults to a `ListRecorder`)
+            optional checkpoint: File to save a checkpoint of the simulation to while it runs (see `save_checkpoint`),
+                                 so a long run can be continued from it with `restore` if it is interrupted
+            optional checkpoint_every: Simulated time (in seconds) between two checkpoints
+
+        Returns: The result of the recorder (a list with the serialized cars of every step by default), or a list
+                 with the result of each recorder if a list was given
         """
 
-        data = deque()
-        if time is not None:
-            # This runs the simulation for time seconds
-            for t in tqdm(np.arange(0, time, self.delta_t)):
-                data.append([car.serialize() for car in self.step()])
-        else:
-            # This runs the simulation until a car reaches the end
-            with tqdm(total=self.road.length) as pbar:
-                lastpos = 0
-                while not self.end:
-                    first_car = None
-                    cars_step = []
-                    for car in self.step():
-                        cars_step.append(car.serialize())
-                        first_car = car if first_car is None or car.pos[0] > first_car.pos[0] else first_car
-                    data.append(cars_step)
-                    if first_car is not None:
-                        pbar.set_description("#cars: " + str(len(self.road.carlist)))
-                        pbar.update(max(int(first_car.pos[0]) - lastpos, 0))
-                        lastpos = int(first_car.pos[0])
-        return list(data)
+        if time is None and getattr(self.road, 'ring', False):
+            raise ValueError("No car reaches the end of a ring road, the time to run has to be given")
+
+        recorders = [ListRecorder()] if recorder is None else (recorder if isinstance(recorder, (list, tuple)) else [recorder])
+        last_checkpoint = self.t
+
+        try:
+            if time is not None:
+                # This runs the simulation for time seconds
+                for t in tqdm(np.arange(0, time, self.delta_t)):
+                    self.__update()
+                    for r in recorders: r.record(self.t, self.road)
+                    if checkpoint is not None: last_checkpoint = self.__checkpoint_due(checkpoint, checkpoint_every, last_checkpoint)
+                    if any(r.done() for r in recorders): break
+            else:
+                # This runs the simulation until a car reaches the end
+                with tqdm(total=self.road.length) as pbar:
+                    lastpos = 0
+                    while not self.end:
+                        self.__update()
+                        for r in recorders: r.record(self.t, self.road)
+                        if checkpoint is not None: last_checkpoint = self.__checkpoint_due(checkpoint, checkpoint_every, last_checkpoint)
+                        if any(r.done() for r in recorders): break
+                        first_pos = self.road.first_pos()
+                        if first_pos is not None:
+                            pbar.set_description("#cars: " + str(len(self.road)))
+                            pbar.update(max(int(first_pos) - lastpos, 0))
+                            lastpos = int(first_pos)
+
+            if checkpoint is not None: self.save_checkpoint(checkpoint)
+
+            results = [r.result() for r in recorders]
+        finally:
+            # The recorders are closed also if the run failed, e.g. so a `TrajectoryRecorder` doesn't leak its files
+            for r in recorders: r.close()
+        return results if isinstance(recorder, (list, tuple)) else results[0]
+
+    def __checkpoint_due(self, filename, every, last):
+        """Save a checkpoint if `every` seconds passed since the last one
+
+        Returns: Simulated time of the last checkpoint
+        """
+
+        if self.t - last < every - self.delta_t / 2: return last
+        self.save_checkpoint(filename)
+        return self.t
+
+    def save_checkpoint(self, filename):
+        """Save the full state of the simulation to a file (see `restore`)
+
+        Everything that decides how the run continues is saved: all the cars including their hidden state and
+        failures, the queue of failure events, the time since the last car was spawned, the sampled params of the
+        next cars and the state of all the random streams. A restored simulation continues exactly like this one.
+        The recorders are not part of the checkpoint.
+
+        Args:
+            filename: File to save to (written to a temporary file first, so an interrupted save keeps the old one)
+        """
+
+        folder = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(folder, exist_ok=True)
+        temp = os.path.join(folder, f'.tmp-{os.getpid()}-{os.path.basename(filename)}')
+        with gzip.open(temp, 'wb', compresslevel=1) as f:
+            pickle.dump({'version': CHECKPOINT_VERSION, 'simulation': self}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, filename)
+
+    @staticmethod
+    def restore(filename, params_list=None, seed=None):
+        """Load a simulation from a checkpoint (see `save_checkpoint`), e.g. to continue an interrupted run with
+        `run`, or to branch several runs off one road that was already filled up (warm start)
+
+        Args:
+            filename: Checkpoint file
+            optional params_list: Car types from now on, with the same car types in the same order. The cars that
+                                  are already on the road take the params that changed for their type (see
+                                  `Road.set_params`)
+            optional seed: Seed for all the randomness from now on (see `Simulation`), so branches of the same
+                           checkpoint are independent. The run continues exactly like the saved one if None
+
+        A branch (with params_list or seed) starts a new run: it is not at its end even if the saved run reached it,
+        so `run` without a time runs until a car reaches the end of the road again.
+
+        Returns: The `Simulation`
+        """
+
+        with gzip.open(filename, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {state.get('version')} in {filename}")
+
+        sim = state['simulation']
+        road = sim.road
+        if seed is not None:
+            sim.seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+            sim.seed = sim.seed_seq.entropy
+            sim.rng = np.random.default_rng(sim.seed_seq)
+            road.rngs.update(random_streams(sim.seed_seq))
+        if params_list is not None:
+            sim.params_list = params_list
+            road.set_params(params_list)
+        elif seed is not None:
+            # The cars sampled ahead of time are drawn again with the new random streams
+            road.pool = ParamsPool(road.params_list, road.lanes, road.rngs)
+        if params_list is not None or seed is not None: sim.end = False
+        return sim
@@ -0,0 +1,156 @@
+import os
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Simulation import Simulation
+from Recorder import ListRecorder
+from Car import Params
+
+def grid(**axes):
+    """Make all the combinations of the given parameter values
+
+    Example: grid(limit=[80, 100], fail_p=[0, 1e-6]) gives
+             [{'limit': 80, 'fail_p': 0}, {'limit': 80, 'fail_p': 1e-6}, {'limit': 100, 'fail_p': 0}, ...]
+
+    Returns: List with one dict per point of the grid
+    """
+
+    names = list(axes.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+class Sweep:
+    """Class to run a parameter sweep, with every simulation in its own process
+
+    Args:
+        params_list: List of car params defining the different car types (the base values of the sweep)
+        points: List of dicts, one per simulation to run (see `grid`)
+        overrides: Function that gets a point and returns a list with one dict of `Params` overrides per car type
+        filename: Optional format string for the data file of each run, filled in with the values of the point
+                  (e.g. 'speedlimit_{limit}_fail_{fail_p}.json')
+        load: Function that reads the data from a filename and returns None if there is no data yet. If it finds
+              data, the simulation is not run again
+        save: Function that stores the data of a run to a filename (called as save(data, filename, overwrite=True))
+        recorder: Optional function that gets the filename of a run and returns the `Recorder` for it (e.g.
+                  `TrajectoryRecorder`), so the data is streamed to disk while simulating instead of saved at the end
+        analyse: Optional function that gets the point and the data of a run and returns what should be sent back
+                 instead of the data (e.g. the average speed), so big results don't have to be sent between processes.
+                 With a cache it is called as analyse(point, data, key), so it can cache what it derives from the run
+                 (see `ResultCache.artifact`)
+        cache: Optional `ResultCache` to keep the runs in, it replaces filename, load, save and recorder and only
+               simulates the runs whose params, seed, simulation arguments or code changed
+        seed: Seed from which the seed of each run is derived, so every run is reproducible on its own
+        processes: Amount of worker processes (defaults to the amount of cores)
+        time: Amount of time (in seconds) to run each simulation, until a car reaches the end if None
+        warm_start: Optional checkpoint (see `Simulation.save_checkpoint`), e.g. of a road that is already filled
+                    up, that every run starts from with its own params and seed instead of an empty road. The cars
+                    already on the road take the params of the run (see `Road.set_params`, the length of a car type
+                    can't be swept this way). The road and the simulation arguments are then the ones of the
+                    checkpoint
+        monitor: Optional function without arguments that returns a new `ConvergenceMonitor` for each run (e.g. a
+                 `functools.partial` of it with the settings), which ends the run as soon as its statistics are
+                 steady. analyse then also gets the summary of the monitor as keyword `convergence` (see
+                 `ConvergenceMonitor.summary`, None if the data was loaded from a file)
+        simulation_kwargs: Arguments passed to every `Simulation` (road_length, delta_t, ...)
+    """
+
+    def __init__(self, params_list, points, overrides, filename=None, load=None, save=None, recorder=None, analyse=None,
+                 cache=None, seed=0, processes=None, time=None, warm_start=None, monitor=None, **simulation_kwargs):
+        self.params_list = params_list
+        self.points = points
+        self.overrides = overrides
+        self.filename = filename
+        self.load = load
+        self.save = save
+        self.recorder = recorder
+        self.analyse = analyse
+        self.cache = cache
+        self.seed = seed
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.time = time
+        self.warm_start = warm_start
+        self.monitor = monitor
+        self.simulation_kwargs = simulation_kwargs
+
+    def params_for(self, point):
+        """Get the car params for one point of the sweep
+
+        Returns: List with a copy of the base params of each car type with the overrides of the point applied
+        """
+
+        return [Params(**{**params.as_dict(), **override}) for params, override in zip(self.params_list, self.overrides(point))]
+
+    def tasks(self):
+        """Get everything a worker needs to do each run of the sweep
+
+        Returns: List with one dict per point, in the order of the points
+        """
+
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.points))
+        return [{'point': point,
+                 'params_list': self.params_for(point),
+                 'filename': self.filename.format(**point) if self.filename is not None else None,
+                 'load': self.load, 'save': self.save, 'recorder': self.recorder, 'analyse': self.analyse, 'cache': self.cache,
+                 'seed': int(seed.generate_state(1)[0]),
+                 'time': self.time,
+                 'warm_start': self.warm_start,
+                 'monitor': self.monitor,
+                 'simulation_kwargs': self.simulation_kwargs} for point, seed in zip(self.points, seeds)]
+
+    @staticmethod
+    def run_task(task):
+        """Run a single simulation of the sweep, or read its data if it already exists
+
+        Returns: Tuple with the point and the data of the run (or the result of `analyse` on it)
+        """
+
+        point, filename = task['point'], task['filename']
+        monitor = task['monitor']() if task['monitor'] is not None else None
+        extra = {} # Additional keyword arguments of analyse
+
+        cache = task['cache']
+        if cache is not None:
+            key = cache.key(task['params_list'], task['seed'], task['time'], task['warm_start'], monitor, **task['simulation_kwargs'])
+            if not cache.has_run(key): print(f'Running simulation for {point}')
+            key, data = cache.run(task['params_list'], task['seed'], task['time'], task['warm_start'], monitor, **task['simulation_kwargs'])
+            if monitor is not None: extra['convergence'] = cache.convergence(key)
+            return point, (task['analyse'](point, data, key, **extra) if task['analyse'] is not None else data)
+
+        if monitor is not None: extra['convergence'] = None
+
+        data = task['load'](filename) if task['load'] is not None and filename is not None else None
+        if data is None:
+            print(f'Running simulation for {point}')
+
+            if task['warm_start'] is not None:
+                sim = Simulation.restore(task['warm_start'], params_list=task['params_list'], seed=task['seed'])
+            else:
+                sim = Simulation(task['params_list'], seed=task['seed'], **task['simulation_kwargs'])
+            recorder = task['recorder'](filename) if task['recorder'] is not None and filename is not None else ListRecorder()
+            if monitor is not None:
+                data, _ = sim.run(time=task['time'], recorder=[recorder, monitor])
+                extra['convergence'] = monitor.summary()
+            else:
+                data = sim.run(time=task['time'], recorder=recorder)
+
+            if task['recorder'] is None and task['save'] is not None and filename is not None:
+                task['save'](data, filename, overwrite=True)
+
+        return point, (task['analyse'](point, data, **extra) if task['analyse'] is not None else data)
+
+    def run(self):
+        """Run all the simulations of the sweep in parallel
+
+        Returns: Generator that yields (point, result) as soon as each run is done (not in the order of the points)
+        """
+
+        tasks = self.tasks()
+        if len(tasks) == 0: return
+        if self.processes <= 1:
+            for task in tasks:
+                yield Sweep.run_task(task)
+            return
+
+        with ProcessPoolExecutor(max_workers=min(self.processes, len(tasks))) as executor:
+            futures = [executor.submit(Sweep.run_task, task) for task in tasks]
+            for future in as_completed(futures):
+                yield future.result()
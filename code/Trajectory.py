@@ -0,0 +1,164 @@
+import os
+import json
+import numpy as np
+
+# Columns stored for every car at every step, with the type they are stored with
+COLUMNS = {
+    'pos_x': np.float32,    # Position of the car along the road (pos[0])
+    'lane': np.int32,       # Vertical position of the lane the car is in (pos[1])
+    'v': np.float32,        # Speed of the car
+    'accel': np.float32,    # Acceleration of the car
+    'length': np.float32,   # Length of the car
+    'id': np.int64,         # Id of the car (-1 if it is not known)
+}
+
+FORMAT_VERSION = 1
+
+class TrajectoryWriter:
+    """Write the data of a simulation step by step into a columnar binary trajectory
+
+    A trajectory is a folder with one flat binary file per column (see `COLUMNS`), holding the values of all
+    the cars of all the steps one after the other, plus `offsets.bin` with the index where each step ends.
+    Every step is appended to the files as soon as it is written, so the data never has to be in memory at once.
+
+    Args:
+        filename: Folder to write the trajectory to (it is overwritten if it already exists)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0 # Amount of cars written so far
+
+        os.makedirs(filename, exist_ok=True)
+        with open(os.path.join(filename, 'meta.json'), 'w') as f:
+            json.dump({'version': FORMAT_VERSION, 'columns': {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()}}, f)
+
+        self.__files = {name: open(os.path.join(filename, name + '.bin'), 'wb') for name in COLUMNS}
+        self.__offsets = open(os.path.join(filename, 'offsets.bin'), 'wb')
+
+    def write_columns(self, **columns):
+        """Append one step given as arrays, with one keyword argument per column (missing ids are stored as -1)
+        """
+
+        size = len(columns['pos_x'])
+        for name, dtype in COLUMNS.items():
+            values = columns.get(name)
+            values = np.asarray(values, dtype=dtype) if values is not None else np.full(size, -1, dtype=dtype)
+            self.__files[name].write(values.tobytes())
+
+        # The column files are written before the offset, so a step is only visible once it is complete
+        self.count += size
+        self.__offsets.write(np.int64(self.count).tobytes())
+
+    def write_step(self, cars):
+        """Append one step given as a list of serialized cars (see `Car.serialize`)
+        """
+
+        self.write_columns(pos_x=[car['pos'][0] for car in cars], lane=[car['pos'][1] for car in cars],
+                           v=[car['v'] for car in cars], accel=[car['accel'] for car in cars],
+                           length=[car['length'] for car in cars], id=[car.get('id', -1) for car in cars])
+
+    def close(self):
+        for f in self.__files.values(): f.close()
+        self.__offsets.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Trajectory:
+    """Read a binary trajectory written by `TrajectoryWriter` without loading it into memory
+
+    All the columns are memory mapped, so they can be bigger than the RAM. The trajectory can also be used like
+    the data returned by `Simulation.run` (indexing or iterating gives lists of serialized cars), but working
+    with the columns directly is much faster.
+
+    Args:
+        filename: Folder of the trajectory
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(os.path.join(filename, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported trajectory version {meta['version']} in {filename}")
+
+        ends = Trajectory.__map(os.path.join(filename, 'offsets.bin'), np.int64)
+        self.offsets = np.concatenate(([0], ends)) # Step i holds the cars offsets[i]:offsets[i+1]
+
+        count = int(self.offsets[-1])
+        self.columns = {name: Trajectory.__map(os.path.join(filename, name + '.bin'), np.dtype(dtype), count)
+                        for name, dtype in meta['columns'].items()}
+
+    @staticmethod
+    def __map(filename, dtype, count=None):
+        """Memory map a flat binary file (empty files can't be mapped, so they give an empty array)
+        """
+
+        size = os.path.getsize(filename) // np.dtype(dtype).itemsize
+        count = size if count is None else count
+        if count == 0: return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(count,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def step(self, i):
+        """Get the columns of one step
+
+        Returns: Dict with one array per column
+        """
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {name: column[start:end] for name, column in self.columns.items()}
+
+    def chunks(self, steps, time_div=1):
+        """Iterate over the trajectory a few steps at a time, so only a part of it is in memory
+
+        Args:
+            steps: Amount of steps in each chunk
+            time_div: Only use every time_div-th step
+
+        Returns: Generator that yields (step indices, offsets, columns) for each chunk, where step indices are
+                 the indices of the steps in the chunk, offsets has the start of each of these steps in the chunk
+                 columns (plus the end of the last one) and columns is a dict with one array per column
+        """
+
+        used = np.arange(0, len(self), time_div)
+        for start in range(0, len(used), steps):
+            indices = used[start:start + steps]
+            starts, ends = self.offsets[indices], self.offsets[indices + 1]
+            lengths = ends - starts
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            if time_div == 1:
+                columns = {name: np.asarray(column[starts[0]:ends[-1]]) for name, column in self.columns.items()}
+            else:
+                # Rows of all the used steps, one step after the other
+                rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+                columns = {name: np.asarray(column[rows]) for name, column in self.columns.items()}
+            yield indices, offsets, columns
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        step = self.step(i)
+        return [{'pos': [x, lane], 'v': v, 'accel': accel, 'length': length, 'id': car_id}
+                for x, lane, v, accel, length, car_id in zip(*(step[name].tolist() for name in ('pos_x', 'lane', 'v', 'accel', 'length', 'id')))]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @staticmethod
+    def write(data, filename):
+        """Write the data returned by `Simulation.run` (a list of serialized cars for each step) to a trajectory
+        """
+
+        with TrajectoryWriter(filename) as writer:
+            for cars in data:
+                writer.write_step(cars)
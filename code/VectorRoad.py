@@ -0,0 +1,491 @@
+import numpy as np
+from Car import ParamsPool, random_streams, changed_params
+from Inflow import EntryQueues
+
+class VectorRoad:
+    """Road that keeps the state of all its cars in contiguous NumPy arrays (structure of arrays)
+
+    It follows the same IDM and MOBIL rules as `Road` together with `Car`, but every step computes the
+    accelerations and lane changes of all the cars at once with array operations instead of looping
+    over Python objects. The cars are stored in the order they were spawned, like `Road.carlist`.
+
+    Failures are scheduled ahead of time like in `Road`, every car keeps the step of its next failure or
+    recovery in `next_event`. A ring road works like the one of `Road`.
+
+    Args:
+        params_list: List of car params defining the different car types
+        position: Position of the top most lane
+        lanes: Amount of lanes
+        lanewidth: Width of the lanes
+        car_frequency: Car creation frequency
+        length: Road length
+        rngs: Random streams for spawning, params and failures (see `Car.random_streams`), unseeded if None
+        ring: True for a ring road (periodic boundary, see `Road`)
+        inflow: `Inflow` the new cars come from instead of car_frequency (see `Road`)
+    """
+
+    # Per car state, every field is one array
+    FIELDS = {
+        'id': np.int64, 'x': np.float64, 'y': np.int64, 'v': np.float64, 'accel': np.float64, 'car_length': np.float64,
+        'v_0': np.float64, 's_0': np.float64, 's_1': np.float64, 'T': np.float64, 'a': np.float64, 'b': np.float64,
+        'delta': np.float64, 'thr': np.float64, 'pol': np.float64, 'fail_p': np.float64, 'right_bias': np.float64,
+        'fail_steps': np.int64, 'next_event': np.int64, 'failing': np.bool_, 'entry_t': np.float64,
+        'v_desired': np.float64, 'type': np.int64,
+    }
+
+    NEVER = np.iinfo(np.int64).max # Step of the next event of cars that never fail
+
+    def __init__(self, params_list, position, lanes, lanewidth, length, car_frequency, rngs=None, ring=False, inflow=None):
+        self.params_list = params_list
+        self.ring = ring
+        self.rngs = rngs if rngs is not None else random_streams()
+        self.pool = ParamsPool(params_list, lanes, self.rngs) # Sampled params of the cars to spawn
+        self.car_frequency = car_frequency
+        self.last_new_car_t = 1.0/car_frequency # Time since last car creation
+        self.queues = EntryQueues(inflow, lanes) if inflow is not None else None # Cars waiting to enter the road
+
+        self.position = position
+        self.length = length
+        self.lanes = lanes
+        self.lanewidth = lanewidth
+        self.toplane = self.position[1] # Position of top lane
+        self.bottomlane = self.toplane + lanewidth * (lanes - 1)
+
+        self.n = 0          # Amount of cars on the road
+        self.next_id = 0    # Id of the next car that is created
+        self.step_count = 0 # Amount of steps simulated so far
+        self.time = 0.      # Simulated time so far
+        self.next_event_step = VectorRoad.NEVER # No car has a failure event before this step
+        self.lane_changes = 0 # Amount of cars that changed lanes in the last step
+        self.exits = []       # (id, travel time) of the cars that left the road in the last step
+        self.__arrays = {name: np.zeros(64, dtype=dtype) for name, dtype in VectorRoad.FIELDS.items()}
+
+    def __getattr__(self, name):
+        # Expose the used part of the state arrays as attributes (e.g. road.x, road.v)
+        arrays = self.__dict__.get('_VectorRoad__arrays')
+        if arrays is not None and name in arrays:
+            return arrays[name][:self.n]
+        raise AttributeError(name)
+
+    @property
+    def carlist(self):
+        """Cars on the road as serialized dicts (the vectorized road has no Car objects)
+        """
+
+        return self.serialize()
+
+    def serialize(self):
+        """Serialize all the cars on the road
+
+        Returns: List with one dict per car, in the same format as `Car.serialize`
+        """
+
+        return [{'pos': [x, y], 'v': v, 'accel': accel, 'length': length, 'id': car_id}
+                for x, y, v, accel, length, car_id in zip(self.x.tolist(), self.y.tolist(), self.v.tolist(), self.accel.tolist(),
+                                                          self.car_length.tolist(), self.id.tolist())]
+
+    def columns(self):
+        """Get the state of all the cars on the road as arrays (views of the state, valid until the next step)
+
+        Returns: Dict with the arrays pos_x, lane, v, accel, length and id (see `Trajectory`)
+        """
+
+        return {'pos_x': self.x, 'lane': self.y, 'v': self.v, 'accel': self.accel, 'length': self.car_length, 'id': self.id}
+
+    def __len__(self):
+        return self.n
+
+    def first_pos(self):
+        """Get the position of the car that is the furthest along the road (None if the road is empty)
+        """
+
+        return float(self.x.max()) if self.n > 0 else None
+
+    def __reserve(self, count):
+        """Grow the state arrays if `count` more cars don't fit in them
+        """
+
+        capacity = len(self.__arrays['x'])
+        if self.n + count > capacity:
+            capacity = max(2 * capacity, self.n + count)
+            for name, array in self.__arrays.items():
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[:self.n] = array[:self.n]
+                self.__arrays[name] = grown
+
+    def __append(self, **values):
+        """Append one car to the state arrays, growing them if they are full
+        """
+
+        self.__reserve(1)
+        for name, array in self.__arrays.items():
+            array[self.n] = values.get(name, 0)
+        self.n += 1
+
+    def cars(self, rows):
+        """Get the state of some cars
+
+        Args:
+            rows: Indices or boolean mask of the cars
+
+        Returns: Dict with a copy of the array of every field of `FIELDS` for these cars
+        """
+
+        return {name: array[:self.n][rows] for name, array in self.__arrays.items()}
+
+    def take_cars(self, mask):
+        """Remove the cars where mask is True from the road
+
+        Returns: Dict with the state of the removed cars (see `cars`)
+        """
+
+        taken = self.cars(mask)
+        self.__compact(~mask)
+        return taken
+
+    def __compact(self, keep):
+        """Drop all the cars where `keep` is False, preserving the order of the rest
+        """
+
+        count = int(keep.sum())
+        for array in self.__arrays.values():
+            array[:count] = array[:self.n][keep]
+        self.n = count
+
+    def __neighbours(self):
+        """Find the closest cars around every car (see `Car.get_cars_around`)
+
+        All the cars are sorted by lane and position once, then the neighbours of a whole lane are looked up
+        with one binary search. Ties are resolved towards the oldest car, like `LaneIndex` does.
+
+        Returns: Dict with the same keys as `Car.get_cars_around`, each with an array holding the index of
+                 the neighbour of every car (-1 if there is none)
+        """
+
+        x, y = self.x, self.y
+        order = np.lexsort((self.id, x, y))
+        sorted_y = y[order]
+        bounds = np.flatnonzero(np.diff(sorted_y)) + 1
+        lanes = {int(sorted_y[start]): order[start:end] for start, end in zip(np.r_[0, bounds], np.r_[bounds, self.n])}
+
+        around = {key: np.full(self.n, -1, dtype=np.int64) for key in ('frontNow', 'frontLeft', 'frontRight', 'backLeft', 'backRight')}
+        for lane, cars in lanes.items():
+            lane_x = x[cars]
+
+            # Cars in this lane look for the car in front, cars in the lane below have this lane on their left,
+            # cars in the lane above have it on their right
+            for query_lane, front_key, back_key in ((lane, 'frontNow', None),
+                                                    (lane + self.lanewidth, 'frontLeft', 'backLeft'),
+                                                    (lane - self.lanewidth, 'frontRight', 'backRight')):
+                queries = lanes.get(query_lane)
+                if queries is None: continue
+                query_x = x[queries]
+
+                i = np.searchsorted(lane_x, query_x, side='right')
+                if self.ring: i[i == len(cars)] = 0 # Across the end of the road
+                found = i < len(cars)
+                around[front_key][queries[found]] = cars[i[found]]
+
+                if back_key is None: continue
+                i = np.searchsorted(lane_x, query_x, side='left') - 1
+                if self.ring: i[i < 0] = len(cars) - 1
+                found = i >= 0
+                # If several cars share the closest position, take the oldest one
+                i = np.searchsorted(lane_x, lane_x[i[found]], side='left')
+                around[back_key][queries[found]] = cars[i]
+
+        return around
+
+    def __seam(self, others, ahead):
+        """Get the distance to add to the position of the car in front of every car (ahead) or to subtract from the
+        position of the car behind it, which is the length of the road where they are only neighbours across the
+        end of a ring road (see `Road.seam`)
+
+        Args:
+            others: Index of the car in front of or behind every car (-1 if there is none)
+            ahead: True if others are in front
+
+        Returns: Array with the distance for every car (all 0 on an open road)
+        """
+
+        if not self.ring: return np.zeros(self.n)
+        wrapped = (self.x[others] <= self.x) if ahead else (self.x[others] >= self.x)
+        return np.where((others >= 0) & wrapped, float(self.length), 0.)
+
+    def __lane_change(self, left, idm, accel_before, front_change, back_change, pos_back, pos_front):
+        """Calculate for all the cars if they should change lanes (see `Road.__change_lanes`)
+
+        Args:
+            left: True if the lane change is to the left lane
+            idm: Function giving the IDM acceleration of some cars for a given gap and speed of the car in front
+            accel_before: IDM acceleration of every car with the car that is currently in front
+            front_change: Index of the car that will be in front after the change
+            back_change: Index of the car that will be in the back after the change
+            pos_back, pos_front: Back and front positions of all the cars
+
+        Returns: Boolean array, True where the lane change should happen
+        """
+
+        v = self.v
+        no_car = 2 * self.length
+        has_front, has_back = front_change >= 0, back_change >= 0
+        seam_front, seam_back = self.__seam(front_change, True), self.__seam(back_change, False)
+
+        s_after = np.where(has_front, pos_back[front_change] - pos_front + seam_front, no_car)
+        other_v_after = np.where(has_front, v[front_change], v)
+
+        # Acceleration of the car that would be behind after the change (only where there is one)
+        disadvantage = np.zeros(self.n)
+        accel_behind_after = np.zeros(self.n)
+        if has_back.any():
+            back = back_change[has_back]
+            front_b, has_front_b = front_change[has_back], has_front[has_back]
+
+            s_behind_before = np.where(has_front_b, pos_back[front_b] - pos_front[back] + seam_front[has_back] + seam_back[has_back], no_car)
+            other_v_behind_before = np.where(has_front_b, v[front_b], v[back])
+            s_behind_after = pos_back[has_back] - pos_front[back] + seam_back[has_back]
+
+            after = idm(back, v[has_back], s_behind_after)
+            disadvantage[has_back] = idm(back, other_v_behind_before, s_behind_before) - after
+            accel_behind_after[has_back] = after
+
+        # Using the MOBIL model
+        bias = self.right_bias if left else -self.right_bias
+        advantage = idm(slice(None), other_v_after, s_after) - accel_before
+        incentive = advantage > self.pol * disadvantage + self.thr + bias
+        safe = accel_behind_after > -self.b
+
+        # These extra conditions just make sure that cars would not collide if a lane change would to happen
+        safe_back = np.where(has_back, pos_front[back_change] - seam_back < pos_back, True)
+        safe_front = np.where(has_front, pos_back[front_change] + seam_front > pos_front, True)
+
+        return incentive & safe & safe_back & safe_front
+
+    def spawn_car(self):
+        """Create new car with the given frequency only if there is enough distance to the next car
+
+        Returns: True if a car could be spawned, False otherwise
+        """
+
+        # Take the lane and the parameters of the new car from the pool
+        lane, values = self.pool.draw()
+
+        # If it is safe to spawn the car, then do so
+        if self.can_enter(lane, values):
+            self.add_car(self.position[0], lane, values)
+            return True
+        else:
+            return False
+
+    def can_enter(self, lane, values):
+        """Check if there is enough distance in front of the start of a lane for a new car (see `spawn_allowed`)
+        """
+
+        x, y = self.position[0], self.position[1] + int(lane * self.lanewidth)
+        pos_front = x + values['length'] / 2
+
+        # Look for the car that would be in front when this car spawned
+        in_lane = np.nonzero((self.y == y) & (self.x > x))[0]
+        gap = None
+        if len(in_lane) > 0:
+            car_front = in_lane[np.argmin(self.x[in_lane])]
+            gap = self.x[car_front] - self.car_length[car_front] / 2 - pos_front
+
+        return VectorRoad.spawn_allowed(values, gap)
+
+    @staticmethod
+    def spawn_allowed(values, gap):
+        """Check if there is enough distance in front of a new car to spawn it
+
+        Args:
+            values: Dict with the fixed params of the new car
+            gap: Distance from the front of the new car to the back of the car in front (None if there is none)
+        """
+
+        if gap is None: return True
+        t = gap / values['start_v'] if values['start_v'] != 0 else values['T']
+        return t >= values['T'] + 2 and not gap <= 0
+
+    def add_car(self, x, lane, values=None):
+        """Put a car on the road, without checking if there is space for it
+
+        Args:
+            x: Position of the center of the car along the road
+            lane: Number of the lane (0 is the top lane)
+            values: Dict with the fixed params of the car (kwargs of `Params`), taken from the pool if None
+
+        Returns: Id of the new car
+        """
+
+        if values is None: _, values = self.pool.draw()
+        y = self.position[1] + int(lane * self.lanewidth)
+
+        # Draw the step of the first failure, the car can fail from the next step on
+        next_event = VectorRoad.NEVER
+        if values['fail_p'] > 0:
+            next_event = self.step_count + int(self.rngs['failures'].geometric(values['fail_p']))
+        self.next_event_step = min(self.next_event_step, next_event)
+
+        # The params that are not per car state are ignored
+        car_id = self.next_id
+        self.__append(**{'type': -1, **values}, id=car_id, x=x, y=y, v=values['start_v'], car_length=values['length'], next_event=next_event,
+                      entry_t=self.time, v_desired=values['v_0'])
+        self.next_id += 1
+        return car_id
+
+    def set_params(self, params_list):
+        """Replace the car types of the road, the cars on it take the params that changed for their car type (see
+        `Road.set_params`)
+
+        Args:
+            params_list: List of car params with the same car types in the same order
+        """
+
+        changed = changed_params(self.params_list, params_list)
+        self.params_list = params_list
+        self.pool = ParamsPool(params_list, self.lanes, self.rngs)
+
+        for model, fields in enumerate(changed):
+            cars = np.flatnonzero(self.type == model)
+            if not fields or len(cars) == 0: continue
+
+            columns = self.pool.sample(params_list[model], len(cars), [field for field in fields if field != 'fail_steps'])
+            for field, column in columns.items():
+                getattr(self, field)[cars] = column
+            if 'v_0' in columns: self.v_desired[cars] = columns['v_0']
+            if 'fail_steps' in fields: self.fail_steps[cars] = params_list[model].fail_steps
+
+            # The cars that are not failing draw their next failure again
+            if 'fail_p' in fields:
+                cars = cars[~self.failing[cars]]
+                fail_p = self.fail_p[cars]
+                draws = self.rngs['failures'].geometric(np.where(fail_p > 0, fail_p, 1))
+                self.next_event[cars] = np.where(fail_p > 0, self.step_count + draws, VectorRoad.NEVER)
+        self.next_event_step = int(self.next_event.min()) if self.n > 0 else VectorRoad.NEVER
+
+        if self.queues is not None: self.pool.redraw([values for queue in self.queues.queues for _, values in queue], changed)
+
+    def start_failures(self):
+        """Make the cars that fail in this step fail and the ones that recover in it recover (see `Road`)
+
+        Returns: Indices of the cars that can fail again from the next step on (they recovered or failed without
+                 effect), their next failure has to be drawn with `schedule_failures`
+        """
+
+        if self.n == 0 or self.next_event_step > self.step_count:
+            return np.zeros(0, dtype=np.int64)
+
+        due = np.flatnonzero(self.next_event <= self.step_count)
+        fail_steps = self.fail_steps[due]
+        recover = self.failing[due]
+        start = ~recover & (fail_steps > 0)
+
+        self.failing[due[recover]] = False
+        self.failing[due[start]] = True
+        self.next_event[due[start]] = self.step_count + fail_steps[start]
+        self.next_event_step = int(self.next_event.min())
+        return due[~start]
+
+    def schedule_failures(self, cars, draws):
+        """Set the step of the next failure of some cars
+
+        Args:
+            cars: Indices of the cars (see `start_failures`)
+            draws: Amount of steps until the failure of each car, drawn from the geometric distribution with p = fail_p
+        """
+
+        self.next_event[cars] = self.step_count + draws
+        if len(cars) > 0:
+            self.next_event_step = int(self.next_event.min())
+
+    def step_cars(self, delta_t):
+        """Move all the cars by one step (without failures, spawning or removing cars)
+        """
+
+        self.lane_changes = 0
+        if self.n > 0:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.__step(delta_t)
+
+    def update(self, delta_t: float):
+        """Create cars and update all the cars on the road
+        Args:
+            delta_t: Time step to simulate
+
+        Returns: True if a car reached the end of the road during this step
+        """
+
+        car_reached_end = False
+
+        # Start and end the failures of this step
+        self.step_count += 1
+        self.time += delta_t
+        self.exits = []
+        redraw = self.start_failures()
+        self.schedule_failures(redraw, self.rngs['failures'].geometric(self.fail_p[redraw]))
+
+        if self.n > 0:
+            self.step_cars(delta_t)
+
+            # If a car is outside the road, then delete it and set the return flag
+            outside = self.x - self.car_length / 2 > self.length
+            if outside.any():
+                exited = self.take_cars(outside)
+                self.exits = list(zip(exited['id'].tolist(), (self.time - exited['entry_t']).tolist()))
+                car_reached_end = True
+
+        # Let the waiting cars enter, or try to spawn a car if the time has come
+        self.last_new_car_t += delta_t
+        if self.queues is not None:
+            self.queues.update(self)
+        elif not self.ring and self.last_new_car_t >= 1.0/self.car_frequency and self.spawn_car():
+            self.last_new_car_t = 0
+
+        return car_reached_end
+
+    def __step(self, delta_t):
+        """Compute the new state of all the cars from the current one (local and global update at once)
+        """
+
+        # Terms of the IDM acceleration that only depend on the car itself (see `Driver.get_accel`)
+        v, a = self.v, self.a
+        relative_v = v / self.v_0
+        free_accel = a * (1 - np.power(relative_v, self.delta))
+        s_star_base = self.s_0 + self.s_1 * np.sqrt(relative_v) + self.T * v
+        s_star_factor = v / (2 * np.sqrt(a * self.b))
+
+        def idm(cars, other_v, s):
+            s_star = s_star_base[cars] + s_star_factor[cars] * (v[cars] - other_v)
+            return free_accel[cars] - a[cars] * (s_star / s) ** 2
+
+        # Get cars around each one to perform calculations based on them
+        around = self.__neighbours()
+        front_now = around["frontNow"]
+        has_front = front_now >= 0
+        pos_back, pos_front = self.x - self.car_length / 2, self.x + self.car_length / 2
+        s = np.where(has_front, pos_back[front_now] - pos_front + self.__seam(front_now, True), 2 * self.length)
+        other_v = np.where(has_front, v[front_now], v)
+        accel_before = idm(slice(None), other_v, s)
+
+        # Change lanes
+        change_left = self.__lane_change(True, idm, accel_before, around["frontLeft"], around["backLeft"], pos_back, pos_front)
+        change_right = self.__lane_change(False, idm, accel_before, around["frontRight"], around["backRight"], pos_back, pos_front)
+
+        # Update speed, based on the state before anything moves
+        s = np.maximum(0.000000001, s) # s can't be 0 or it will break things so we make s smol
+        accel = idm(slice(None), other_v, s) * delta_t
+        accel[self.failing] = 0
+
+        # Update position
+        self.x[:] += v * delta_t
+        if self.ring: self.x[self.x >= self.length] -= self.length
+
+        # Don't jump outside of the road :)
+        right = change_right & (self.y != self.bottomlane)
+        left = change_left & ~right & (self.y != self.toplane)
+        self.y[right] += self.lanewidth
+        self.y[left] -= self.lanewidth
+        self.lane_changes = int(np.count_nonzero(right | left))
+
+        self.accel[:] = accel
+        self.v[:] = np.where(self.failing, 0, np.maximum(v + accel, 0))
@@ -0,0 +1,110 @@
+"""Compare adaptive stepping (see `Car.AdaptiveStepping`) with the fixed step baseline
+
+Both runs use the same seed, so they get the same cars. For each setting this prints the evaluations of the driver
+model per simulated second, the run time (wall clock) and how far the result is from the baseline: the difference of
+the average speed and the average difference of the position and speed of the same car at the same time. Every
+evaluation of the IDM acceleration of one car counts, the ones of `Driver.get_accel` in the update of the cars and
+the ones of the `Kernels` in the lane change stage (MOBIL takes two per possible lane change, and so does the
+disadvantage of the car behind).
+
+Run from the code folder with `python benchmarks/adaptive.py [time] [car_frequency]`
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Car import Params, AdaptiveStepping
+from DriverModel import Driver
+from Simulation import Simulation
+import Kernels
+
+SEED = 0
+
+# Same car types as main
+CAR = Params(T=1.4, a=2, b=2.5, delta=4, s_0=2, s_1=0, length=4.55, thr=0.3, pol=0.25, right_bias=0.3,
+             fail_steps=30, spawn_weight=139829, v_0=(120/3.6, 15/3.6), fail_p=1e-6)
+TRUCK = Params(T=1.6, a=1, b=1.5, delta=4, s_0=2, s_1=0, length=16.5, thr=0.3, pol=0.25, right_bias=0.3,
+               fail_steps=30, spawn_weight=7886, v_0=(80/3.6, 2.5/3.6), fail_p=1e-6)
+
+SETTINGS = [None, AdaptiveStepping(), AdaptiveStepping(tolerance=0.01), AdaptiveStepping(tolerance=0.05),
+            AdaptiveStepping(max_substeps=16)]
+
+# Functions that evaluate the driver model, with the amount of evaluations per car of their result
+COUNTED = [(Driver, 'get_accel', 1), (Kernels, 'idm_accel', 1), (Kernels, 'disadvantage_and_safety', 2), (Kernels, 'mobil_change', 2)]
+
+def counted(function, per_car, counter):
+    """Wrap a function to add its evaluations to counter[0], the ones of the functions it calls are not counted
+    again (counter[1] is the depth of the nested calls)
+    """
+
+    def wrapper(*args, **kwargs):
+        counter[1] += 1
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            counter[1] -= 1
+        if counter[1] == 0:
+            counter[0] += per_car * np.size(result[0] if isinstance(result, tuple) else result)
+        return result
+    return wrapper
+
+def run(adaptive, sim_time, car_frequency):
+    """Run a simulation and count the evaluations of the driver model
+
+    Returns: Tuple with the data of every step, the amount of evaluations and the run time
+    """
+
+    counter = [0, 0]
+    originals = [getattr(owner, name) for owner, name, _ in COUNTED]
+    for (owner, name, per_car), function in zip(COUNTED, originals):
+        setattr(owner, name, counted(function, per_car, counter))
+    try:
+        sim = Simulation([CAR, TRUCK], road_length=5000, car_frequency=car_frequency, delta_t=0.3, adaptive=adaptive, seed=SEED)
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                data = sim.run(time=sim_time)
+            finally:
+                sys.stderr = stderr
+        return data, counter[0], time.perf_counter() - start
+    finally:
+        for (owner, name, _), function in zip(COUNTED, originals):
+            setattr(owner, name, function)
+
+def difference(data, baseline):
+    """Average difference of the position and the speed of the same car in the same step
+
+    Returns: Tuple with the average absolute difference of the position and of the speed
+    """
+
+    dx, dv = [], []
+    for cars, base_cars in zip(data, baseline):
+        base = {car['id']: car for car in base_cars}
+        for car in cars:
+            other = base.get(car['id'])
+            if other is None: continue
+            dx.append(abs(car['pos'][0] - other['pos'][0]))
+            dv.append(abs(car['v'] - other['v']))
+    return np.mean(dx), np.mean(dv)
+
+def average_speed(data):
+    return 3.6 * np.mean([car['v'] for cars in data for car in cars])
+
+if __name__ == '__main__':
+    sim_time = float(sys.argv[1]) if len(sys.argv) > 1 else 600
+    car_frequency = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    print(f"{'stepping':70} {'evals/s':>10} {'ratio':>7} {'time':>8} {'ratio':>7} {'speed km/h':>11} {'|dx| m':>8} {'|dv| m/s':>9}")
+    baseline = None
+    for adaptive in SETTINGS:
+        data, evaluations, seconds = run(adaptive, sim_time, car_frequency)
+        if baseline is None:
+            baseline, base_evaluations, base_seconds = data, evaluations, seconds
+        dx, dv = difference(data, baseline)
+        print(f"{repr(adaptive) if adaptive is not None else 'fixed':70} {evaluations / sim_time:10.0f} {evaluations / base_evaluations:7.2f} "
+              f"{seconds:7.2f}s {seconds / base_seconds:7.2f} {average_speed(data):11.3f} {dx:8.3f} {dv:9.4f}", flush=True)
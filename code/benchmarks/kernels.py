@@ -0,0 +1,86 @@
+"""Microbenchmark of the array kernels in `Kernels` against calling `Driver` once per car
+
+Run from the code folder with `python benchmarks/kernels.py [cars]`
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Kernels
+from Car import Params
+from DriverModel import Driver
+
+PARAM_NAMES = ('v_0', 's_0', 's_1', 'T', 'a', 'b', 'delta')
+MOBIL_NAMES = ('thr', 'pol', 'right_bias')
+
+def make_inputs(cars, seed=0):
+    """Make random but realistic inputs for every car, with the params of the default car types in main
+    """
+
+    rng = np.random.default_rng(seed)
+    params_list = [Params(v_0=120/3.6, s_0=2, s_1=0, T=1.5, a=1, b=2, delta=4, thr=0.2, pol=0.5, right_bias=0.1),
+                   Params(v_0=90/3.6, s_0=4, s_1=0, T=1.7, a=0.5, b=1.5, delta=4, thr=0.2, pol=0.2, right_bias=0.3)]
+    params = [params_list[i] for i in rng.integers(len(params_list), size=cars)]
+
+    inputs = {
+        'v': rng.uniform(0, 35, cars),
+        'other_v': rng.uniform(0, 35, cars),
+        's': rng.uniform(5, 200, cars),
+        'other_v_after': rng.uniform(0, 35, cars),
+        's_after': rng.uniform(5, 200, cars),
+        'disadvantage': rng.uniform(-1, 1, cars),
+        'accel_behind': rng.uniform(-3, 1, cars),
+    }
+    arrays = {name: np.array([getattr(p, name) for p in params], dtype=np.float64) for name in PARAM_NAMES + MOBIL_NAMES}
+    return params, inputs, arrays
+
+def timeit(function, repeat):
+    """Best time of `repeat` calls of function
+    """
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(cars=10000, repeat=5):
+    params, inputs, arrays = make_inputs(cars)
+    drivers = [Driver(p) for p in params]
+    idm_params = [arrays[name] for name in PARAM_NAMES]
+    mobil_params = idm_params + [arrays[name] for name in MOBIL_NAMES]
+    v, other_v, s = inputs['v'].tolist(), inputs['other_v'].tolist(), inputs['s'].tolist()
+    other_v_after, s_after = inputs['other_v_after'].tolist(), inputs['s_after'].tolist()
+    disadvantage, accel_behind = inputs['disadvantage'].tolist(), inputs['accel_behind'].tolist()
+
+    def idm_driver():
+        return [d.get_accel(v[i], other_v[i], s[i]) for i, d in enumerate(drivers)]
+
+    def idm_kernel():
+        return Kernels.idm_accel(inputs['v'], inputs['other_v'], inputs['s'], *idm_params)
+
+    def mobil_driver():
+        return [d.change_lane(True, v[i], s[i], other_v[i], s_after[i], other_v_after[i], disadvantage[i], accel_behind[i])
+                for i, d in enumerate(drivers)]
+
+    def mobil_kernel():
+        return Kernels.mobil_change(True, inputs['v'], inputs['s'], inputs['other_v'], inputs['s_after'], inputs['other_v_after'],
+                                    inputs['disadvantage'], inputs['accel_behind'], *mobil_params)
+
+    # Both versions have to give the same results, the first call also compiles the Numba kernels
+    assert np.allclose(idm_driver(), idm_kernel(), rtol=1e-12)
+    assert np.array_equal(mobil_driver(), mobil_kernel())
+
+    print(f'Backend: {Kernels.BACKEND}, {cars} cars')
+    for name, driver, kernel in (('IDM', idm_driver, idm_kernel), ('MOBIL', mobil_driver, mobil_kernel)):
+        t_driver, t_kernel = timeit(driver, repeat), timeit(kernel, repeat)
+        print(f'{name:6} Driver: {t_driver/cars*1e9:8.1f} ns/car   Kernels: {t_kernel/cars*1e9:8.1f} ns/car   '
+              f'speedup: {t_driver/t_kernel:6.1f}x')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,229 @@
+"""Benchmarks of the simulation, the data files and the metrics
+
+Every benchmark uses fixed seeds, so two runs measure exactly the same work. The results are stored as JSON in
+benchmarks/results/<commit>.json, so the numbers of two commits can be compared with --compare.
+
+Run from the code folder, e.g.:
+    python benchmarks/run.py                          # Run everything
+    python benchmarks/run.py -k road_update --quick   # Only some benchmarks, with less repetitions
+    python benchmarks/run.py --compare benchmarks/results/<other commit>.json
+"""
+
+import os
+import sys
+import json
+import time
+import contextlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_DIR)
+
+from Car import Params, random_streams
+from Road import Road
+from VectorRoad import VectorRoad
+from Simulation import Simulation
+from Metrics import Metrics
+
+SEED = 0
+RESULTS_DIR = os.path.join(CODE_DIR, 'benchmarks', 'results')
+ENGINES = {'objects': Road, 'vectorized': VectorRoad}
+
+# Same car types as main
+CAR = Params(T=1.4, a=2, b=2.5, delta=4, s_0=2, s_1=0, length=4.55, thr=0.3, pol=0.25, right_bias=0.3,
+             fail_steps=30, spawn_weight=139829, v_0=(120/3.6, 15/3.6), fail_p=1e-6)
+TRUCK = Params(T=1.6, a=1, b=1.5, delta=4, s_0=2, s_1=0, length=16.5, thr=0.3, pol=0.25, right_bias=0.3,
+               fail_steps=30, spawn_weight=7886, v_0=(80/3.6, 2.5/3.6), fail_p=1e-6)
+PARAMS_LIST = [CAR, TRUCK]
+
+BENCHMARKS = {}
+
+def benchmark(unit, **params):
+    """Register a benchmark
+
+    The decorated function gets a temporary folder and one value of each param, and returns a tuple with a
+    function to time and the amount of work (in `unit`) each call of it does, so the result can be given as a rate.
+
+    Args:
+        unit: What the work is counted in (e.g. 'steps')
+        params: Lists of values to run the benchmark with, every combination is run
+    """
+
+    def decorator(function):
+        BENCHMARKS[function.__name__] = {'function': function, 'unit': unit, 'params': params}
+        return function
+    return decorator
+
+def filled_road(engine, cars, lanes=2, spacing=25):
+    """Make a road with the given amount of cars evenly spread over all its lanes
+
+    The road is twice as long as the part with cars, so no car leaves it while it is measured.
+    """
+
+    per_lane = -(-cars // lanes)
+    road = ENGINES[engine](PARAMS_LIST, (0, 0), lanes, 5, 2 * per_lane * spacing, 2, rngs=random_streams(SEED))
+    for i in range(cars):
+        road.add_car((i // lanes) * spacing, i % lanes)
+    return road
+
+def simulation_data(steps, engine='vectorized'):
+    """Run a simulation with a fixed seed and return its data (a list of serialized cars per step)
+    """
+
+    sim = Simulation(PARAMS_LIST, road_length=10000, car_frequency=2, delta_t=0.3, engine=engine, seed=SEED)
+    return [sim.step() for _ in range(steps)]
+
+@benchmark('steps', engine=['objects', 'vectorized'], cars=[100, 1000, 5000, 20000])
+def road_update(folder, engine, cars):
+    road = filled_road(engine, cars)
+    return (lambda: road.update(0.3)), 1
+
+@benchmark('steps', engine=['objects', 'vectorized'], lanes=[1, 2, 4, 8])
+def road_update_lanes(folder, engine, lanes):
+    road = filled_road(engine, 5000, lanes)
+    return (lambda: road.update(0.3)), 1
+
+@benchmark('calls', engine=['objects', 'vectorized'], cars=[0, 1000])
+def spawn_car(folder, engine, cars):
+    road = filled_road(engine, cars)
+
+    # Only the first call can spawn a car at the start of the road, the others check the gap and give up
+    def spawn():
+        for _ in range(100): road.spawn_car()
+    return spawn, 100
+
+@benchmark('cars', format=['json', 'traj'])
+def save_data(folder, format):
+    from main import save_data
+    data = simulation_data(500)
+    filename = os.path.join(folder, 'data.' + format)
+
+    def save():
+        save_data(data, filename, overwrite=True)
+    return save, sum(len(cars) for cars in data)
+
+@benchmark('cars', format=['json', 'traj'])
+def read_data(folder, format):
+    from main import save_data, read_data
+    data = simulation_data(500)
+    filename = os.path.join(folder, 'data.' + format)
+    save_data(data, filename, overwrite=True)
+
+    # Reading a trajectory is lazy, so all the columns are read too to compare the same work
+    def read():
+        data = read_data(filename)
+        if format == 'traj':
+            for column in data.columns.values(): np.asarray(column).sum()
+    return read, sum(len(cars) for cars in data)
+
+@benchmark('steps', data=['list', 'traj'])
+def make_dots_bw(folder, data):
+    from Trajectory import Trajectory
+    steps = simulation_data(1000)
+    if data == 'traj':
+        filename = os.path.join(folder, 'data.traj')
+        Trajectory.write(steps, filename)
+        steps = Trajectory(filename)
+    return (lambda: Metrics.make_dots_bw(steps, 10000, 1, 10)), 1000
+
+@benchmark('frames', data=['list', 'traj'])
+def replay_frames(folder, data):
+    from Trajectory import Trajectory
+    from Replay import Replay
+    steps = simulation_data(300)
+    if data == 'traj':
+        filename = os.path.join(folder, 'data.traj')
+        Trajectory.write(steps, filename)
+        steps = Trajectory(filename)
+    replay = Replay(steps, size=(2000, 100), scale=0.2)
+    return (lambda: sum(1 for _ in replay.frames())), 300
+
+def measure(function, min_time, repeat):
+    """Time a function, calling it until min_time has passed, `repeat` times
+
+    Returns: The best time per call (in seconds)
+    """
+
+    function() # Warm up (first call of lazy imports, caches, ...)
+    best = np.inf
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time: break
+        best = min(best, elapsed / calls)
+    return best
+
+def combinations(params):
+    """All the combinations of the benchmark params, as dicts
+    """
+
+    combos = [{}]
+    for name, values in params.items():
+        combos = [{**combo, name: value} for combo in combos for value in values]
+    return combos
+
+def key(name, params):
+    return name + ''.join(f'[{k}={v}]' for k, v in params.items())
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CODE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run(pattern=None, min_time=1.0, repeat=3):
+    """Run the benchmarks whose name contains pattern (all if None)
+
+    Returns: Dict with the time per call and the rate of each benchmark, keyed by name and params
+    """
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if pattern is not None and pattern not in name: continue
+        for params in combinations(bench['params']):
+            with tempfile.TemporaryDirectory() as folder:
+                # Keep what the code prints (and its progress bars) while it is timed out of the results
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+                    function, work = bench['function'](folder, **params)
+                    seconds = measure(function, min_time, repeat)
+            results[key(name, params)] = {'seconds': seconds, 'rate': work / seconds, 'unit': bench['unit'] + '/s'}
+            print(f"{key(name, params):50} {seconds*1000:10.3f} ms {work/seconds:14.1f} {bench['unit']}/s", flush=True)
+    return results
+
+def compare(results, other):
+    """Print the change of the rates compared to another results file
+    """
+
+    print(f"\nCompared to {other['commit']} (higher is faster):")
+    for name, result in results.items():
+        if name in other['results']:
+            print(f"{name:50} {result['rate'] / other['results'][name]['rate']:8.2f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmarks and store the results as JSON')
+    parser.add_argument('-k', dest='pattern', help='Only run the benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='Time each benchmark once for a short time')
+    parser.add_argument('--output', help='File to store the results in (benchmarks/results/<commit>.json by default)')
+    parser.add_argument('--compare', help='Results file of another commit to compare with')
+    args = parser.parse_args()
+
+    results = run(args.pattern, min_time=0.2 if args.quick else 1.0, repeat=1 if args.quick else 3)
+
+    output = args.output or os.path.join(RESULTS_DIR, commit() + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'commit': commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'machine': platform.machine(), 'seed': SEED, 'results': results}, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
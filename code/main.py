@@ -7,6 +7,10 @@ from Simulation import Simulation
 from DriverModel import Driver
 from Metrics import Metrics
 from Car import Params
+from Trajectory import Trajectory
+from Sweep import Sweep, grid
+from Cache import ResultCache
+from Replay import Replay
 
 def dist(a, b):
     return np.sqrt((a[0]-b[0])**2 + (a[1]-b[1])**2)
@@ -18,18 +22,22 @@ def make_filename(f):
     ext = fsplit[1] if len(fsplit) > 1 else ""
     suff = ""
     i = 1
-    while os.path.isfile(f'{name}{suff}.{ext}'): suff = i ; i += 1
+    while os.path.exists(f'{name}{suff}.{ext}'): suff = i ; i += 1
     return f'{name}{suff}.{ext}'
 
-# Save data to JSON file
+# Save data to JSON file, or to a binary trajectory if the filename ends with .traj (for simulation data)
 def save_data(data, filename, overwrite=False):
     print("Saving data, this might take a while...")
     os.makedirs(os.path.dirname(filename), exist_ok=True)
-    json.dump(data, open(make_filename(filename) if not overwrite else filename, "w"))
+    filename = make_filename(filename) if not overwrite else filename
+    if filename.endswith(".traj"): Trajectory.write(data, filename)
+    else: json.dump(data, open(filename, "w"))
 
-# Read data from JSON file
+# Read data from JSON file, or open a binary trajectory if the filename ends with .traj (this does not load it into memory)
 def read_data(filename):
-    if not os.path.isfile(filename): return None
+    if not os.path.exists(filename): return None
+    elif filename.endswith(".traj"):
+        return Trajectory(filename)
     else:
         print("Loading data, this might take a while...")
         return json.load(open(filename, "r"))
@@ -43,6 +51,12 @@ def dots_to_image(pixel_plot, filename, mode='L', overwrite=False):
     img = Image.fromarray(pixel_plot.astype('uint8'), mode=mode)
     img.save(filename)
 
+# Read an image saved with dots_to_image back into a pixel plot
+def read_image(filename):
+    from PIL import Image
+
+    return np.asarray(Image.open(filename))
+
 # Make image out of dots graph (without saving)
 def dots_to_image_not_saved(pixel_plot):
     from PIL import Image
@@ -57,44 +71,36 @@ def combine_and_save(img1, img2, filename, overwrite = False):
     new_image = img.resize((int(img.width * 1),int(img.height *0.2) ), resample= Image.BILINEAR)
     new_image.save(filename)
 
-# Show the simulation using pygame (good for debugging)
+# Show the simulation using pygame (good for debugging), data can be a list of steps or a trajectory (see `Replay`)
 def show_pygame(data, delta_t):
-    import pygame
-    SPEED = 5 # playback speed of the data (1 for real time)
-
-    SIZE = WIDTH, HEIGHT = 1000, 100
-    SCREEN = pygame.display.set_mode(SIZE)
-    BLACK = (0, 0, 0)
-    WHITE = (255, 255, 255)
-
-    CLOCK = pygame.time.Clock()
-
-    pygame.init()
+    Replay(data).show(delta_t)
 
-    for datapoint in data:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT: sys.exit()
-            if event.type == pygame.KEYDOWN:
-                # These two change the playback speed with the arrow keys
-                if event.key == pygame.K_UP: SPEED += 1
-                if event.key == pygame.K_DOWN: SPEED = max(1, SPEED - 1)
+# Compute the average speed and make the plots for one run of a sweep (this runs in the worker processes)
+# The average and the dot graph are cached together with the run, so they are only computed once per run
+def analyse_run(point, data, key, cache, road_length, filename_average, filename_average_plot, filename_graph):
+    avg = cache.artifact(key, 'average.json', lambda: Metrics.avg_speed(data))    # Calculate average at each time step
+    save_data(avg, filename_average.format(**point), overwrite=True)
 
-        SCREEN.fill(BLACK)
+    Metrics.plot_bins(100, avg, filename_average_plot.format(**point))      # Plot average speed across time in groups of 100 steps
 
-        for car in datapoint:
-            car_surface = pygame.Surface((car['length'], 2)) # Make a pygame surface for the car
-            car_surface.fill(WHITE)                          # Fill the surface with white
-            car_rect = car_surface.get_rect()                # Get the rect (bounding area)
-            car_rect.center = car['pos']                     # Set center of the rect to position of the car
-            SCREEN.blit(car_surface, car_rect)               # Draw the car on the screen
+    dots = cache.artifact(key, 'graph.png', lambda: Metrics.make_dots_bw(data, road_length, time_div=1, delta_x=10),   # Make the dot graph
+                          save=lambda dots, filename: dots_to_image(dots, filename, overwrite=True), load=read_image)
+    dots_to_image(dots, filename_graph.format(**point), overwrite=True)         # Save the dot graph
 
-        pygame.display.update()                              # Update the screen
-        CLOCK.tick(1./delta_t * SPEED)                       # Tick the clock according to the playback speed
+    return np.mean(avg)                         # This is the actual overall average (over all time steps)
 
 if __name__ == "__main__":
+    from functools import partial
+
     road_length = 50000 # Length of the road we want to simulate
     delta_t = 0.3       # Time step of the simulation
 
+    # All the simulations of a sweep run in parallel (one per core). The runs are kept in the cache, so a run is only
+    # simulated again if its params, seed, road, delta_t or the simulation code changed. Every sweep has its own
+    # seed, so the runs of different sweeps don't share their random traffic
+    cache = ResultCache('cache')
+    sweep_kwargs = dict(road_length=road_length, car_frequency=2, delta_t=delta_t, cache=cache)
+
     # With speed limit and constant params (standard)
     #===========================================================================================
 
@@ -114,38 +120,24 @@ if __name__ == "__main__":
 
     folder='speedlimit/'                                # Folder to store all the data and plots
     filename_plot_groupped=folder + f'speedlimit_plot_groupped.svg'
-    for i, p in enumerate(fail_ps):
-        filename_plot=folder + f'speedlimit_plot_fail_{p}.svg'
-        for j, l in enumerate(limits):
-            filename_data=folder + f'speedlimit_{l}_fail_{p}.json'
-            filename_average=folder + f'speedlimit_{l}_fail_{p}_average.json'
-            filename_graph=folder + f'speedlimit_{l}_fail_{p}_graph.png'
-            filename_average_plot=folder + f'speedlimit_{l}_fail_{p}_average_plot.svg'
-
-            data = read_data(filename=filename_data) # Try to read data, if no data then run the simulation
-            if data is None:
-                print(f'Running simulation for speedlimit={l}, fail_p={p}')
 
-                car_params.v_0 = (l/3.6, 5/3.6)
-                car_params.fail_p = p
+    # Overrides of the car and trucc params for each simulation
+    def speedlimit_overrides(point):
+        l, p = point['limit'], point['fail_p']
+        return [dict(v_0=(l/3.6, 5/3.6), fail_p=p), dict(v_0=(min(l, 80)/3.6, 2.5/3.6), fail_p=p)]
 
-                trucc_params.v_0 = (min(l, 80)/3.6, 2.5/3.6)
-                trucc_params.fail_p = p
+    sweep = Sweep([car_params, trucc_params], grid(fail_p=fail_ps, limit=limits), speedlimit_overrides,
+                  analyse=partial(analyse_run, cache=cache, road_length=road_length,
+                                  filename_average=folder + 'speedlimit_{limit}_fail_{fail_p}_average.json',
+                                  filename_average_plot=folder + 'speedlimit_{limit}_fail_{fail_p}_average_plot.svg',
+                                  filename_graph=folder + 'speedlimit_{limit}_fail_{fail_p}_graph.png'),
+                  seed=1, **sweep_kwargs)
 
-                sim = Simulation([car_params, trucc_params], road_length=road_length, car_frequency=2, delta_t=delta_t)
-                data = sim.run()
-                save_data(data, filename_data, overwrite=True)
+    for point, avg in sweep.run():
+        avg_table[fail_ps.index(point['fail_p'])][limits.index(point['limit'])] = avg
 
-            avg = read_data(filename_average)
-            if avg is None:
-                avg = Metrics.avg_speed(data)           # Calculate average at each time step
-                save_data(avg, filename_average, overwrite=True)
-            avg_table[i][j] = np.mean(avg)              # This is the actual overall average (over all time steps)
-
-            Metrics.plot_bins(100, avg, filename_average_plot)      # Plot average speed across time in groups of 100 steps
-
-            dots = Metrics.make_dots_bw(data, road_length, time_div=1, delta_x=10)      # Make the dot graph
-            dots_to_image(dots, filename_graph, overwrite=True)                         # Save the dot graph
+    for i, p in enumerate(fail_ps):
+        filename_plot=folder + f'speedlimit_plot_fail_{p}.svg'
 
         # This plots speed limit against average car speed
         plt.bar(range(len(limits)), avg_table[i])
@@ -176,40 +168,21 @@ if __name__ == "__main__":
     fail_ps = [0, 1e-6]
     avg_table = np.zeros((len(fail_ps), len(limits)))
 
+    folder='speedlimit_a_0,3/{fail_p}/'
+    sweep = Sweep([car_params, trucc_params], grid(fail_p=fail_ps, limit=limits), speedlimit_overrides,
+                  analyse=partial(analyse_run, cache=cache, road_length=road_length,
+                                  filename_average=folder + 'speedlimit_{limit}_fail_{fail_p}_average_a_0,3.json',
+                                  filename_average_plot=folder + 'speedlimit_{limit}_fail_{fail_p}_average_plot_a_0,3.svg',
+                                  filename_graph=folder + 'speedlimit_{limit}_fail_{fail_p}_graph_a_0,3.png'),
+                  seed=2, **sweep_kwargs)
+
+    for point, avg in sweep.run():
+        avg_table[fail_ps.index(point['fail_p'])][limits.index(point['limit'])] = avg
+
     for i, p in enumerate(fail_ps):
         folder=f'speedlimit_a_0,3/{p}/'
         filename_plot_groupped=folder + f'speedlimit_plot_groupped_a_0,3.svg'
         filename_plot=folder + f'speedlimit_plot_fail_{p}_a_0,3.svg'
-        for j, l in enumerate(limits):
-            filename_data=folder + f'speedlimit_{l}_fail_{p}_a_0,3.json'
-            filename_average=folder + f'speedlimit_{l}_fail_{p}_average_a_0,3.json'
-            filename_graph=folder + f'speedlimit_{l}_fail_{p}_graph_a_0,3.png'
-            filename_average_plot=folder + f'speedlimit_{l}_fail_{p}_average_plot_a_0,3.svg'
-
-            data = read_data(filename=filename_data)
-            if data is None:
-                print(f'Running simulation for speedlimit={l}, fail_p={p}')
-
-                car_params.v_0 = (l/3.6, 5/3.6)
-                car_params.fail_p = p
-
-                trucc_params.v_0 = (min(l, 80)/3.6, 2.5/3.6)
-                trucc_params.fail_p = p
-
-                sim = Simulation([car_params, trucc_params], road_length=road_length, car_frequency=2, delta_t=delta_t)
-                data = sim.run()
-                save_data(data, filename_data, overwrite=True)
-
-            avg = read_data(filename_average)
-            if avg is None:
-                avg = Metrics.avg_speed(data)
-                save_data(avg, filename_average, overwrite=True)
-            avg_table[i][j] = np.mean(avg)
-
-            Metrics.plot_bins(100, avg, filename_average_plot)
-
-            dots = Metrics.make_dots_bw(data, road_length, time_div=1, delta_x=10)
-            dots_to_image(dots, filename_graph, overwrite=True)
 
         plt.bar(range(len(limits)), avg_table[i])
         plt.xticks(range(len(limits)), limits)
@@ -236,43 +209,30 @@ if __name__ == "__main__":
     avgs = [100, 120, 140, 160, 180]
     widths = [10, 15, 20]
     fail_ps = [0, 1e-6]
-    avg_table = np.zeros((len(widths), len(avgs)))
+    avg_tables = {p: np.zeros((len(widths), len(avgs))) for p in fail_ps}
+
+    # Overrides of the car and trucc params for each simulation
+    def no_speedlimit_overrides(point):
+        a, w, p = point['avg'], point['width'], point['fail_p']
+        return [dict(v_0=(a/3.6, w/3.6), fail_p=p), dict(v_0=(min(a, 80)/3.6, 2.5/3.6), fail_p=p)]
+
+    folder='no_speedlimit/{fail_p}/'
+    sweep = Sweep([car_params, trucc_params], grid(fail_p=fail_ps, width=widths, avg=avgs), no_speedlimit_overrides,
+                  analyse=partial(analyse_run, cache=cache, road_length=road_length,
+                                  filename_average=folder + 'no_speedlimit_({avg}, {width})_fail_{fail_p}_average.json',
+                                  filename_average_plot=folder + 'no_speedlimit_{avg}_width_{width}_average_plot.svg',
+                                  filename_graph=folder + 'no_speedlimit_({avg}, {width})_fail_{fail_p}.png'),
+                  seed=3, **sweep_kwargs)
+
+    for point, avg in sweep.run():
+        avg_tables[point['fail_p']][widths.index(point['width'])][avgs.index(point['avg'])] = avg
 
     for p in fail_ps:
         folder=f'no_speedlimit/{p}/'
         filename_plot_groupped=folder + f'no_speedlimit_graph_groupped.svg'
+        avg_table = avg_tables[p]
         for i, w in enumerate(widths):
             filename_plot=folder + f'no_speedlimit_plot_width_{w}.svg'
-            for j, a in enumerate(avgs):
-                filename_data=folder + f'no_speedlimit_({a}, {w})_fail_{p}.json'
-                filename_average=folder + f'no_speedlimit_({a}, {w})_fail_{p}_average.json'
-                filename_graph=folder + f'no_speedlimit_({a}, {w})_fail_{p}.png'
-                filename_average_plot=folder + f'no_speedlimit_{a}_width_{w}_average_plot.svg'
-
-                data = read_data(filename=filename_data)
-                if data is None:
-                    print(f'Running simulation for average speed={a}, width={w}, fail_p={p}')
-
-                    car_params.v_0 = (a/3.6, w/3.6)
-                    car_params.fail_p = p
-
-                    trucc_params.v_0 = (min(a, 80)/3.6, 2.5/3.6)
-                    trucc_params.fail_p = p
-
-                    sim = Simulation([car_params, trucc_params], road_length=road_length, car_frequency=2, delta_t=delta_t)
-                    data = sim.run()
-                    save_data(data, filename_data, overwrite=True)
-
-                avg = read_data(filename_average)
-                if avg is None:
-                    avg = Metrics.avg_speed(data)
-                    save_data(avg, filename_average, overwrite=True)
-                avg_table[i][j] = np.mean(avg)
-
-                Metrics.plot_bins(100, avg, filename_average_plot)
-
-                dots = Metrics.make_dots_bw(data, road_length, time_div=1, delta_x=10)
-                dots_to_image(dots, filename_graph, overwrite=True)
 
             plt.bar(range(len(avgs)), avg_table[i])
             plt.xticks(range(len(avgs)), avgs)
@@ -298,43 +258,25 @@ if __name__ == "__main__":
     avgs = [100, 120, 140, 160, 180]
     widths = [10, 15, 20]
     fail_ps = [0, 1e-06]
-    avg_table = np.zeros((len(widths), len(avgs)))
+    avg_tables = {p: np.zeros((len(widths), len(avgs))) for p in fail_ps}
+
+    folder='no_speedlimit_a_0,3/{fail_p}/'
+    sweep = Sweep([car_params, trucc_params], grid(fail_p=fail_ps, width=widths, avg=avgs), no_speedlimit_overrides,
+                  analyse=partial(analyse_run, cache=cache, road_length=road_length,
+                                  filename_average=folder + 'no_speedlimit_({avg}, {width})_fail_{fail_p}_average_a_0,3.json',
+                                  filename_average_plot=folder + 'no_speedlimit_{avg}_width_{width}_average_plot_a_0,3.svg',
+                                  filename_graph=folder + 'no_speedlimit_({avg}, {width})_fail_{fail_p}_a_0,3.png'),
+                  seed=4, **sweep_kwargs)
+
+    for point, avg in sweep.run():
+        avg_tables[point['fail_p']][widths.index(point['width'])][avgs.index(point['avg'])] = avg
 
     for p in fail_ps:
         folder=f'no_speedlimit_a_0,3/{p}/'
         filename_plot_groupped=folder + f'no_speedlimit_graph_groupped_a_0,3.svg'
+        avg_table = avg_tables[p]
         for i, w in enumerate(widths):
             filename_plot=folder + f'no_speedlimit_plot_width_{w}_a_0,3.svg'
-            for j, a in enumerate(avgs):
-                filename_data=folder + f'no_speedlimit_({a}, {w})_fail_{p}_a_0,3.json'
-                filename_average=folder + f'no_speedlimit_({a}, {w})_fail_{p}_average_a_0,3.json'
-                filename_graph=folder + f'no_speedlimit_({a}, {w})_fail_{p}_a_0,3.png'
-                filename_average_plot=folder + f'no_speedlimit_{a}_width_{w}_average_plot_a_0,3.svg'
-
-                data = read_data(filename=filename_data)
-                if data is None:
-                    print(f'Running simulation for average speed={a}, width={w}, fail_p={p}')
-
-                    car_params.v_0 = (a/3.6, w/3.6)
-                    car_params.fail_p = p
-
-                    trucc_params.v_0 = (min(a, 80)/3.6, 2.5/3.6)
-                    trucc_params.fail_p = p
-
-                    sim = Simulation([car_params, trucc_params], road_length=road_length, car_frequency=2, delta_t=delta_t)
-                    data = sim.run()
-                    save_data(data, filename_data, overwrite=True)
-
-                avg = read_data(filename_average)
-                if avg is None:
-                    avg = Metrics.avg_speed(data)
-                    save_data(avg, filename_average, overwrite=True)
-                avg_table[i][j] = np.mean(avg)
-
-                Metrics.plot_bins(100, avg, filename_average_plot)
-
-                dots = Metrics.make_dots_bw(data, road_length, time_div=1, delta_x=10)
-                dots_to_image(dots, filename_graph, overwrite=True)
 
             plt.bar(range(len(avgs)), avg_table[i])
             plt.xticks(range(len(avgs)), avgs)
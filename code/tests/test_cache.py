@@ -0,0 +1,27 @@
+import os
+import sys
+import Cache
+import Simulation
+from Car import Params
+
+def test_every_module_of_a_run_is_part_of_the_code_version():
+    folder = os.path.dirname(os.path.abspath(Cache.__file__))
+    loaded = {os.path.basename(module.__file__) for module in list(sys.modules.values())
+              if getattr(module, '__file__', None) and os.path.dirname(os.path.abspath(module.__file__)) == folder}
+    assert loaded - {'Cache.py'} <= set(Cache.CODE_FILES)
+    for name in ('Corridor.py', 'Inflow.py', 'Recorder.py', 'Trajectory.py', 'Detectors.py'):
+        assert name in Cache.CODE_FILES
+
+def test_evicting_keeps_the_files_that_are_being_written(tmp_path):
+    cache = Cache.ResultCache(str(tmp_path))
+    key, trajectory = cache.run([Params()], 0, time=10, road_length=300, car_frequency=2, delta_t=0.2)
+    assert len(trajectory) > 0 and os.listdir(tmp_path / cache.TEMP) == []
+
+    # Another process that is still writing its run
+    writing = tmp_path / cache.TEMP / f'1-{key}-run.traj'
+    writing.mkdir()
+    (writing / 'offsets.bin').write_bytes(b'0' * 64)
+
+    Cache.ResultCache(str(tmp_path), max_size=0).evict()
+    assert not cache.has_run(key) and cache.size() == 0
+    assert (writing / 'offsets.bin').exists()
@@ -0,0 +1,48 @@
+import pytest
+import numpy as np
+from Car import Params
+from Simulation import Simulation
+
+PARAMS_LIST = [Params(fail_p=1e-3, fail_steps=20), Params(v_0=(20, 2), length=(12, 1), fail_p=1e-3)]
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_restored_run_continues_exactly(tmp_path, engine):
+    checkpoint = str(tmp_path / 'sim.ckpt')
+    sim = Simulation(PARAMS_LIST, road_length=1000, car_frequency=2, delta_t=0.2, engine=engine, seed=1)
+    sim.run(time=40, recorder=[], checkpoint=checkpoint)
+
+    assert Simulation.restore(checkpoint).run(time=40) == sim.run(time=40)
+
+def test_branch_of_a_finished_run_steps(tmp_path):
+    checkpoint = str(tmp_path / 'sim.ckpt')
+    sim = Simulation(PARAMS_LIST, road_length=300, car_frequency=2, delta_t=0.2, engine='vectorized', seed=1)
+    sim.run(checkpoint=checkpoint)
+    assert sim.end
+
+    # The run ended when the first car reached the end, a branch runs until it happens again
+    branch = Simulation.restore(checkpoint, params_list=PARAMS_LIST, seed=5)
+    assert len(branch.run()) > 0
+    assert len(Simulation.restore(checkpoint, seed=5).run()) > 0
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_branch_applies_the_new_params_to_the_cars_on_the_road(tmp_path, engine):
+    checkpoint = str(tmp_path / 'sim.ckpt')
+    sim = Simulation(PARAMS_LIST, road_length=2000, car_frequency=2, delta_t=0.2, engine=engine, seed=1)
+    sim.run(time=60, recorder=[], checkpoint=checkpoint)
+
+    slow = [Params(**{**PARAMS_LIST[0].as_dict(), 'v_0': 10, 'fail_p': 0}), PARAMS_LIST[1]]
+    branch = Simulation.restore(checkpoint, params_list=slow, seed=2)
+    road = branch.road
+    if engine == 'objects':
+        cars = [car for car in road.carlist if car.type == 0]
+        assert cars and all(car.params.v_0 == 10 and car.params.fail_p == 0 for car in cars)
+        assert all(car.id not in road.scheduled for car in cars if not car.failing)
+        assert any(car.params.v_0 != 10 for car in road.carlist if car.type == 1)
+    else:
+        cars = road.type == 0
+        assert cars.any() and np.all(road.v_0[cars] == 10) and np.all(road.fail_p[cars] == 0)
+        assert np.all(road.next_event[cars & ~road.failing] == road.NEVER)
+        assert np.any(road.v_0[road.type == 1] != 10)
+
+    with pytest.raises(ValueError):
+        Simulation.restore(checkpoint, params_list=[Params(**{**PARAMS_LIST[0].as_dict(), 'length': 8}), PARAMS_LIST[1]])
@@ -0,0 +1,19 @@
+from Car import Params
+from Simulation import Simulation
+from Corridor import Segment, OnRamp, OffRamp
+
+def test_blocked_ramp_cars_wait_until_they_merge():
+    # The right lane is busy, so the ramp demand is often blocked
+    corridor = [Segment(1000), Segment(1000, speed_limit=100, on_ramp=OnRamp(0.5), off_ramp=OffRamp(0.2)), Segment(1000)]
+    sim = Simulation([Params(fail_p=0)], road_lanes=2, car_frequency=2, delta_t=0.2, engine='vectorized', corridor=corridor, seed=3)
+
+    merges = []
+    for _ in range(1500):
+        sim.step()
+        merges += sim.road.merges
+
+    summary, = sim.road.ramp_summary()
+    assert abs(summary['arrived'] - 150) <= 1 # 0.5 cars per second for 300 s
+    assert summary['waiting'] > 0
+    assert summary['arrived'] == summary['merged'] + summary['waiting']
+    assert len(merges) == len(set(merges)) == summary['merged']
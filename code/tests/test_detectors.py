@@ -0,0 +1,45 @@
+import numpy as np
+from Car import Params
+from Simulation import Simulation
+from Detectors import DetectorRecorder, LoopDetector, SectionDetector
+
+PARAMS_LIST = [Params(fail_p=1e-3, fail_steps=20), Params(v_0=(20, 2), length=(12, 1), thr=0.1, right_bias=0.1, pol=0.2)]
+
+def detectors():
+    return DetectorRecorder([LoopDetector(300), LoopDetector(700, lanes=[0]), SectionDetector(100, 900)], interval=30)
+
+def simulation():
+    return Simulation(PARAMS_LIST, road_length=1000, road_lanes=2, car_frequency=2, delta_t=0.2, seed=4, engine='vectorized')
+
+def test_restored_run_matches_uninterrupted_run(tmp_path):
+    checkpoint = str(tmp_path / 'sim.ckpt')
+    sim = simulation()
+    sim.run(time=60, recorder=[], checkpoint=checkpoint, checkpoint_every=60)
+
+    uninterrupted = simulation()
+    full = uninterrupted.run(time=150, recorder=detectors())
+    restored = Simulation.restore(checkpoint).run(time=90, recorder=detectors())
+
+    # The restored run starts with the interval the checkpoint is in, and each interval has its full length
+    assert restored.start == 60
+    assert np.allclose(restored.durations, 30)
+    assert np.allclose(full.durations, 30)
+
+    # Everything that doesn't need the positions before the first step is the same as in the uninterrupted run
+    for name in ('occupancy', 'density', 'space_mean_speed'):
+        ours, theirs = getattr(restored, name), getattr(full, name)[:, 2:]
+        assert np.allclose(ours[2], theirs[2], equal_nan=True), name
+    assert np.allclose(restored.occupancy[:2], full.occupancy[:2, 2:])
+
+    # The cars passing the loop detectors are only missed in the first step
+    assert np.array_equal(restored.counts[:, 1:], full.counts[:, 3:])
+    assert np.all(restored.counts[:, 0] <= full.counts[:, 2])
+
+def test_second_run_continues_the_intervals():
+    sim = simulation()
+    sim.run(time=45, recorder=[])
+    recorder = sim.run(time=45, recorder=detectors())
+
+    assert recorder.start == 30
+    assert np.allclose(recorder.durations, [15, 30])
+    assert recorder.density.shape == (3, 2)
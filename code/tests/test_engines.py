@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from Car import Params
+from Recorder import CallbackRecorder
+from Simulation import Simulation
+
+PARAMS_LIST = [Params(fail_p=1e-3, fail_steps=20), Params(v_0=(20, 2), length=(12, 1), thr=0.1, right_bias=0.1, pol=0.2)]
+
+def test_neighbours_match_a_scan_of_all_the_cars():
+    sim = Simulation(PARAMS_LIST, road_length=1000, road_lanes=3, car_frequency=3, delta_t=0.2, seed=2)
+    sim.run(time=60, recorder=[])
+    road = sim.road
+
+    def closest(car, lane, front):
+        # Closest car in the lane ahead of (or behind) the car, the oldest one if several are at the same position
+        others = [other for other in road.carlist if other.pos[1] == lane and (other.pos[0] > car.pos[0] if front else other.pos[0] < car.pos[0])]
+        return min(others, key=lambda other: ((other.pos[0] if front else -other.pos[0]), other.id), default=None)
+
+    for car in road.carlist:
+        x, lane = car.pos
+        left = lane - road.lanewidth if lane != road.toplane else None
+        right = lane + road.lanewidth if lane != road.bottomlane else None
+        expected = (closest(car, lane, True),
+                    closest(car, left, True) if left is not None else None, closest(car, right, True) if right is not None else None,
+                    closest(car, left, False) if left is not None else None, closest(car, right, False) if right is not None else None)
+        assert car.get_cars_around() == expected
+
+def test_both_engines_give_the_same_cars():
+    runs = [Simulation(PARAMS_LIST, road_length=1000, road_lanes=3, car_frequency=3, delta_t=0.2, engine=engine, seed=5).run(time=100)
+            for engine in ('objects', 'vectorized')]
+
+    for cars, vector_cars in zip(*runs):
+        assert [car['id'] for car in cars] == [car['id'] for car in vector_cars]
+        for name in ('pos', 'v', 'accel', 'length'):
+            assert np.allclose([car[name] for car in cars], [car[name] for car in vector_cars], rtol=0, atol=1e-6)
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_the_same_seed_gives_the_same_run(engine):
+    def run(seed):
+        return Simulation(PARAMS_LIST, road_length=1000, car_frequency=2, delta_t=0.2, engine=engine, seed=seed).run(time=60)
+
+    assert run(0) == run(0)
+    assert run(0) != run(1)
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_failures_follow_the_geometric_distribution(engine):
+    fail_p, fail_steps = 0.02, 10
+    sim = Simulation([Params(fail_p=fail_p, fail_steps=fail_steps)], road_length=2000, delta_t=0.2, engine=engine, ring_density=20, seed=3)
+
+    # Whether each car fails, in every step (the cars of a ring stay the same)
+    steps = []
+    def record(t, road):
+        if engine == 'objects': steps.append([car.failing for car in sorted(road.carlist, key=lambda car: car.id)])
+        else: steps.append(road.failing[np.argsort(road.id)].tolist())
+    sim.run(time=600, recorder=CallbackRecorder(record))
+
+    runs, gaps = [], []
+    for failing in np.array(steps, dtype=bool).T:
+        changes = np.flatnonzero(np.diff(failing.astype(int)))
+        # The failures and the gaps between them that start and end within the run
+        lengths, states = np.diff(changes), failing[changes[1:]]
+        runs += lengths[states].tolist()
+        gaps += lengths[~states].tolist()
+
+    # Every failure lasts fail_steps, and the steps between two failures are geometric with p = fail_p
+    assert len(runs) > 1000 and set(runs) == {fail_steps}
+    assert min(gaps) >= 1 and np.mean(gaps) == pytest.approx(1 / fail_p, rel=0.1)
+    assert np.mean(steps) == pytest.approx(fail_steps / (fail_steps + 1 / fail_p), rel=0.1)
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_exits_are_the_cars_that_left(engine):
+    sim = Simulation(PARAMS_LIST, road_length=500, car_frequency=3, delta_t=0.2, engine=engine, seed=4)
+
+    last, entered, exits = {}, {}, 0
+    def record(t, road):
+        nonlocal last, exits
+        cars = {car['id']: car for car in road.serialize()}
+        for i in cars.keys() - last.keys(): entered[i] = t
+
+        # Every car that left is reported once, with the time since it entered, and no car past the end is kept
+        left = last.keys() - cars.keys()
+        assert sorted(i for i, _ in road.exits) == sorted(left)
+        for i, travel_time in road.exits:
+            assert travel_time == pytest.approx(t - entered[i])
+        assert all(car['pos'][0] - car['length'] / 2 <= road.length for car in cars.values())
+        last, exits = cars, exits + len(left)
+    sim.run(time=120, recorder=CallbackRecorder(record))
+    assert exits > 20
@@ -0,0 +1,27 @@
+import pytest
+import numpy as np
+from Car import Params
+from Inflow import Inflow, DemandProfile, ArrivalTrace
+from Simulation import Simulation
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_the_lanes_of_the_demand_have_to_be_on_the_road(engine):
+    for demand in (ArrivalTrace([1, 2, 3], [0, 2, 1]), DemandProfile([0], [[0.5, 0.5, 0.5]])):
+        with pytest.raises(ValueError):
+            Simulation([Params()], road_lanes=2, engine=engine, inflow=Inflow(demand))
+    with pytest.raises(ValueError):
+        ArrivalTrace([1, 2], [0, -2])
+
+    Simulation([Params()], road_lanes=2, engine=engine, inflow=Inflow(ArrivalTrace([1, 2, 3], [0, -1, 1])))
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+def test_every_arrival_is_counted_once(engine):
+    # More demand than the road can take, so the queues fill up and cars are rejected
+    inflow = Inflow(DemandProfile([0, 30], [[3, 1], [0.5, 0.5]]), max_queue=5, horizon=7)
+    sim = Simulation([Params()], road_length=1000, road_lanes=2, delta_t=0.2, engine=engine, inflow=inflow, seed=0)
+    sim.run(time=60, recorder=[])
+
+    queues = sim.road.queues
+    assert np.all(queues.arrived == queues.entered + queues.rejected + queues.lengths)
+    summary = queues.summary()
+    assert summary['rejected'] > 0 and summary['arrived'] == summary['entered'] + summary['rejected'] + summary['queued']
@@ -0,0 +1,16 @@
+import pytest
+from Car import Params
+from Recorder import TrajectoryRecorder, CallbackRecorder
+from Simulation import Simulation
+
+def test_a_failed_run_closes_its_recorders(tmp_path):
+    def fail(t, road):
+        if road.step_count == 5: raise RuntimeError("failed")
+
+    trajectory = TrajectoryRecorder(str(tmp_path / 'run.traj'))
+    sim = Simulation([Params()], road_length=300, car_frequency=2, delta_t=0.2, seed=0)
+    with pytest.raises(RuntimeError):
+        sim.run(time=10, recorder=[trajectory, CallbackRecorder(fail)])
+
+    files = trajectory.writer._TrajectoryWriter__files
+    assert files and all(f.closed for f in files.values())
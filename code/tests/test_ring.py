@@ -0,0 +1,30 @@
+import pytest
+from Car import Params
+from Simulation import Simulation
+
+def lanes_of(road):
+    """Position and length of the cars of each lane, sorted by position
+    """
+
+    lanes = {}
+    for car in road.serialize():
+        lanes.setdefault(car['pos'][1], []).append((car['pos'][0], car['length']))
+    return [sorted(cars) for _, cars in sorted(lanes.items())]
+
+@pytest.mark.parametrize('engine', ['objects', 'vectorized'])
+@pytest.mark.parametrize('lanes', [2, 3])
+def test_filled_ring_has_no_overlap_after_first_step(engine, lanes):
+    sim = Simulation([Params(fail_p=0, length=5)], road_length=1000, road_lanes=lanes, delta_t=0.2, engine=engine, ring_density=60, seed=1)
+
+    # A car side by side with one in the next lane at the same position would be invisible to its lane changes
+    filled = lanes_of(sim.road)
+    for lane, next_lane in zip(filled, filled[1:]):
+        assert not {x for x, _ in lane} & {x for x, _ in next_lane}
+
+    sim.step()
+    cars = lanes_of(sim.road)
+    assert sum(len(lane) for lane in cars) == 60
+    for lane in cars:
+        # Every car ends before the next one starts, also across the end of the ring
+        for (x, length), (next_x, next_length) in zip(lane, lane[1:] + [(lane[0][0] + 1000, lane[0][1])]):
+            assert x + length / 2 < next_x - next_length / 2